@@ -7,8 +7,6 @@ import platform
 import socket
 import sys
 
-import yaml
-
 import server.cfg
 import server.http_handler as http
 
@@ -29,11 +27,7 @@ if __name__ == '__main__':
     log.info('Starting %s %s on %s (Python %s)...' % (
         PROJECT, VERSION, socket.gethostname(), platform.python_version()))
     log.info('Using config file: %s' % config_file)
-    config_obj = server.cfg.ScorerConfig()
-    with open(config_file) as f:
-        data_map = yaml.safe_load(f)
-        if data_map != None:
-            config_obj = server.cfg.ScorerConfig(**data_map)
+    config_obj = server.cfg.load_config(config_file)
 
     # Set log level to the value of 'log_level' in the config.
     # For interpretation of 'log_level', see
@@ -44,5 +38,6 @@ if __name__ == '__main__':
     except AttributeError as ae:
         pass
 
-    svr = http.OpenWeixinScorer(config_obj)
+    # SIGHUP (or POST /admin/reload) reads config_file again
+    svr = http.OpenWeixinScorer(config_obj, config_file)
     svr.run()
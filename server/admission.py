@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+# Weight of the newest sample in the moving averages of service time and cost
+SERVICE_TIME_EWMA_WEIGHT = 0.1
+
+class AdmissionRejected(Exception):
+    '''This exception is thrown when a backend is saturated: its wait queue
+    is full or the request waited longer than allowed.
+    '''
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class BackendLimiter(object):
+    '''BackendLimiter admits at most `max_concurrency` requests at a time to
+    one backend. Up to `max_queue` more wait, each for at most
+    `max_queue_time_sec` seconds; beyond that, AdmissionRejected is raised at
+    once, so a client gets a fast 503 rather than a timeout.
+
+    Waiting requests are let in shortest expected job first, with aging: a
+    request with `cost_sec` seconds of audio goes in as if it had arrived
+    `sjf_weight` * cost_sec seconds later. A short drill thus overtakes a
+    long recital queued a little before it, but never one queued long
+    enough before it. A request whose cost is not known yet counts as the
+    average cost released lately. With sjf_weight 0, the order is FIFO.
+
+    Call `started = await limiter.acquire(cost_sec)` before using the backend
+    and `limiter.release(started, cost_sec)` afterwards. A max_concurrency of
+    0 admits all.
+    '''
+
+    def __init__(self, max_concurrency=0, max_queue=0, max_queue_time_sec=5, sjf_weight=0):
+        self.max_concurrency = int(max_concurrency)
+        self.max_queue = int(max_queue)
+        self.max_queue_time_sec = float(max_queue_time_sec)
+        self.sjf_weight = float(sjf_weight)
+        self.in_flight = 0
+        # Heap of [priority, arrival number, future]
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_sec_total = 0.0
+        self.wait_sec_max = 0.0
+        self.service_sec_avg = 0.0
+        self.cost_sec_avg = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    async def acquire(self, cost_sec=None):
+        '''Wait for a slot and return the time it was granted. `cost_sec` is
+        the expected work (seconds of audio), if known (else the average).
+        '''
+
+        if self.max_concurrency <= 0 or (
+                self.in_flight < self.max_concurrency and not self._waiters):
+            return self._admit(0.0)
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected('Backend saturated (%d in flight, %d queued)' % (
+                self.in_flight, len(self._waiters)), self.retry_after())
+        self.queued += 1
+        fut = asyncio.get_event_loop().create_future()
+        start = time.monotonic()
+        if cost_sec is None:
+            cost_sec = self.cost_sec_avg
+        priority = start + self.sjf_weight * cost_sec
+        heapq.heappush(self._waiters, [priority, next(self._arrivals), fut])
+        try:
+            await asyncio.wait_for(fut, self.max_queue_time_sec)
+        except asyncio.TimeoutError:
+            if not self._discard(fut):
+                # The slot was handed over just as the wait timed out
+                self.in_flight -= 1
+                self._wake_next()
+            self.rejected += 1
+            self.timed_out += 1
+            raise AdmissionRejected('Queued for more than %gs' % self.max_queue_time_sec,
+                self.retry_after())
+        except asyncio.CancelledError:
+            if not self._discard(fut):
+                # The slot was handed over just before the cancellation
+                self.in_flight -= 1
+                self._wake_next()
+            raise
+        # release() has already counted us in in_flight
+        self.in_flight -= 1
+        return self._admit(time.monotonic() - start)
+
+    def try_acquire(self):
+        '''Take a slot if one is free with nobody waiting, and return the time
+        it was granted; return None rather than wait.
+        '''
+
+        if self.max_concurrency <= 0 or (
+                self.in_flight < self.max_concurrency and not self._waiters):
+            return self._admit(0.0)
+        return None
+
+    def release(self, started=None, cost_sec=None):
+        '''Give the slot back; `started` (from acquire) feeds the average
+        service time used for Retry-After, and `cost_sec` (the work done, if
+        known) the average cost of requests acquired without one.
+        '''
+
+        self.in_flight -= 1
+        if started is not None:
+            self.service_sec_avg += SERVICE_TIME_EWMA_WEIGHT * (
+                time.monotonic() - started - self.service_sec_avg)
+        if cost_sec is not None:
+            self.cost_sec_avg += SERVICE_TIME_EWMA_WEIGHT * (cost_sec - self.cost_sec_avg)
+        self._wake_next()
+
+    def retry_after(self):
+        '''Return seconds a rejected client should wait before retrying: the
+        time to drain the current queue, at least 1.
+        '''
+
+        if self.max_concurrency <= 0:
+            return 1
+        drain = (len(self._waiters) + 1) * self.service_sec_avg / self.max_concurrency
+        return max(1, int(math.ceil(drain)))
+
+    def stats(self):
+        return {
+            'in_flight':       self.in_flight,
+            'queue_depth':     len(self._waiters),
+            'admitted':        self.admitted,
+            'queued':          self.queued,
+            'rejected':        self.rejected,
+            'timed_out':       self.timed_out,
+            'wait_sec_total':  self.wait_sec_total,
+            'wait_sec_max':    self.wait_sec_max,
+            'service_sec_avg': self.service_sec_avg,
+            'cost_sec_avg':    self.cost_sec_avg,
+        }
+
+    def _admit(self, waited):
+        self.in_flight += 1
+        self.admitted += 1
+        self.wait_sec_total += waited
+        self.wait_sec_max = max(self.wait_sec_max, waited)
+        return time.monotonic()
+
+    def _wake_next(self):
+        while self._waiters and (self.max_concurrency <= 0 or self.in_flight < self.max_concurrency):
+            fut = heapq.heappop(self._waiters)[2]
+            if not fut.done():
+                # Hand the slot over; the waiter takes it in acquire()
+                self.in_flight += 1
+                fut.set_result(None)
+
+    def _discard(self, fut):
+        for i, waiter in enumerate(self._waiters):
+            if waiter[2] is fut:
+                self._waiters[i] = self._waiters[-1]
+                self._waiters.pop()
+                heapq.heapify(self._waiters)
+                return True
+        return False
+
+class AdmissionController(object):
+    '''AdmissionController holds one BackendLimiter per scorer URL.
+
+    Limits come from `defaults` (a dict with max_concurrency, max_queue,
+    max_queue_time_sec and optionally sjf_weight) updated with
+    `per_url[url]`, if any.
+    '''
+
+    def __init__(self, defaults, per_url=None):
+        self.defaults = dict(defaults)
+        self.per_url = dict(per_url or {})
+        self._limiters = {}
+
+    def limiter(self, url):
+        try:
+            return self._limiters[url]
+        except KeyError:
+            pass
+        limits = dict(self.defaults)
+        limits.update(self.per_url.get(url) or {})
+        limiter = BackendLimiter(**limits)
+        self._limiters[url] = limiter
+        return limiter
+
+    def update(self, defaults, per_url=None):
+        '''Apply new limits. Limiters keep their in-flight and queued
+        requests; raising a limit lets waiters in at once.
+        '''
+
+        self.defaults = dict(defaults)
+        self.per_url = dict(per_url or {})
+        for url, limiter in self._limiters.items():
+            limits = dict(self.defaults)
+            limits.update(self.per_url.get(url) or {})
+            limiter.max_concurrency = int(limits['max_concurrency'])
+            limiter.max_queue = int(limits['max_queue'])
+            limiter.max_queue_time_sec = float(limits['max_queue_time_sec'])
+            limiter.sjf_weight = float(limits.get('sjf_weight', 0))
+            limiter._wake_next()
+
+    def stats(self):
+        return {url: limiter.stats() for url, limiter in self._limiters.items()}
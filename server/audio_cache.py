@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import time
+
+log = logging.getLogger()
+
+CACHE_FILE_SUFFIX = '.spx'
+TEMP_FILE_SUFFIX = '.tmp'
+# Bytes per chunk when serving a cached file
+SERVE_BLOCK_SIZE = 32768
+# Temporary files older than this are removed on startup
+STALE_TEMP_FILE_SEC = 3600
+
+class AudioCache(object):
+    '''AudioCache stores downloaded audio, already in Liulishuo speex framing,
+    in a local directory, one file per mediaId.
+
+    Audio is kept while the download streams to the scorer (see tee) and
+    written in the background once the download completed, becoming visible
+    by an atomic rename. Cached audio is served from a memory map. Files are
+    only opened, written and mapped by executor threads, never on the event
+    loop. When the files exceed `max_bytes`, the least recently used ones
+    are deleted.
+
+    Every process keeps its own index, so with several workers sharing a
+    directory the size limit is enforced by each of them separately.
+    '''
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self._files = collections.OrderedDict() # file name -> size, LRU first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._commits = set() # tasks writing files
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def file_name(self, media_id):
+        # mediaId is chosen by WeChat; hash it rather than trust it in a path
+        return hashlib.sha1(media_id.encode()).hexdigest() + CACHE_FILE_SUFFIX
+
+    async def open(self, media_id, block_size=SERVE_BLOCK_SIZE):
+        '''Return an async iterator over the cached audio of `media_id`, or
+        None if it is not cached.
+        '''
+
+        name = self.file_name(media_id)
+        mapped = await asyncio.get_event_loop().run_in_executor(None, _map_file,
+            os.path.join(self.directory, name))
+        if mapped is None:
+            self._forget(name)
+            self.misses += 1
+            return None
+        mm, size = mapped
+        self.hits += 1
+        self._touch(name, size)
+        return _serve_mmap(mm, block_size)
+
+    def size(self, media_id):
+        '''Return the size of the cached audio of `media_id`, or None.
+        '''
+
+        return self._files.get(self.file_name(media_id))
+
+    async def tee(self, media_id, chunks):
+        '''Yield the chunks of `chunks` while keeping a copy of them. Once
+        `chunks` is exhausted without error, the copy is written to the cache
+        in the background (see close), so the consumer does not wait for it.
+        '''
+
+        kept = []
+        async for chunk in chunks:
+            # Chunks may be views of a buffer the reader reuses
+            kept.append(bytes(chunk))
+            yield chunk
+        commit = asyncio.ensure_future(self._commit(media_id, kept))
+        self._commits.add(commit)
+        commit.add_done_callback(self._commits.discard)
+
+    async def close(self):
+        '''Wait for the files being written.
+        '''
+
+        if self._commits:
+            await asyncio.gather(*self._commits)
+
+    def stats(self):
+        return {
+            'files':     len(self._files),
+            'bytes':     self.bytes,
+            'hits':      self.hits,
+            'misses':    self.misses,
+            'writes':    self.writes,
+            'evictions': self.evictions,
+        }
+
+    async def _commit(self, media_id, chunks):
+        name = self.file_name(media_id)
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._write_file,
+                os.path.join(self.directory, name), chunks)
+        except OSError as e:
+            log.warning('Unable to cache audio of %s: %r' % (media_id, e))
+            return
+        self.writes += 1
+        self._touch(name, sum(len(chunk) for chunk in chunks))
+        evicted = self._evict()
+        if evicted:
+            await asyncio.get_event_loop().run_in_executor(None, _remove_files, evicted)
+
+    def _write_file(self, path, chunks):
+        # The file only becomes visible, complete, by the rename
+        tmp_path = '%s.%d%s' % (path, os.getpid(), TEMP_FILE_SUFFIX)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(b''.join(chunks))
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _load_index(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(TEMP_FILE_SUFFIX):
+                # Left over by a crashed writer (recent ones may belong to a
+                # worker that is still writing)
+                try:
+                    if time.time() - entry.stat().st_mtime < STALE_TEMP_FILE_SEC:
+                        continue
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            elif entry.name.endswith(CACHE_FILE_SUFFIX):
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._touch(name, size)
+        _remove_files(self._evict())
+
+    def _touch(self, name, size):
+        self._forget(name)
+        self._files[name] = size
+        self.bytes += size
+
+    def _forget(self, name):
+        size = self._files.pop(name, None)
+        if size is not None:
+            self.bytes -= size
+
+    def _evict(self):
+        # Return the paths of the files to delete
+        evicted = []
+        while self.bytes > self.max_bytes and self._files:
+            name = next(iter(self._files))
+            self._forget(name)
+            self.evictions += 1
+            evicted.append(os.path.join(self.directory, name))
+        return evicted
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _map_file(path):
+    # Return the memory map and size of a cached file, or None
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return mm, size
+
+async def _serve_mmap(mm, block_size):
+    # Slices are not released explicitly: the transport may still hold one in
+    # its write buffer after send_bytes returns.
+    view = memoryview(mm)
+    try:
+        for i in range(0, len(view), block_size):
+            yield view[i:i+block_size]
+    finally:
+        del view
+        try:
+            mm.close()
+        except BufferError:
+            # A slice is still referenced; the map is unmapped with the last one
+            pass
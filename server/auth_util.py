@@ -1,16 +1,14 @@
 import hashlib
-import json
 import logging
 import random
 import time
 
+from .meta_util import json_dumps, parse_json, remove_trail_from_meta
+
 log = logging.getLogger()
 rand = random.Random()
 rand.seed()
 
-def remove_trail_from_meta(meta):
-    return meta[:meta.rfind('}')+1]
-
 def generate_salt():
     rand_uint32 = rand.randint(0, 2**32 - 1)
     now = time.time()
@@ -30,30 +28,40 @@ def get_signed_request(config, meta, salt=None):
               to set this argument)
     '''
 
-    app_id = ''
-    secret = ''
-    try:
-        app_id = config.app_id
-        secret = config.secret
-    except AttributeError as ae:
-        log.warning(ae)
-    if app_id == None or secret == None or len(app_id) == 0 or len(secret) == 0:
+    credentials = get_credentials(config)
+    if credentials is None:
         # AppID or secret not set - signing disabled
         return meta
 
-    meta_json = remove_trail_from_meta(meta)
-    try:
-        meta_dict = json.loads(meta_json)
-    except json.decoder.JSONDecodeError as jde:
-        log.warning(jde)
+    meta_dict = parse_json(meta)
+    if meta_dict is None:
+        log.warning('Meta is not a JSON object: %r' % meta)
         return ''
+    return sign_meta_dict(credentials[0], credentials[1], meta_dict, salt)
+
+def get_credentials(config):
+    '''Return (app_id, secret) from config, or None if signing is disabled.
+    '''
+
+    app_id = getattr(config, 'app_id', None)
+    secret = getattr(config, 'secret', None)
+    if not app_id or not secret:
+        return None
+    return app_id, secret
+
+def sign_meta_dict(app_id, secret, meta_dict, salt=None):
+    '''Return the signed meta text for the parsed meta `meta_dict`.
+
+    meta_dict itself is not modified.
+    '''
 
     if salt == None or len(salt) == 0:
         salt = generate_salt()
+    meta_dict = dict(meta_dict)
     meta_dict['appID'] = app_id
     meta_dict['salt'] = salt
-    new_meta = json.dumps(meta_dict)
-    str_to_hash = '+'.join((app_id, new_meta, meta_dict['salt'], secret))
+    new_meta = json_dumps(meta_dict)
+    str_to_hash = '+'.join((app_id, new_meta, salt, secret))
     hash_obj = hashlib.new('md5', str_to_hash.encode())
     hash_str = hash_obj.hexdigest()
     return new_meta + ';hash=' + hash_str
@@ -0,0 +1,175 @@
+import math
+import random
+import time
+
+POLICY_LEAST_OUTSTANDING = 'least_outstanding'
+POLICY_PEAK_EWMA = 'peak_ewma'
+POLICIES = (POLICY_LEAST_OUTSTANDING, POLICY_PEAK_EWMA)
+# Share of its normal load a backend gets right after an ejection ends
+RECOVERY_MIN_WEIGHT = 0.1
+
+def check_policy(policy):
+    if policy not in POLICIES:
+        raise ValueError('Unknown balancing policy %r (expected one of %s)' % (
+            policy, ', '.join(POLICIES)))
+
+class Backend(object):
+    '''Backend holds the load and health of one scorer endpoint.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.latency_ewma = 0.0 # seconds
+        self.updated_at = time.monotonic()
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def weight(self, now, recovery_sec):
+        '''Return the share of traffic (0 to 1) the backend may take: 0 while
+        ejected, growing linearly back to 1 over `recovery_sec` afterwards.
+        '''
+
+        if self.ejections == 0 or recovery_sec <= 0:
+            return 1.0 if now >= self.ejected_until else 0.0
+        if now < self.ejected_until:
+            return 0.0
+        return min(1.0, max(RECOVERY_MIN_WEIGHT, (now - self.ejected_until) / recovery_sec))
+
+    def stats(self, now, recovery_sec):
+        return {
+            'outstanding':  self.outstanding,
+            'latency_ewma': self.latency_ewma,
+            'weight':       self.weight(now, recovery_sec),
+            'ejected':      int(now < self.ejected_until),
+            'requests':     self.requests,
+            'failures':     self.failures,
+            'ejections':    self.ejections,
+        }
+
+class Lease(object):
+    '''Lease is one request to a backend chosen by LoadBalancer.pick(). Only
+    the first finish() counts, so it can also be called from a finally block.
+    '''
+
+    def __init__(self, balancer, backend):
+        self.balancer = balancer
+        self.backend = backend
+        self.url = backend.url
+        self.finished = False
+
+    def finish(self, latency=None, failed=False):
+        if not self.finished:
+            self.finished = True
+            self.balancer.finish(self.backend, latency, failed)
+
+class LoadBalancer(object):
+    '''LoadBalancer picks one of several scorer endpoints for each request.
+
+    With the least_outstanding policy the endpoint with the fewest requests
+    in flight wins; with peak_ewma, the one with the lowest latency estimate
+    times requests in flight, where the estimate jumps to any slower sample
+    and decays towards faster ones with a time constant of `decay_sec`.
+
+    An endpoint failing `eject_after` times in a row (WS connect errors,
+    LiulishuoResponseError) is ejected for `eject_sec` seconds, then its share
+    of traffic grows back to normal over `recovery_sec` seconds. If every
+    endpoint of a request is ejected, the one coming back first is used.
+
+    Call `lease = balancer.pick(urls)`, then `lease.finish(...)` when the
+    request is over. Endpoints are shared by every list they are in.
+    '''
+
+    def __init__(self, policy=POLICY_LEAST_OUTSTANDING, eject_after=3, eject_sec=10,
+            recovery_sec=30, decay_sec=10):
+        self._backends = {}
+        self.update(policy, eject_after, eject_sec, recovery_sec, decay_sec)
+
+    def update(self, policy=POLICY_LEAST_OUTSTANDING, eject_after=3, eject_sec=10,
+            recovery_sec=30, decay_sec=10):
+        '''Apply new settings; the load and health of backends are kept.
+        '''
+
+        check_policy(policy)
+        self.policy = policy
+        self.eject_after = int(eject_after)
+        self.eject_sec = float(eject_sec)
+        self.recovery_sec = float(recovery_sec)
+        self.decay_sec = float(decay_sec)
+
+    def backend(self, url):
+        try:
+            return self._backends[url]
+        except KeyError:
+            backend = self._backends[url] = Backend(url)
+            return backend
+
+    def pick(self, urls):
+        '''Choose a backend among `urls`, count the request against it and
+        return a Lease.
+        '''
+
+        if len(urls) == 1:
+            backend = self.backend(urls[0])
+        else:
+            backend = self._choose([self.backend(url) for url in urls])
+        backend.outstanding += 1
+        backend.requests += 1
+        return Lease(self, backend)
+
+    def finish(self, backend, latency=None, failed=False):
+        '''End a request started with pick() (see Lease.finish).
+
+        Arguments:
+        backend -- the Backend of the lease
+        latency -- seconds the backend took, if it answered
+        failed  -- whether the backend itself failed
+        '''
+
+        backend.outstanding -= 1
+        now = time.monotonic()
+        if failed:
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if self.eject_after > 0 and backend.consecutive_failures >= self.eject_after:
+                backend.consecutive_failures = 0
+                backend.ejected_until = now + self.eject_sec
+                backend.ejections += 1
+            return
+        backend.consecutive_failures = 0
+        if latency is None:
+            return
+        if latency > backend.latency_ewma:
+            backend.latency_ewma = latency
+        else:
+            decay = math.exp(-(now - backend.updated_at) / self.decay_sec) if self.decay_sec > 0 else 0.0
+            backend.latency_ewma = latency + (backend.latency_ewma - latency) * decay
+        backend.updated_at = now
+
+    def stats(self):
+        now = time.monotonic()
+        return {url: backend.stats(now, self.recovery_sec)
+            for url, backend in self._backends.items()}
+
+    def _choose(self, backends):
+        now = time.monotonic()
+        best, best_cost = None, None
+        # Start at a random place so that ties do not always go to the first
+        start = random.randrange(len(backends))
+        for i in range(len(backends)):
+            backend = backends[(start + i) % len(backends)]
+            weight = backend.weight(now, self.recovery_sec)
+            if weight <= 0:
+                continue
+            load = backend.outstanding + 1
+            if self.policy == POLICY_PEAK_EWMA:
+                load *= backend.latency_ewma
+            cost = load / weight
+            if best is None or cost < best_cost:
+                best, best_cost = backend, cost
+        if best is None:
+            best = min(backends, key=lambda backend: backend.ejected_until)
+        return best
@@ -0,0 +1,235 @@
+import collections
+import logging
+import math
+import time
+
+from . import transport
+
+log = logging.getLogger()
+
+# Breaker states, as exported on /metrics
+STATE_CLOSED = 0
+STATE_OPEN = 1
+STATE_HALF_OPEN = 2
+# Settings of a breaker not listed in config (see BreakerSet)
+DEFAULT_SETTINGS = {
+    'window_sec':       10,
+    'min_requests':     20,
+    'error_percent':    50,
+    'timeout_percent':  50,
+    'open_sec':         5,
+    'half_open_probes': 1,
+}
+# Upstreams with several endpoints, each with its own breaker (see
+# BreakerSet.endpoint)
+ENDPOINT_UPSTREAMS = (transport.UPSTREAM_SCORER,)
+
+class CircuitOpen(Exception):
+    '''This exception is thrown when an upstream's circuit breaker is open:
+    the upstream failed too often lately and is not called for a while.
+    '''
+
+    def __init__(self, upstream, retry_after=1):
+        super().__init__('Circuit of %s is open' % upstream)
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+def check_settings(settings):
+    for name, value in settings.items():
+        if name not in DEFAULT_SETTINGS:
+            raise ValueError('Unknown breaker setting %r (expected one of %s)' % (
+                name, ', '.join(sorted(DEFAULT_SETTINGS))))
+        if float(value) < 0:
+            raise ValueError('Invalid breaker %s: %r' % (name, value))
+
+class CircuitBreaker(object):
+    '''CircuitBreaker stops calls to an upstream that keeps failing.
+
+    Calls are counted in one-second buckets over the last `window_sec`
+    seconds. Once there were at least `min_requests` of them, the breaker
+    opens when `error_percent` percent failed (timeouts included) or
+    `timeout_percent` percent timed out (0 disables either check). While
+    open, calls fail at once with CircuitOpen. After `open_sec` seconds the
+    breaker is half open: up to `half_open_probes` calls go through at a
+    time; the first success closes it, a failure opens it again.
+
+    Call `breaker.allow()` before calling the upstream, then exactly one of
+    `breaker.success()`, `breaker.failure(timeout)` or, if the call ended
+    for a reason that says nothing about the upstream, `breaker.skip()`.
+    '''
+
+    def __init__(self, name, settings=None):
+        self.name = name
+        self.apply(dict(DEFAULT_SETTINGS, **(settings or {})))
+        self.state = STATE_CLOSED
+        self.opened_at = 0.0
+        self.probes = 0
+        # [second, calls, failures, timeouts], oldest first
+        self._buckets = collections.deque()
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.trips = 0
+
+    def apply(self, settings):
+        self.window_sec = int(math.ceil(float(settings['window_sec'])))
+        self.min_requests = int(settings['min_requests'])
+        self.error_percent = float(settings['error_percent'])
+        self.timeout_percent = float(settings['timeout_percent'])
+        self.open_sec = float(settings['open_sec'])
+        self.half_open_probes = max(1, int(settings['half_open_probes']))
+
+    def allow(self):
+        '''Raise CircuitOpen unless the upstream may be called now.
+        '''
+
+        if self.state == STATE_OPEN:
+            now = time.monotonic()
+            if now - self.opened_at < self.open_sec:
+                self.rejected += 1
+                raise CircuitOpen(self.name, self.retry_after(now))
+            self.state = STATE_HALF_OPEN
+            self.probes = 0
+        if self.state == STATE_HALF_OPEN:
+            if self.probes >= self.half_open_probes:
+                self.rejected += 1
+                raise CircuitOpen(self.name)
+            self.probes += 1
+        self.calls += 1
+
+    def success(self):
+        if self.state == STATE_HALF_OPEN:
+            log.info('Circuit of %s is closed again' % self.name)
+            self.state = STATE_CLOSED
+            self._buckets.clear()
+        self._count(0, 0)
+
+    def failure(self, timeout=False):
+        self.failures += 1
+        if timeout:
+            self.timeouts += 1
+        if self.state == STATE_HALF_OPEN:
+            self._open()
+            return
+        self._count(1, 1 if timeout else 0)
+        if self.state == STATE_CLOSED and self._tripped():
+            self._open()
+
+    def skip(self):
+        if self.state == STATE_HALF_OPEN:
+            self.probes -= 1
+
+    def retry_after(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return max(1, int(math.ceil(self.opened_at + self.open_sec - now)))
+
+    def stats(self):
+        calls, failures, timeouts = self._totals()
+        return {
+            'state':           self.state,
+            'calls':           self.calls,
+            'failures':        self.failures,
+            'timeouts':        self.timeouts,
+            'rejected':        self.rejected,
+            'trips':           self.trips,
+            'window_calls':    calls,
+            'window_failures': failures,
+        }
+
+    def _open(self):
+        log.warning('Circuit of %s is open for %gs' % (self.name, self.open_sec))
+        self.state = STATE_OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._buckets.clear()
+
+    def _count(self, failures, timeouts):
+        second = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == second:
+            bucket = self._buckets[-1]
+        else:
+            bucket = [second, 0, 0, 0]
+            self._buckets.append(bucket)
+        bucket[1] += 1
+        bucket[2] += failures
+        bucket[3] += timeouts
+        while self._buckets[0][0] <= second - self.window_sec:
+            self._buckets.popleft()
+
+    def _totals(self):
+        oldest = int(time.monotonic()) - self.window_sec
+        calls = failures = timeouts = 0
+        for second, c, f, t in self._buckets:
+            if second > oldest:
+                calls += c
+                failures += f
+                timeouts += t
+        return calls, failures, timeouts
+
+    def _tripped(self):
+        calls, failures, timeouts = self._totals()
+        if calls < max(1, self.min_requests):
+            return False
+        return ((self.error_percent > 0 and failures * 100 >= self.error_percent * calls) or
+            (self.timeout_percent > 0 and timeouts * 100 >= self.timeout_percent * calls))
+
+class BreakerSet(object):
+    '''BreakerSet holds one CircuitBreaker per upstream (see
+    server.transport.UPSTREAMS), with `defaults` (see DEFAULT_SETTINGS)
+    updated with `per_upstream[upstream]`, if any. The upstreams of
+    ENDPOINT_UPSTREAMS have one breaker per endpoint URL instead, so that a
+    dead endpoint does not stop calls to the others.
+    '''
+
+    def __init__(self, defaults=None, per_upstream=None):
+        self._breakers = {}
+        self._endpoints = {} # (upstream, url) -> CircuitBreaker
+        self._settings = {}
+        self.update(defaults, per_upstream)
+
+    def update(self, defaults=None, per_upstream=None):
+        '''Apply new settings; breakers keep their state and counts.
+        '''
+
+        for upstream in transport.UPSTREAMS:
+            settings = self.settings(defaults, per_upstream, upstream)
+            self._settings[upstream] = settings
+            if upstream in ENDPOINT_UPSTREAMS:
+                continue
+            if upstream in self._breakers:
+                self._breakers[upstream].apply(settings)
+            else:
+                self._breakers[upstream] = CircuitBreaker(upstream, settings)
+        for (upstream, _), endpoint_breaker in self._endpoints.items():
+            endpoint_breaker.apply(self._settings[upstream])
+
+    @staticmethod
+    def settings(defaults, per_upstream, upstream):
+        settings = dict(DEFAULT_SETTINGS, **(defaults or {}))
+        settings.update((per_upstream or {}).get(upstream) or {})
+        check_settings(settings)
+        return settings
+
+    def __getitem__(self, upstream):
+        return self._breakers[upstream]
+
+    def endpoint(self, upstream, url):
+        '''Return the breaker of endpoint `url` of `upstream` (one of
+        ENDPOINT_UPSTREAMS).
+        '''
+
+        try:
+            return self._endpoints[upstream, url]
+        except KeyError:
+            pass
+        endpoint_breaker = CircuitBreaker(url, self._settings[upstream])
+        self._endpoints[upstream, url] = endpoint_breaker
+        return endpoint_breaker
+
+    def stats(self):
+        return {upstream: breaker.stats() for upstream, breaker in self._breakers.items()}
+
+    def endpoint_stats(self):
+        return {url: breaker.stats() for (_, url), breaker in self._endpoints.items()}
@@ -1,8 +1,11 @@
 import asyncio
 
+import yaml
+
 class ScorerConfig(object):
     '''
-    ScorerConfig is loaded from YAML on server startup.
+    ScorerConfig is loaded from YAML on server startup, and again when the
+    server is told to reload it.
     It provides default values for the most common options.
     '''
 
@@ -12,11 +15,88 @@ class ScorerConfig(object):
     app_id = ''
     secret = ''
 
-    # Transport settings (merely listen address now, but timeouts or conn pool
-    # size or so on may be added in the future):
+    # Transport settings: listen address, and the client connections below.
     listen_addr = '0.0.0.0'
     listen_port = '54449'
 
+    # Number of worker processes, or 'auto' for one per CPU. With more than one
+    # worker, reuse_port lets each worker bind the port itself (SO_REUSEPORT,
+    # better balanced on Linux); otherwise the workers share one socket.
+    workers = 1
+    reuse_port = False
+
+    # Event loop to run on: 'asyncio', or 'uvloop' (faster; used only if the
+    # uvloop package is installed).
+    event_loop = 'asyncio'
+
+    # Admin endpoints (/admin/...) are only served when admin_token is set,
+    # and only to requests sending it in the X-Admin-Token header.
+    admin_token = ''
+
+    # Log records are formatted and written by a background thread; at most
+    # log_queue_size of them wait (0 logs synchronously), more are dropped and
+    # counted on /metrics. Each logging call site may log log_rate_burst
+    # warnings every log_rate_period_sec seconds (0 for no limit). With
+    # access_log, every rating request (rejected ones too) is logged in one
+    # line with its stage timings; aiohttp's access log keeps the others.
+    log_queue_size = 10000
+    log_rate_burst = 10
+    log_rate_period_sec = 10
+    access_log = True
+
+    # With traffic_record_path, the shape of traffic_sample_percent percent of
+    # rating requests (arrival time, question type, sizes and stage timings;
+    # no mediaId, token, meta or audio) is appended to that file, for
+    # test/replay.py to play back.
+    traffic_record_path = ''
+    traffic_sample_percent = 1
+
+    # The event loop's lag is measured every loop_lag_interval_sec seconds
+    # (0 disables) and exported on /metrics; when the loop is blocked for over
+    # slow_callback_sec seconds (0 disables), the blocking stack is logged.
+    # Profiles taken on /admin/profile last at most profile_max_sec seconds,
+    # sample the loop every profile_interval_sec seconds and list the
+    # profile_memory_top source lines allocating the most memory.
+    loop_lag_interval_sec = 0.5
+    slow_callback_sec = 0.1
+    profile_max_sec = 30
+    profile_interval_sec = 0.005
+    profile_memory_top = 20
+
+    # Client connections are pooled separately for each upstream (wechat,
+    # token, scorer), so a slow one cannot take the connections of the
+    # others. Each pool gets connector_defaults, updated with
+    # connectors[upstream]: limit (connections in total, 0 = unlimited),
+    # limit_per_host, keepalive_timeout (seconds an idle connection is kept)
+    # and ttl_dns_cache (seconds DNS answers are cached). For example:
+    #   connectors: {wechat: {limit: 400, limit_per_host: 200}}
+    connector_defaults = {
+        'limit':             100,
+        'limit_per_host':    0,
+        'keepalive_timeout': 15,
+        'ttl_dns_cache':     10,
+    }
+    connectors = {}
+
+    # Each upstream (wechat, token, and each scorer URL) has a circuit
+    # breaker. Once it got min_requests calls in the last window_sec seconds,
+    # it opens when error_percent percent of them failed or timeout_percent
+    # percent timed out (0 disables either). While open, requests fail at
+    # once the way the upstream's own errors do; after open_sec seconds,
+    # half_open_probes requests at a time try the upstream again. breakers
+    # overrides breaker_defaults per upstream (scorer for all scorer URLs),
+    # e.g.
+    #   breakers: {token: {min_requests: 5, open_sec: 2}}
+    breaker_defaults = {
+        'window_sec':       10,
+        'min_requests':     20,
+        'error_percent':    50,
+        'timeout_percent':  50,
+        'open_sec':         5,
+        'half_open_probes': 1,
+    }
+    breakers = {}
+
     # The following link is documented here (in Appendix):
     # https://mp.weixin.qq.com/wiki?t=resource/res_main&id=mp1444738727
     audio_download_url = 'https://api.weixin.qq.com/cgi-bin/media/get/jssdk'
@@ -24,5 +104,172 @@ class ScorerConfig(object):
     # Contact LLS to get correct value for this:
     scorer_url = 'https://liulishuo-scorer-url'
 
+    # scorer_url and each of type_specific_scorer_urls may also be a list of
+    # URLs. Requests are then spread by scorer_balancer: 'least_outstanding'
+    # (fewest requests in flight) or 'peak_ewma' (lowest latency times requests
+    # in flight, latency decaying over scorer_latency_decay_sec). A URL failing
+    # scorer_eject_after times in a row is left out for scorer_eject_sec
+    # seconds, then gets back to its full share over scorer_recovery_sec.
+    scorer_balancer = 'least_outstanding'
+    scorer_eject_after = 3
+    scorer_eject_sec = 10
+    scorer_recovery_sec = 30
+    scorer_latency_decay_sec = 10
+
+    # Hedging: when the scorer has not answered hedge_delay_sec seconds after
+    # the audio started streaming, the same audio is sent to a second endpoint
+    # and the first answer wins. With hedge_delay_sec 0, the delay is the
+    # hedge_quantile of the scoring durations seen for the question type
+    # (after hedge_min_samples of them). At most hedge_budget_percent percent
+    # of requests are hedged.
+    hedging = False
+    hedge_delay_sec = 0
+    hedge_quantile = 0.95
+    hedge_min_samples = 20
+    hedge_budget_percent = 5
+
+    # Audio is sent to the scorer in WS messages of at least ws_coalesce_bytes
+    # bytes, or whatever has been buffered for ws_coalesce_window_sec seconds.
+    # Set ws_coalesce_bytes to 0 to send audio as soon as it is downloaded.
+    ws_coalesce_bytes = 32768
+    ws_coalesce_window_sec = 0.05
+
+    # In pipelined mode the scorer WebSocket handshake starts with the request,
+    # concurrently with the access token fetch and the WeChat download; the
+    # socket is dropped if WeChat's response is an error. Frames downloaded
+    # before the socket is ready are queued, at most pipeline_queue_chunks
+    # reads of them, before the download is paused.
+    pipelined = False
+    pipeline_queue_chunks = 16
+
+    # Keep ws_pool_size idle, already-upgraded WebSocket connections to
+    # scorer_url and to each of type_specific_scorer_urls (0 disables the pool).
+    # Idle connections are checked every ws_pool_check_interval_sec seconds and
+    # replaced after ws_pool_max_idle_sec seconds.
+    ws_pool_size = 0
+    ws_pool_max_idle_sec = 20
+    ws_pool_check_interval_sec = 5
+
+    # Requests with the same mediaId and meta (salt and hash aside) share one
+    # scoring while it runs, if dedup_inflight_requests is set. Successful
+    # results (status 0) are kept for result_cache_ttl_sec seconds, at most
+    # result_cache_size of them and result_cache_max_bytes in total (set
+    # result_cache_size to 0 to disable). Clients may bypass both by sending
+    # `noCache: true` or `Cache-Control: no-cache`.
+    dedup_inflight_requests = True
+    result_cache_size = 1024
+    result_cache_max_bytes = 64 * 1024 * 1024
+    result_cache_ttl_sec = 300
+
+    # Downloaded audio can be kept in a local directory (audio_cache_dir, empty
+    # to disable) so that rescoring a recording does not download it again.
+    # The least recently used files are deleted beyond audio_cache_max_bytes.
+    audio_cache_dir = ''
+    audio_cache_max_bytes = 1024 * 1024 * 1024
+
+    # A rating request may have a deadline: request_deadline_sec seconds (0
+    # for none, the default), or less if the client sends a deadline_header
+    # of milliseconds. The stage caps below are never tighter than the fixed
+    # timeouts used before deadlines (10 seconds for WeChat, 30 for the scorer).
+    # A batch shares one deadline; a job gets its own when it starts. Each
+    # stage gets what is left, up to its own cap: wechat_timeout_sec for the
+    # download, ws_connect_timeout_sec for the scorer handshake, and
+    # scoring_timeout_sec plus scoring_timeout_per_audio_sec per second of
+    # audio for the scorer exchange. Scoring needs at least scoring_min_sec
+    # plus scoring_min_per_audio_sec per second of audio; a stage that would
+    # leave less than that fails at once (504) instead of using the scorer.
+    request_deadline_sec = 0
+    deadline_header = 'X-Request-Timeout-Ms'
+    wechat_timeout_sec = 10
+    ws_connect_timeout_sec = 30
+    scoring_timeout_sec = 30
+    scoring_timeout_per_audio_sec = 0.5
+    scoring_min_sec = 0.5
+    scoring_min_per_audio_sec = 0.05
+
+    # Admission control per scorer URL: at most scorer_max_concurrency requests
+    # are in flight (0 = unlimited), up to scorer_max_queue more wait for at
+    # most scorer_max_queue_time_sec seconds, and the rest get a 503 with
+    # Retry-After at once. scorer_limits overrides these per URL, e.g.
+    #   scorer_limits: {'wss://scorer-a': {max_concurrency: 50}}
+    scorer_max_concurrency = 0
+    scorer_max_queue = 100
+    scorer_max_queue_time_sec = 5
+    scorer_limits = {}
+    # Waiting requests go in shortest audio first: one with N seconds of
+    # audio queues as if it had arrived scorer_sjf_weight * N seconds later,
+    # so long clips age their way in rather than starve. 0 keeps the queue
+    # FIFO. No request waits holding WeChat's response: one that has to wait
+    # asks WeChat for its audio's size first (a HEAD request). Its length
+    # is then estimated from the Content-Length; without one (and in
+    # pipelined mode), it counts as the average length scored lately.
+    scorer_sjf_weight = 0.1
+
+    # Fair scheduling between tenants (set by validate_request, see
+    # OpenWeixinScorer.TENANT_KEY), on when fair_max_concurrency > 0 or tenants
+    # is set: at most fair_max_concurrency requests (0 = unlimited) are scored
+    # at a time, and waiting ones are let in by weighted fair queuing, so a
+    # tenant's burst does not hold up the others. Up to fair_max_queue
+    # requests per tenant wait, for at most fair_max_queue_time_sec seconds.
+    # Each tenant has a weight (its share when busy), a token bucket of `rate`
+    # requests per second up to `burst` (rate 0 = unlimited; beyond it, 429)
+    # and at most max_in_flight requests scored (0 = unlimited), from tenants
+    # or else tenant_defaults, e.g.
+    #   tenants: {school-a: {weight: 2, rate: 20, burst: 40, max_in_flight: 10}}
+    fair_max_concurrency = 0
+    fair_max_queue = 1000
+    fair_max_queue_time_sec = 10
+    tenant_defaults = {'weight': 1, 'rate': 0, 'burst': 0, 'max_in_flight': 0}
+    tenants = {}
+
+    # A batch request (see OpenWeixinScorer.BATCH_ENDPOINT) may hold up to
+    # batch_max_items items, of which batch_concurrency are scored at a time.
+    batch_max_items = 100
+    batch_concurrency = 8
+
+    # Jobs (see OpenWeixinScorer.JOBS_ENDPOINT) are kept for job_ttl_sec
+    # seconds, at most job_max_jobs of them. A poll waits for a result for at
+    # most job_max_wait_sec seconds. With job_spool_dir, running jobs are
+    # marked and completed results stored there, so they survive a worker
+    # restart and any worker can answer a poll. With more than one worker,
+    # set job_spool_dir to a directory they share, or route polls back to the
+    # worker that took the job; otherwise a poll may get 404. A poll reaching
+    # another worker than the job's does not wait for the result.
+    job_max_jobs = 10000
+    job_ttl_sec = 600
+    job_max_wait_sec = 25
+    job_spool_dir = ''
+
+    # Access tokens got from get_access_token are cached in memory for
+    # access_token_ttl_sec seconds (0 disables the cache) and refreshed in the
+    # background when less than access_token_refresh_ahead_sec seconds remain.
+    # WeChat tokens live for 7200 seconds; keep the TTL well below that.
+    access_token_ttl_sec = 600
+    access_token_refresh_ahead_sec = 60
+
     def __init__(self, **entries):
         self.__dict__.update(entries)
+
+# Entries that only take effect when the server is restarted, not reloaded
+RESTART_ENTRIES = ('listen_addr', 'listen_port', 'workers', 'reuse_port', 'event_loop')
+
+def load_config(path):
+    '''Read a ScorerConfig from the YAML file `path`.
+    '''
+
+    with open(path) as f:
+        data_map = yaml.safe_load(f)
+    if data_map is None:
+        return ScorerConfig()
+    if not isinstance(data_map, dict):
+        raise ValueError('%s does not hold a YAML mapping' % path)
+    return ScorerConfig(**data_map)
+
+def changed_entries(old, new):
+    '''Return the sorted names of the entries that differ between two
+    ScorerConfig objects.
+    '''
+
+    names = set(vars(old)) | set(vars(new))
+    return sorted(name for name in names
+        if getattr(old, name, None) != getattr(new, name, None))
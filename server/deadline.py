@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+# Stages that are not timed in metrics.RequestTrace
+STAGE_QUEUE = 'queue'     # waiting for the fair scheduler or admission
+STAGE_SCORING = 'scoring' # the scorer exchange, from connecting to the reply
+# Timers may fire this much before the deadline they were set for
+CLOCK_SLACK_SEC = 0.01
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    '''This exception is thrown when a stage of a request cannot be done
+    within what is left of the request's deadline. It is an
+    asyncio.TimeoutError, so it is handled as any other timeout.
+    '''
+
+    def __init__(self, stage, remaining_sec):
+        super().__init__('Deadline exceeded in stage %s (%.3gs left)' % (stage, remaining_sec))
+        self.stage = stage
+
+class Deadline(object):
+    '''Deadline is the time by which a request must be done.
+
+    Each stage asks budget() for its timeout: what is left, up to the
+    stage's own cap, keeping `need_sec` for the stages after it. A stage
+    that would get no time at all fails at once rather than load an
+    upstream for an answer nobody will wait for.
+    '''
+
+    def __init__(self, budget_sec):
+        self.budget_sec = float(budget_sec)
+        self.expires_at = time.monotonic() + self.budget_sec
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self, stage, cap_sec=None, need_sec=0):
+        '''Return the seconds `stage` may take, or raise DeadlineExceeded if
+        none are left once `need_sec` is kept for later stages.
+        '''
+
+        remaining = self.expires_at - time.monotonic()
+        budget = remaining - need_sec
+        if budget <= 0:
+            raise DeadlineExceeded(stage, max(0.0, remaining))
+        if cap_sec is not None and cap_sec > 0:
+            budget = min(budget, cap_sec)
+        return budget
+
+    def ran_out(self, need_sec=0):
+        '''Tell whether no time is left once `need_sec` is kept, i.e. whether
+        a stage given budget(..., need_sec) that just timed out was cut short
+        by the deadline rather than by its own cap.
+        '''
+
+        return self.expires_at - time.monotonic() - need_sec <= CLOCK_SLACK_SEC
+
+    def require(self, stage, min_sec):
+        '''Raise DeadlineExceeded unless `min_sec` seconds are left for
+        `stage`.
+        '''
+
+        remaining = self.remaining()
+        if remaining < min_sec:
+            raise DeadlineExceeded(stage, remaining)
+
+    async def run(self, aw, stage, cap_sec=None, need_sec=0):
+        '''Await `aw` within the budget of `stage` (see budget); raise
+        DeadlineExceeded if the deadline is what it ran out of (see cut).
+        '''
+
+        try:
+            budget = self.budget(stage, cap_sec, need_sec)
+        except DeadlineExceeded:
+            if asyncio.iscoroutine(aw):
+                aw.close()
+            raise
+        return await self.cut(asyncio.wait_for(aw, budget), stage, need_sec)
+
+    async def cut(self, aw, stage, need_sec=0):
+        '''Await `aw`, a stage whose timeout came from budget(stage, cap_sec,
+        need_sec). If it times out because the deadline left it no more
+        time, raise DeadlineExceeded. A timeout with time left (its cap, or a
+        timeout of its own) stays a plain asyncio.TimeoutError, the
+        upstream's failure.
+        '''
+
+        try:
+            return await aw
+        except DeadlineExceeded:
+            raise
+        except asyncio.TimeoutError as e:
+            if self.ran_out(need_sec):
+                raise DeadlineExceeded(stage, self.remaining()) from e
+            raise
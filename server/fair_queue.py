@@ -0,0 +1,234 @@
+import asyncio
+import collections
+import math
+import time
+
+from .admission import AdmissionRejected
+
+# Tenant of requests for which validate_request set none
+DEFAULT_TENANT = ''
+# Settings of a tenant not listed in config (see FairScheduler)
+DEFAULT_SETTINGS = {'weight': 1, 'rate': 0, 'burst': 0, 'max_in_flight': 0}
+
+class RateLimited(AdmissionRejected):
+    '''This exception is thrown when a tenant sends requests faster than its
+    rate limit allows.
+    '''
+
+def check_settings(settings):
+    for name, value in settings.items():
+        if name not in DEFAULT_SETTINGS:
+            raise ValueError('Unknown tenant setting %r (expected one of %s)' % (
+                name, ', '.join(sorted(DEFAULT_SETTINGS))))
+        if float(value) < 0 or (name == 'weight' and float(value) <= 0):
+            raise ValueError('Invalid tenant %s: %r' % (name, value))
+
+class Tenant(object):
+    '''Tenant holds the queue, token bucket and counters of one tenant.
+    '''
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.apply(settings)
+        self.tokens = self.burst
+        self.refilled_at = time.monotonic()
+        self.in_flight = 0
+        self.last_finish = 0.0
+        # [start tag, future] of each waiting request, in arrival order
+        self.waiters = collections.deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.timed_out = 0
+        self.wait_sec_max = 0.0
+
+    def apply(self, settings):
+        self.weight = float(settings['weight'])
+        self.rate = float(settings['rate'])
+        # A rate limited tenant may burst to at least one request
+        self.burst = max(1.0, float(settings['burst'] or settings['rate']))
+        self.max_in_flight = int(settings['max_in_flight'])
+
+    def take_token(self, now):
+        if self.rate <= 0:
+            return True
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        return max(1, int(math.ceil((1 - self.tokens) / self.rate)))
+
+    def eligible(self):
+        return self.max_in_flight <= 0 or self.in_flight < self.max_in_flight
+
+    def stats(self):
+        return {
+            'weight':       self.weight,
+            'in_flight':    self.in_flight,
+            'queue_depth':  len(self.waiters),
+            'admitted':     self.admitted,
+            'queued':       self.queued,
+            'rejected':     self.rejected,
+            'rate_limited': self.rate_limited,
+            'timed_out':    self.timed_out,
+            'wait_sec_max': self.wait_sec_max,
+        }
+
+class FairScheduler(object):
+    '''FairScheduler shares scoring between tenants (apps, accounts or
+    schools; see OpenWeixinScorer.TENANT_KEY).
+
+    At most `max_concurrency` requests (0 = unlimited) are let in at a time.
+    When more arrive, they wait in one FIFO queue per tenant, and a freed
+    slot goes to the tenant whose head request has the lowest start tag
+    (start-time fair queuing): each request of a tenant of weight w is
+    tagged 1/w after the previous one, but never before the tag of the
+    request last let in. A tenant bursting hundreds of requests thus only
+    queues behind itself; a quiet tenant's request goes in next.
+
+    Each tenant also has a token bucket (`rate` requests per second, up to
+    `burst`; rate 0 = unlimited; RateLimited is raised at once beyond it) and
+    at most `max_in_flight` requests let in (0 = unlimited), from `tenants`
+    or `defaults` (see DEFAULT_SETTINGS). At most `max_queue` requests of a
+    tenant wait, for at most `max_queue_time_sec` seconds; AdmissionRejected
+    is raised otherwise. How long requests waited goes to `wait_seconds` (a
+    metrics.Histogram labelled by tenant), if given.
+
+    Call `await scheduler.acquire(tenant)` before scoring and
+    `scheduler.release(tenant)` afterwards.
+    '''
+
+    def __init__(self, max_concurrency=0, max_queue=1000, max_queue_time_sec=10,
+            defaults=None, tenants=None, wait_seconds=None):
+        self._tenants = {}
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self.wait_seconds = wait_seconds
+        self.update(max_concurrency, max_queue, max_queue_time_sec, defaults, tenants)
+
+    def update(self, max_concurrency=0, max_queue=1000, max_queue_time_sec=10,
+            defaults=None, tenants=None):
+        '''Apply new settings; tenants keep their queued and running requests.
+        '''
+
+        defaults = dict(DEFAULT_SETTINGS, **(defaults or {}))
+        check_settings(defaults)
+        for settings in (tenants or {}).values():
+            check_settings(settings or {})
+        self.max_concurrency = int(max_concurrency)
+        self.max_queue = int(max_queue)
+        self.max_queue_time_sec = float(max_queue_time_sec)
+        self.defaults = defaults
+        self.tenants = {str(name): dict(settings or {}) for name, settings in (tenants or {}).items()}
+        for name, tenant in self._tenants.items():
+            tenant.apply(self.settings(name))
+        self._wake_next()
+
+    def settings(self, name):
+        settings = dict(self.defaults)
+        settings.update(self.tenants.get(name) or {})
+        return settings
+
+    def tenant(self, name):
+        try:
+            return self._tenants[name]
+        except KeyError:
+            tenant = self._tenants[name] = Tenant(name, self.settings(name))
+            return tenant
+
+    async def acquire(self, name=DEFAULT_TENANT):
+        '''Wait for a slot for tenant `name`.
+        '''
+
+        tenant = self.tenant(name)
+        now = time.monotonic()
+        if not tenant.take_token(now):
+            tenant.rate_limited += 1
+            tenant.rejected += 1
+            raise RateLimited('Tenant %r is over its rate limit (%g/s)' % (name, tenant.rate),
+                tenant.retry_after())
+        start_tag = max(self.virtual_time, tenant.last_finish)
+        # While a slot is free, every eligible waiter was let in already
+        if self._has_slot() and tenant.eligible():
+            tenant.last_finish = start_tag + 1 / tenant.weight
+            self.virtual_time = start_tag
+            self._admit(tenant, 0.0)
+            return
+        if len(tenant.waiters) >= self.max_queue:
+            tenant.rejected += 1
+            raise AdmissionRejected('Tenant %r has %d requests queued' % (
+                name, len(tenant.waiters)))
+        tenant.last_finish = start_tag + 1 / tenant.weight
+        tenant.queued += 1
+        fut = asyncio.get_event_loop().create_future()
+        waiter = [start_tag, fut]
+        tenant.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(fut, self.max_queue_time_sec)
+        except asyncio.TimeoutError:
+            self._discard(tenant, waiter)
+            tenant.rejected += 1
+            tenant.timed_out += 1
+            raise AdmissionRejected('Queued for more than %gs' % self.max_queue_time_sec)
+        except asyncio.CancelledError:
+            self._discard(tenant, waiter)
+            raise
+        # _wake_next() has already counted us in in_flight
+        self.in_flight -= 1
+        tenant.in_flight -= 1
+        self._admit(tenant, time.monotonic() - now)
+
+    def release(self, name=DEFAULT_TENANT):
+        '''Give the slot of tenant `name` back.
+        '''
+
+        tenant = self._tenants[name]
+        self.in_flight -= 1
+        tenant.in_flight -= 1
+        self._wake_next()
+
+    def stats(self):
+        return {name or 'default': tenant.stats() for name, tenant in self._tenants.items()}
+
+    def _has_slot(self):
+        return self.max_concurrency <= 0 or self.in_flight < self.max_concurrency
+
+    def _admit(self, tenant, waited):
+        self.in_flight += 1
+        tenant.in_flight += 1
+        tenant.admitted += 1
+        tenant.wait_sec_max = max(tenant.wait_sec_max, waited)
+        if self.wait_seconds is not None:
+            self.wait_seconds.observe(waited, (tenant.name or 'default',))
+
+    def _wake_next(self):
+        while self._has_slot():
+            best = None
+            for tenant in self._tenants.values():
+                if tenant.waiters and tenant.eligible() and (
+                        best is None or tenant.waiters[0][0] < best.waiters[0][0]):
+                    best = tenant
+            if best is None:
+                return
+            start_tag, fut = best.waiters.popleft()
+            if fut.done():
+                continue
+            # Hand the slot over; the waiter takes it in acquire()
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self.in_flight += 1
+            best.in_flight += 1
+            fut.set_result(None)
+
+    def _discard(self, tenant, waiter):
+        try:
+            tenant.waiters.remove(waiter)
+        except ValueError:
+            # The slot was handed over just as the wait ended
+            self.in_flight -= 1
+            tenant.in_flight -= 1
+            self._wake_next()
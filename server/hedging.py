@@ -0,0 +1,71 @@
+from . import metrics
+
+# Most hedges that may be saved up for a burst of slow requests
+MAX_BUDGET_TOKENS = 10
+# Buckets (seconds) of the scoring durations the hedge delay is derived from
+DURATION_BUCKETS = (0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 25, 30)
+
+class HedgePolicy(object):
+    '''HedgePolicy decides whether and when a scoring request is hedged,
+    i.e. sent to a second scorer when the first is slow to answer.
+
+    The delay is either fixed (`delay_sec` > 0) or the `quantile` of the
+    scoring durations observed for the question type, once `min_samples` of
+    them were seen. Hedges are limited by a budget: every request earns
+    `budget_percent` / 100 of a hedge, and a hedge spends a whole one, so at
+    most that share of requests is hedged over time.
+    '''
+
+    def __init__(self, delay_sec=0, quantile=0.95, min_samples=20, budget_percent=5):
+        self.delay_sec = float(delay_sec)
+        self.quantile = float(quantile)
+        self.min_samples = int(min_samples)
+        self.budget_ratio = float(budget_percent) / 100
+        self.tokens = 0.0
+        self.durations = metrics.Histogram('scoring_seconds', 'Scoring durations',
+            ('type',), DURATION_BUCKETS)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+        self.saturated = 0 # hedges skipped, their backend being saturated
+
+    def delay(self, question_type):
+        '''Count a request and return the seconds to wait before hedging it,
+        or None if it should not be hedged.
+        '''
+
+        self.requests += 1
+        self.tokens = min(MAX_BUDGET_TOKENS, self.tokens + self.budget_ratio)
+        if self.delay_sec > 0:
+            return self.delay_sec
+        if self.durations.count((question_type,)) < self.min_samples:
+            return None
+        return self.durations.quantile(self.quantile, (question_type,))
+
+    def try_hedge(self):
+        '''Take a hedge from the budget; return False if none is left.
+        '''
+
+        if self.tokens < 1:
+            self.budget_exhausted += 1
+            return False
+        self.tokens -= 1
+        self.hedges += 1
+        return True
+
+    def observe(self, question_type, seconds):
+        '''Record how long the first scorer of a request took to answer.
+        '''
+
+        self.durations.observe(seconds, (question_type,))
+
+    def stats(self):
+        return {
+            'requests':         self.requests,
+            'hedges':           self.hedges,
+            'hedge_wins':       self.hedge_wins,
+            'budget_exhausted': self.budget_exhausted,
+            'saturated':        self.saturated,
+            'budget_tokens':    self.tokens,
+        }
@@ -1,49 +1,502 @@
 import base64
+import hmac
 import json
 import logging
-import traceback
+import os
+import signal
+import time
 import urllib.parse as urlparse
 
 import aiohttp
 import aiohttp.web
 import asyncio
 
-from . import auth_util, cfg, url_util, lls_ws_client, wx_http_client
+from . import admission, audio_cache, auth_util, balancer, breaker, cfg, deadline, fair_queue, hedging, jobs, log_util, meta_util, metrics, profiling, recorder, result_cache, routing, url_util, lls_ws_client, token_cache, transport, workers, ws_pool, wx_http_client
 from .user.lls import get_access_token
 
 log = logging.getLogger()
 
+# `status` of the error results returned instead of a scorer response
+WEIXIN_ERROR_STATUS = -100    # WeChat refused the audio download
+BATCH_ITEM_ERROR_STATUS = -1  # any other failure of one item of a batch
+# Seconds sessions replaced by a config reload stay open for requests in flight
+RETIRE_DELAY_SEC = 60
+# errcode of WeChat's "system busy" error, also given while its circuit is open
+WX_BUSY_ERRCODE = -1
+
+def error_result(status, msg):
+    '''Return the JSON error result (status/msg/flag) sent instead of a
+    scorer response.
+    '''
+
+    return json.dumps({
+        'status': status,
+        'msg':    msg,
+        'flag':   1,
+    })
+
+class CompiledConfig(object):
+    '''CompiledConfig is a ScorerConfig with what every request needs from it
+    precomputed: the scorer route table, the audio download URL template and
+    the signing credentials.
+
+    Building one validates the config, raising ValueError if it is unusable.
+    A request keeps the CompiledConfig it started with to the end, so a
+    reload never changes config under its feet.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.routes = routing.ScorerRoutes(config)
+        self.audio_url = url_util.URLTemplate(config.audio_download_url)
+        self.credentials = auth_util.get_credentials(config)
+        balancer.check_policy(config.scorer_balancer)
+        fair_queue.check_settings(config.tenant_defaults or {})
+        for settings in (config.tenants or {}).values():
+            fair_queue.check_settings(settings or {})
+        for upstream in transport.UPSTREAMS:
+            transport.connector_options(config, upstream)
+            breaker.BreakerSet.settings(config.breaker_defaults, config.breakers, upstream)
+
 class OpenWeixinScorer(object):
     '''OpenWeixinScorer is the main server object that you can use out-of-box.
 
-    It uses aiohttp to achieve single-threaded concurrency and maintains the
-    ClientSession on its own. To extend its functionality you should create a
-    subclass and rewrite get_access_token, validate_request or rating_handler.
+    It uses aiohttp to achieve single-threaded concurrency and maintains its
+    ClientSessions (one per upstream, see server.transport) on its own. To
+    extend its functionality you should create a subclass and rewrite
+    get_access_token, validate_request or rating_handler.
     '''
 
     RETURN_CONTENT_TYPE = 'application/json'
     REQUEST_ENDPOINT    = '/api/ratings'
+    BATCH_ENDPOINT      = '/api/ratings/batch'
+    BATCH_CONTENT_TYPE  = 'application/x-ndjson'
+    JOBS_ENDPOINT       = '/api/ratings/jobs'
+    METRICS_ENDPOINT    = '/metrics'
+    ADMIN_RELOAD_ENDPOINT = '/admin/reload'
+    ADMIN_PROFILE_ENDPOINT = '/admin/profile'
+    ADMIN_TOKEN_HEADER  = 'X-Admin-Token'
+    # Key of req_dict that validate_request may set to the request's tenant
+    # (e.g. its appID or school) for fair scheduling. Clients can't set it.
+    TENANT_KEY          = '_tenant'
 
     config = cfg.ScorerConfig()
 
-    def __init__(self, new_config):
+    def __init__(self, new_config, config_file=None):
+        '''
+        Arguments:
+        new_config  -- cfg.ScorerConfig object
+        config_file -- the YAML file new_config came from, read again on reload
+        '''
+
         self.config = new_config
+        self.config_file = config_file
+        self._started = False
+        self._supervised = False
+        self._queue_logging = None
+        self.compile_config()
+
+    def compile_config(self):
+        '''Precompute what every request needs from config (see
+        CompiledConfig).
+        '''
+
+        self._compiled = CompiledConfig(self.config)
+        self._routes = self._compiled.routes
+        self._audio_url = self._compiled.audio_url
+        self._credentials = self._compiled.credentials
 
     async def on_startup(self):
-        self._session = aiohttp.ClientSession()
-        log.debug('Created client session %s' % repr(self._session))
+        self._sessions = {}
+        self._retired = []
+        self._breakers = None
+        self._token_cache = None
+        self._result_cache = None
+        self._inflight = None
+        self._audio_cache = None
+        self._admission = None
+        self._ws_pool = None
+        self._balancer = None
+        self._hedging = None
+        self._loop_lag = None
+        self._profiling = False
+        self._scheduler = None
+        self._recorder = None
+        self._jobs = jobs.JobStore(
+            self.config.job_max_jobs,
+            self.config.job_ttl_sec,
+            self.config.job_spool_dir,
+            lambda exc: error_result(BATCH_ITEM_ERROR_STATUS, 'Internal Error').encode(),
+        )
+        self._metrics = metrics.ScorerMetrics()
+        self.apply_config(None, self.config)
+        self._started = True
+        self.register_metrics(self._metrics)
 
-    def run(self):
-        asyncio.get_event_loop().run_until_complete(self.on_startup())
+    def apply_config(self, old, new):
+        '''Create, update or replace the sessions, caches, pools and limiters
+        that depend on config entries changed from `old` to `new` (all of them
+        if old is None). Whatever did not change is left alone, warm.
+        '''
+
+        def changed(*names):
+            return old is None or any(
+                getattr(old, name, None) != getattr(new, name, None) for name in names)
+
+        if hasattr(new, 'log_level') and changed('log_level'):
+            log.setLevel(new.log_level)
+
+        for upstream in transport.UPSTREAMS:
+            options = transport.connector_options(new, upstream)
+            if old is None or transport.connector_options(old, upstream) != options:
+                if upstream in self._sessions:
+                    self._retire(self._sessions[upstream].close)
+                self._sessions[upstream] = transport.make_session(options)
+        # The session for WeChat, kept under its historical name
+        self._session = self._sessions[transport.UPSTREAM_WECHAT]
+        if self._breakers is None:
+            self._breakers = breaker.BreakerSet(new.breaker_defaults, new.breakers)
+        else:
+            self._breakers.update(new.breaker_defaults, new.breakers)
+
+        if changed('token_service_jsonrpc_addr') or self._token_cache is None:
+            # Tokens from another service may be for another account
+            self._token_cache = token_cache.AccessTokenCache(
+                new.access_token_ttl_sec,
+                new.access_token_refresh_ahead_sec,
+            )
+        else:
+            self._token_cache.ttl_sec = float(new.access_token_ttl_sec)
+            self._token_cache.refresh_ahead_sec = float(new.access_token_refresh_ahead_sec)
+
+        if changed('result_cache_size', 'result_cache_max_bytes', 'result_cache_ttl_sec'):
+            self._result_cache = None
+            if int(new.result_cache_size) > 0:
+                self._result_cache = result_cache.ResultCache(
+                    new.result_cache_size,
+                    new.result_cache_max_bytes,
+                    new.result_cache_ttl_sec,
+                )
+        if changed('dedup_inflight_requests'):
+            self._inflight = None
+            if new.dedup_inflight_requests:
+                self._inflight = result_cache.InFlightRequests()
+        if changed('audio_cache_dir', 'audio_cache_max_bytes'):
+            self._audio_cache = None
+            if new.audio_cache_dir:
+                self._audio_cache = audio_cache.AudioCache(
+                    new.audio_cache_dir,
+                    new.audio_cache_max_bytes,
+                )
+
+        if int(new.scorer_max_concurrency) > 0 or new.scorer_limits:
+            limits = {
+                'max_concurrency':    new.scorer_max_concurrency,
+                'max_queue':          new.scorer_max_queue,
+                'max_queue_time_sec': new.scorer_max_queue_time_sec,
+                'sjf_weight':         new.scorer_sjf_weight,
+            }
+            if self._admission is None:
+                self._admission = admission.AdmissionController(limits, new.scorer_limits)
+            else:
+                self._admission.update(limits, new.scorer_limits)
+        else:
+            self._admission = None
+
+        if int(new.ws_pool_size) > 0:
+            if self._ws_pool is None:
+                self._ws_pool = ws_pool.WebSocketPool(
+                    lambda url: lls_ws_client.connect(self._sessions[transport.UPSTREAM_SCORER], url),
+                    self._routes.urls(),
+                    new.ws_pool_size,
+                    new.ws_pool_max_idle_sec,
+                    new.ws_pool_check_interval_sec,
+                )
+                self._ws_pool.start()
+            else:
+                self._ws_pool.update(
+                    self._routes.urls(),
+                    new.ws_pool_size,
+                    new.ws_pool_max_idle_sec,
+                    new.ws_pool_check_interval_sec,
+                )
+        elif self._ws_pool is not None:
+            self._retire(self._ws_pool.close, 0)
+            self._ws_pool = None
+
+        balancer_settings = (
+            new.scorer_balancer,
+            new.scorer_eject_after,
+            new.scorer_eject_sec,
+            new.scorer_recovery_sec,
+            new.scorer_latency_decay_sec,
+        )
+        if self._balancer is None:
+            self._balancer = balancer.LoadBalancer(*balancer_settings)
+        else:
+            self._balancer.update(*balancer_settings)
+
+        if changed('hedging', 'hedge_delay_sec', 'hedge_quantile', 'hedge_min_samples',
+                'hedge_budget_percent'):
+            self._hedging = None
+            if new.hedging:
+                self._hedging = hedging.HedgePolicy(
+                    new.hedge_delay_sec,
+                    new.hedge_quantile,
+                    new.hedge_min_samples,
+                    new.hedge_budget_percent,
+                )
+
+        if changed('loop_lag_interval_sec', 'slow_callback_sec'):
+            if self._loop_lag is not None:
+                self._loop_lag.stop()
+                self._loop_lag = None
+            if float(new.loop_lag_interval_sec) > 0:
+                self._loop_lag = profiling.LoopLagMonitor(
+                    new.loop_lag_interval_sec,
+                    new.slow_callback_sec,
+                    self._metrics.loop_lag_seconds,
+                )
+                self._loop_lag.start()
+
+        if int(new.fair_max_concurrency) > 0 or new.tenants:
+            fairness = (
+                new.fair_max_concurrency,
+                new.fair_max_queue,
+                new.fair_max_queue_time_sec,
+                new.tenant_defaults,
+                new.tenants,
+            )
+            if self._scheduler is None:
+                self._scheduler = fair_queue.FairScheduler(*fairness,
+                    wait_seconds=self._metrics.tenant_wait_seconds)
+            else:
+                self._scheduler.update(*fairness)
+        else:
+            self._scheduler = None
+
+        if changed('traffic_record_path'):
+            if self._recorder is not None:
+                # Its last records are appended in the background
+                self._recorder.flush()
+                self._recorder = None
+            if new.traffic_record_path:
+                self._recorder = recorder.TrafficRecorder(
+                    new.traffic_record_path,
+                    new.traffic_sample_percent,
+                )
+        elif self._recorder is not None:
+            self._recorder.sample_percent = float(new.traffic_sample_percent)
+
+        if self._queue_logging is not None:
+            self._queue_logging.rate_limit.burst = int(new.log_rate_burst)
+            self._queue_logging.rate_limit.period_sec = float(new.log_rate_period_sec)
+
+        self._jobs.max_jobs = int(new.job_max_jobs)
+        self._jobs.ttl_sec = float(new.job_ttl_sec)
+
+    def reload_config(self, new_config=None):
+        '''Swap in `new_config` (by default, config_file read again) and
+        return the names of the changed entries.
+
+        The new config is validated first; if it is unusable, ValueError (or
+        the error reading the file) is raised and nothing changes. Requests
+        in flight finish with the config they started with.
+        '''
+
+        if new_config is None:
+            if not self.config_file:
+                raise ValueError('No config file to reload')
+            new_config = cfg.load_config(self.config_file)
+        compiled = CompiledConfig(new_config)
+        changed = cfg.changed_entries(self.config, new_config)
+        restart = [name for name in changed if name in cfg.RESTART_ENTRIES]
+        if restart:
+            log.warning('Restart to apply %s' % ', '.join(restart))
+        old, self.config = self.config, new_config
+        self._compiled = compiled
+        self._routes = compiled.routes
+        self._audio_url = compiled.audio_url
+        self._credentials = compiled.credentials
+        if self._started:
+            self.apply_config(old, new_config)
+        log.info('Reloaded config (pid %d), changed: %s' % (
+            os.getpid(), ', '.join(changed) or 'nothing'))
+        return changed
+
+    def _retire(self, close, delay_sec=RETIRE_DELAY_SEC):
+        '''Call coroutine function `close` after `delay_sec` seconds, once
+        requests in flight are done with what it closes.
+        '''
+
+        loop = asyncio.get_event_loop()
+        handle = loop.call_later(delay_sec, lambda: asyncio.ensure_future(close()))
+        self._retired.append((handle, close))
+
+    def register_metrics(self, scorer_metrics):
+        '''Export the stats of caches, pools and limiters on /metrics.
+
+        Override this (calling original) to add metrics of your own. The stats
+        are looked up at scrape time, so components replaced by a config
+        reload are followed.
+        '''
+
+        def stats_of(name):
+            def stats():
+                component = getattr(self, name)
+                return component.stats() if component is not None else {}
+            return stats
+        scorer_metrics.add_stats('scorer_loop', 'Event loop',
+            stats_of('_loop_lag'))
+        scorer_metrics.add_stats('scorer_logging', 'Queued logging',
+            stats_of('_queue_logging'))
+        scorer_metrics.add_stats('scorer_traffic_recorder', 'Recorded traffic',
+            stats_of('_recorder'))
+        scorer_metrics.add_stats('scorer_token_cache', 'Access token cache',
+            stats_of('_token_cache'))
+        scorer_metrics.add_stats('scorer_result_cache', 'Result cache',
+            stats_of('_result_cache'))
+        scorer_metrics.add_stats('scorer_inflight', 'Coalesced identical requests',
+            stats_of('_inflight'))
+        scorer_metrics.add_stats('scorer_audio_cache', 'On-disk audio cache',
+            stats_of('_audio_cache'))
+        scorer_metrics.add_stats('scorer_circuit',
+            'Circuit breakers (state 0 closed, 1 open, 2 half open)',
+            stats_of('_breakers'), 'upstream')
+        scorer_metrics.add_stats('scorer_backend_circuit',
+            'Circuit breakers of scorer endpoints (state 0 closed, 1 open, 2 half open)',
+            lambda: self._breakers.endpoint_stats() if self._breakers is not None else {},
+            'url')
+        scorer_metrics.add_stats('scorer_backend', 'Scorer endpoints',
+            stats_of('_balancer'), 'url')
+        scorer_metrics.add_stats('scorer_hedging', 'Hedged scoring requests',
+            stats_of('_hedging'))
+        scorer_metrics.add_stats('scorer_jobs', 'Asynchronous rating jobs',
+            stats_of('_jobs'))
+        scorer_metrics.add_stats('scorer_ws_pool', 'WebSocket pool',
+            stats_of('_ws_pool'), 'url')
+        scorer_metrics.add_stats('scorer_admission', 'Admission control',
+            stats_of('_admission'), 'url')
+        scorer_metrics.add_stats('scorer_tenant', 'Fair scheduling',
+            stats_of('_scheduler'), 'tenant')
+
+    async def on_cleanup(self):
+        if self._loop_lag is not None:
+            self._loop_lag.stop()
+        if self._recorder is not None:
+            await self._recorder.close()
+        await self._jobs.close()
+        if self._audio_cache is not None:
+            await self._audio_cache.close()
+        if self._ws_pool is not None:
+            await self._ws_pool.close()
+        for handle, close in self._retired:
+            if not handle.cancelled():
+                handle.cancel()
+                await close()
+        for session in self._sessions.values():
+            await session.close()
+
+    def scorer_urls(self):
+        '''Return every scorer URL in config, without duplicates.
+        '''
+
+        return self._routes.urls()
+
+    def on_sighup(self):
+        log.info('Received SIGHUP (pid %d), reloading config' % os.getpid())
+        try:
+            self.reload_config()
+        except Exception as e:
+            log.error('Config not reloaded: %r' % e)
+
+    def make_app(self):
+        '''Create the aiohttp Application serving this scorer.
+
+        on_startup and on_cleanup run inside the application's event loop, so
+        every worker process gets its own session and caches.
+        '''
+
+        async def on_startup(app):
+            await self.on_startup()
+            if hasattr(signal, 'SIGHUP'):
+                asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self.on_sighup)
         async def on_cleanup(app):
-            await self._session.close()
+            await self.on_cleanup()
         app = aiohttp.web.Application()
+        app.on_startup.append(on_startup)
         app.on_cleanup.append(on_cleanup)
         app.router.add_post(self.REQUEST_ENDPOINT, self.rating_handler)
-        aiohttp.web.run_app(app,
-            host=self.config.listen_addr,
-            port=self.config.listen_port,
-        )
+        app.router.add_post(self.BATCH_ENDPOINT, self.batch_rating_handler)
+        app.router.add_post(self.JOBS_ENDPOINT, self.job_submit_handler)
+        app.router.add_get(self.JOBS_ENDPOINT + '/{job_id}', self.job_result_handler)
+        app.router.add_get(self.METRICS_ENDPOINT, self.metrics_handler)
+        app.router.add_post(self.ADMIN_RELOAD_ENDPOINT, self.reload_handler)
+        app.router.add_get(self.ADMIN_PROFILE_ENDPOINT, self.profile_handler)
+        return app
+
+    def run(self):
+        '''Serve until stopped.
+
+        The event loop is the one named by `event_loop` in config. With
+        `workers` > 1 (or 'auto'), a supervisor process forks that many
+        workers sharing the listen port, either through SO_REUSEPORT
+        (`reuse_port: true`, each worker binds its own socket) or through one
+        socket bound here and inherited by the workers.
+        '''
+
+        transport.install_event_loop(self.config.event_loop)
+        count = workers.resolve_worker_count(self.config.workers)
+        if count == 1 or not hasattr(os, 'fork'):
+            self.run_worker()
+            return
+        host, port = self.config.listen_addr, self.config.listen_port
+        sock = None
+        if not self.config.reuse_port:
+            sock = workers.bind_socket(host, port)
+        def target(index):
+            self._supervised = True
+            if self.config_file:
+                # A restarted worker must not bring back a config reloaded since
+                try:
+                    self.reload_config()
+                except Exception as e:
+                    log.error('Config not reloaded: %r' % e)
+            worker_sock = sock
+            if worker_sock is None:
+                worker_sock = workers.bind_socket(host, port, reuse_port=True)
+            self.run_worker(worker_sock)
+        log.info('Starting %d workers on %s:%s' % (count, host, port))
+        workers.Supervisor(target, count).run()
+
+    def run_worker(self, sock=None):
+        '''Serve on `sock`, or on listen_addr:listen_port if it is None.
+        '''
+
+        app = self.make_app()
+        options = {}
+        if self.config.access_log:
+            # Ours (see log_util.log_access) replaces aiohttp's for ratings
+            options['access_log_class'] = log_util.AccessLogger
+        if int(self.config.log_queue_size) > 0:
+            self._queue_logging = log_util.QueueLogging(
+                self.config.log_queue_size,
+                self.config.log_rate_burst,
+                self.config.log_rate_period_sec,
+            )
+            self._queue_logging.start()
+        try:
+            if sock is not None:
+                aiohttp.web.run_app(app, sock=sock, **options)
+            else:
+                aiohttp.web.run_app(app,
+                    host=self.config.listen_addr,
+                    port=self.config.listen_port,
+                    **options
+                )
+        finally:
+            if self._queue_logging is not None:
+                self._queue_logging.stop()
 
     async def get_access_token(self, req_dict):
         '''Get access token (from external service).
@@ -58,9 +511,23 @@ class OpenWeixinScorer(object):
         /api/ratings request. Keep your token highly available.
         '''
 
-        access_token = await get_access_token(self._session, self.config, req_dict)
+        access_token = await get_access_token(
+            self._sessions[transport.UPSTREAM_TOKEN], self.config, req_dict)
         return access_token
 
+    def get_access_token_key(self, req_dict):
+        '''Return the key under which the token for req_dict is cached, or
+        None to get it with get_access_token every time.
+
+        The token service is asked for one token, shared by all requests. If
+        get_access_token is overridden (e.g. for several official accounts),
+        tokens are not cached unless this is overridden too.
+        '''
+
+        if type(self).get_access_token is not OpenWeixinScorer.get_access_token:
+            return None
+        return getattr(self.config, 'token_service_jsonrpc_addr', '')
+
     async def validate_request(self, req_dict, header_dict, query_dict):
         '''Validate request and optionally alter it.
 
@@ -72,18 +539,88 @@ class OpenWeixinScorer(object):
         return req_dict
 
     async def rating_handler(self, request):
-        '''The only HTTP handler, mounted on /api/ratings by default.
+        '''The rating handler, mounted on /api/ratings by default.
 
         If you should override this (to add metrics etc.), be sure to call
         original.
         You can change the path by editing the value of REQUEST_ENDPOINT.
         '''
 
+        req_deadline = self.make_deadline(request.headers)
+        try:
+            req_dict, media_id, meta_obj = await self.parse_rating_request(request)
+        except aiohttp.web.HTTPException:
+            if self.config.access_log:
+                log_util.log_access(request, None, metrics.RequestTrace(),
+                    metrics.OUTCOME_BAD_REQUEST)
+            raise
+
+        trace = metrics.RequestTrace()
+        trace.question_type = self._routes.type_label(meta_obj.question_type)
+        trace.tenant = self.tenant_of(req_dict)
+        trace.deadline = req_deadline
+        outcome = metrics.OUTCOME_ERROR
+        try:
+            rsp = await self.get_result(req_dict, media_id, meta_obj,
+                self.is_cache_bypassed(request, req_dict), trace)
+            outcome = metrics.OUTCOME_OK
+        except fair_queue.RateLimited as rl:
+            log.warning(rl)
+            outcome = metrics.OUTCOME_REJECTED
+            raise aiohttp.web.HTTPTooManyRequests(
+                headers={'Retry-After': str(rl.retry_after)},
+                reason='Rate Limited',
+            )
+        except admission.AdmissionRejected as ar:
+            log.warning(ar)
+            outcome = metrics.OUTCOME_REJECTED
+            raise aiohttp.web.HTTPServiceUnavailable(
+                headers={'Retry-After': str(ar.retry_after)},
+                reason='Scorer Saturated',
+            )
+        except token_cache.AccessTokenError as ate:
+            outcome = metrics.OUTCOME_TOKEN_ERROR
+            raise aiohttp.web.HTTPInternalServerError(
+                body=repr(ate.__cause__),
+            )
+        except wx_http_client.WeixinResponseError as wre:
+            log.warning(wre)
+            outcome = metrics.OUTCOME_WEIXIN_ERROR
+            rsp = error_result(WEIXIN_ERROR_STATUS, str(wre))
+        except lls_ws_client.LiulishuoResponseError:
+            outcome = metrics.OUTCOME_SCORER_ERROR
+            raise
+        except deadline.DeadlineExceeded as de:
+            log.warning('%s scoring %s' % (de, media_id))
+            outcome = metrics.OUTCOME_TIMEOUT
+            raise aiohttp.web.HTTPGatewayTimeout(
+                reason='Deadline Exceeded',
+            )
+        except asyncio.TimeoutError:
+            outcome = metrics.OUTCOME_TIMEOUT
+            raise
+        finally:
+            self._metrics.observe_request(trace, outcome)
+            if self.config.access_log:
+                log_util.log_access(request, media_id, trace, outcome)
+            if self._recorder is not None and self._recorder.sample():
+                self._recorder.record(trace, len(meta_obj.encoded), outcome)
+        return aiohttp.web.Response(
+            body=rsp,
+            content_type=self.RETURN_CONTENT_TYPE,
+        )
+
+    async def parse_rating_request(self, request):
+        '''Parse and validate a single rating request; return req_dict,
+        mediaId and the decoded meta (a meta_util.Meta). Raise HTTPBadRequest
+        if the request is unusable.
+        '''
+
         json_str = await request.text()
         try:
             req_dict = json.loads(json_str)
         except json.decoder.JSONDecodeError as jde:
-            log.warning('Can\'t unmarshal request "%s": %s' % (json_str, jde))
+            log.warning('Can\'t unmarshal request "%.200s": %s' % (json_str, jde))
             raise aiohttp.web.HTTPBadRequest(
                 reason='JSON Decode Error',
             )
@@ -91,11 +628,13 @@ class OpenWeixinScorer(object):
             media_id = req_dict['mediaId']
             meta = req_dict['meta']
         except KeyError as ke:
-            log.warning('Request "%s" is missing field %s' % (json_str, ke))
+            log.warning('Request "%.200s" is missing field %s' % (json_str, ke))
             raise aiohttp.web.HTTPBadRequest(
                 reason='Missing required field(s)',
             )
 
+        # Only validate_request may tell the tenant
+        req_dict.pop(self.TENANT_KEY, None)
         try:
             req_dict = await self.validate_request(
                 req_dict,
@@ -107,59 +646,851 @@ class OpenWeixinScorer(object):
                 body=str(e),
             )
 
-        access_token = ''
+        # Decode and parse meta once; signing and routing both use the result.
         try:
-            # If accessToken is specified, use it
-            access_token = req_dict['accessToken']
-        except KeyError:
-            pass
-        if len(access_token) == 0:
+            meta_obj = meta_util.Meta.from_base64(meta)
+        except meta_util.MetaError as me:
+            log.warning(me)
+            raise aiohttp.web.HTTPBadRequest(
+                reason='Malformed meta',
+            )
+        if self._credentials is not None and meta_obj.dict is None:
+            log.warning('Meta is not a JSON object: %r' % meta_obj.text)
+            raise aiohttp.web.HTTPBadRequest(
+                reason='Malformed meta',
+            )
+        return req_dict, media_id, meta_obj
+
+    async def batch_rating_handler(self, request):
+        '''Score several recordings in one request, mounted on
+        /api/ratings/batch by default (see BATCH_ENDPOINT).
+
+        The body is a JSON object whose `items` list holds {mediaId, meta}
+        objects; other fields (e.g. accessToken, noCache) apply to every item.
+        validate_request sees the whole body once. The access token is fetched
+        once, then up to `batch_concurrency` items are scored at a time.
+
+        Results are streamed as newline-delimited JSON, one line per item in
+        the order they finish: {"index": i, "mediaId": ..., "result": ...},
+        where result is the scorer response or a status/msg/flag error like
+        the one rating_handler returns for WeChat errors.
+        '''
+
+        req_deadline = self.make_deadline(request.headers)
+        json_str = await request.text()
+        try:
+            batch_dict = json.loads(json_str)
+            items = batch_dict['items']
+        except json.decoder.JSONDecodeError as jde:
+            log.warning('Can\'t unmarshal batch request: %s' % jde)
+            raise aiohttp.web.HTTPBadRequest(
+                reason='JSON Decode Error',
+            )
+        except (KeyError, TypeError):
+            raise aiohttp.web.HTTPBadRequest(
+                reason='Missing required field(s)',
+            )
+        if not isinstance(items, list):
+            raise aiohttp.web.HTTPBadRequest(
+                reason='Missing required field(s)',
+            )
+        if len(items) > int(self.config.batch_max_items):
+            raise aiohttp.web.HTTPRequestEntityTooLarge(
+                int(self.config.batch_max_items), len(items),
+            )
+
+        batch_dict.pop(self.TENANT_KEY, None)
+        try:
+            batch_dict = await self.validate_request(
+                batch_dict,
+                request.headers,
+                request.query,
+            )
+        except Exception as e:
+            raise aiohttp.web.HTTPBadRequest(
+                body=str(e),
+            )
+
+        shared = {k: v for k, v in batch_dict.items() if k != 'items'}
+        if not shared.get('accessToken'):
+            # One token for the whole batch; the items then find it in the
+            # token cache (or get it directly if that cache is disabled).
+            token_key = self.get_access_token_key(shared)
             try:
-                access_token = await self.get_access_token(req_dict)
-            except Exception as e:
-                log.warning('Unable to get access token')
-                traceback.print_tb(e.__traceback__)
+                access_token = await self._fetch_access_token(shared, token_key)
+            except token_cache.AccessTokenError as ate:
                 raise aiohttp.web.HTTPInternalServerError(
-                    body=repr(e),
+                    body=repr(ate.__cause__),
                 )
+            if token_key is None or self._token_cache.ttl_sec <= 0:
+                shared['accessToken'] = access_token
+        bypass_cache = self.is_cache_bypassed(request, shared)
 
-        # Sign request if credentials are set in config.
-        # TODO: catch exceptions and return 400 (will be 500 if not done)
-        meta_signed = auth_util.get_signed_request(self.config, base64.b64decode(meta).decode())
-        log.debug(meta_signed)
-        meta = base64.b64encode(meta_signed.encode()).decode()
-
-        audio_link = self.calculateURL(media_id, access_token)
-        try:
-            # Receive from WeChat, convert to LLS format, and send to scoring
-            # service - all done in parallel.
-            rsp = await lls_ws_client.get_score(
-                self._session,
-                lls_ws_client.provide_scorer_url(self.config, meta),
-                meta,
-                wx_http_client.download_audio(self._session, audio_link),
-            )
-            return aiohttp.web.Response(
-                body=rsp,
-                content_type=self.RETURN_CONTENT_TYPE,
-            )
+        rsp = aiohttp.web.StreamResponse(
+            headers={'Content-Type': self.BATCH_CONTENT_TYPE},
+        )
+        await rsp.prepare(request)
+        semaphore = asyncio.Semaphore(max(1, int(self.config.batch_concurrency)))
+        async def score_item(index, item):
+            async with semaphore:
+                return index, await self.score_item(shared, item, bypass_cache, req_deadline)
+        futs = [asyncio.ensure_future(score_item(i, item)) for i, item in enumerate(items)]
+        try:
+            for fut in asyncio.as_completed(futs):
+                index, result = await fut
+                media_id = items[index].get('mediaId') if isinstance(items[index], dict) else None
+                await rsp.write(_batch_line(index, media_id, result))
+        finally:
+            # The client went away: stop scoring what it won't read
+            for fut in futs:
+                fut.cancel()
+        await rsp.write_eof()
+        return rsp
+
+    async def score_item(self, shared, item, bypass_cache=False, req_deadline=None):
+        '''Score one item of a batch (or a job) and return its result as
+        bytes: the scorer response, or a status/msg/flag error. The item must
+        be done by `req_deadline` (a deadline.Deadline), or by the configured
+        deadline from now if None.
+        '''
+
+        try:
+            req_dict = dict(shared)
+            req_dict.update(item)
+            # The tenant is the batch's (or job's), never an item's
+            req_dict.pop(self.TENANT_KEY, None)
+            if self.TENANT_KEY in shared:
+                req_dict[self.TENANT_KEY] = shared[self.TENANT_KEY]
+            media_id = req_dict['mediaId']
+            meta_obj = meta_util.Meta.from_base64(req_dict['meta'])
+        except (TypeError, ValueError, KeyError):
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Missing required field(s)').encode()
+        except meta_util.MetaError as me:
+            log.warning(me)
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Malformed meta').encode()
+        if self._credentials is not None and meta_obj.dict is None:
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Malformed meta').encode()
+
+        trace = metrics.RequestTrace()
+        trace.question_type = self._routes.type_label(meta_obj.question_type)
+        trace.tenant = self.tenant_of(req_dict)
+        trace.deadline = req_deadline or self.make_deadline()
+        outcome = metrics.OUTCOME_ERROR
+        try:
+            rsp = await self.get_result(req_dict, media_id, meta_obj, bypass_cache, trace)
+            outcome = metrics.OUTCOME_OK
+            return bytes(rsp)
         except wx_http_client.WeixinResponseError as wre:
             log.warning(wre)
-            rsp = json.dumps({
-                'status': -100,
-                'msg':    str(wre),
-                'flag':   1,
-            })
-            return aiohttp.web.Response(
-                body=rsp,
-                content_type=self.RETURN_CONTENT_TYPE,
+            outcome = metrics.OUTCOME_WEIXIN_ERROR
+            return error_result(WEIXIN_ERROR_STATUS, str(wre)).encode()
+        except fair_queue.RateLimited as rl:
+            log.warning(rl)
+            outcome = metrics.OUTCOME_REJECTED
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Rate Limited').encode()
+        except admission.AdmissionRejected as ar:
+            log.warning(ar)
+            outcome = metrics.OUTCOME_REJECTED
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Scorer Saturated').encode()
+        except token_cache.AccessTokenError as ate:
+            outcome = metrics.OUTCOME_TOKEN_ERROR
+            return error_result(BATCH_ITEM_ERROR_STATUS, repr(ate.__cause__)).encode()
+        except lls_ws_client.LiulishuoResponseError as lre:
+            log.warning(lre)
+            outcome = metrics.OUTCOME_SCORER_ERROR
+            return error_result(BATCH_ITEM_ERROR_STATUS, str(lre)).encode()
+        except deadline.DeadlineExceeded as de:
+            log.warning('%s scoring %s' % (de, media_id))
+            outcome = metrics.OUTCOME_TIMEOUT
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Deadline Exceeded').encode()
+        except asyncio.TimeoutError:
+            log.warning('Timed out scoring %s' % media_id)
+            outcome = metrics.OUTCOME_TIMEOUT
+            return error_result(BATCH_ITEM_ERROR_STATUS, 'Timeout').encode()
+        except aiohttp.ClientError as ce:
+            log.warning('Unable to score %s: %r' % (media_id, ce))
+            return error_result(BATCH_ITEM_ERROR_STATUS, repr(ce)).encode()
+        finally:
+            self._metrics.observe_request(trace, outcome)
+
+    async def job_submit_handler(self, request):
+        '''Start scoring in the background, mounted on /api/ratings/jobs by
+        default (see JOBS_ENDPOINT).
+
+        The body is the same as for rating_handler, and is validated before
+        the job starts. Respond 202 with {"jobId": ...} at once, or 503 if the
+        job store is full of running jobs.
+        '''
+
+        req_dict, _, _ = await self.parse_rating_request(request)
+        bypass_cache = self.is_cache_bypassed(request, req_dict)
+        try:
+            job = self._jobs.submit(lambda: self.score_item(req_dict, {}, bypass_cache))
+        except jobs.JobStoreFull as jsf:
+            log.warning(jsf)
+            raise aiohttp.web.HTTPServiceUnavailable(
+                headers={'Retry-After': '1'},
+                reason='Too Many Jobs',
+            )
+        return aiohttp.web.json_response({'jobId': job.id}, status=202)
+
+    async def job_result_handler(self, request):
+        '''Return the result of a job, mounted on /api/ratings/jobs/{job_id}.
+
+        With `?wait=N`, wait up to N seconds (at most job_max_wait_sec) for
+        the job to finish. A finished job gets the same body rating_handler
+        would have returned; one still running gets 202 with
+        {"jobId": ..., "state": "pending"}; an unknown or expired one 404. A
+        job that failed unexpectedly is done with an "Internal Error" result.
+        With more than one worker, polls may reach another worker than the
+        job's: set job_spool_dir (see ScorerConfig).
+        '''
+
+        job = await self._jobs.get(request.match_info['job_id'])
+        if job is None:
+            raise aiohttp.web.HTTPNotFound(reason='No Such Job')
+        try:
+            wait = float(request.query.get('wait', 0))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(reason='Invalid wait')
+        await self._jobs.wait(job, min(wait, float(self.config.job_max_wait_sec)))
+        if not job.done:
+            return aiohttp.web.json_response(
+                {'jobId': job.id, 'state': 'pending'},
+                status=202,
+            )
+        return aiohttp.web.Response(
+            body=job.result,
+            content_type=self.RETURN_CONTENT_TYPE,
+        )
+
+    async def metrics_handler(self, request):
+        '''Serve metrics in the Prometheus text format, mounted on /metrics by
+        default (see METRICS_ENDPOINT).
+        '''
+
+        return aiohttp.web.Response(
+            body=self._metrics.render().encode(),
+            headers={'Content-Type': metrics.CONTENT_TYPE},
+        )
+
+    async def reload_handler(self, request):
+        '''Reload config, mounted on /admin/reload (see ADMIN_RELOAD_ENDPOINT).
+
+        Only served when `admin_token` is set in config and the request
+        carries it in the X-Admin-Token header. Answer the changed entries as
+        JSON, or 400 with the error if the new config is unusable. With worker
+        processes, the config is validated here and the supervisor is then
+        sent SIGHUP, so that every worker reloads it.
+        '''
+
+        self.check_admin(request)
+        try:
+            if not self._supervised:
+                changed = self.reload_config()
+            else:
+                new_config = cfg.load_config(self.config_file)
+                CompiledConfig(new_config)
+                changed = cfg.changed_entries(self.config, new_config)
+                os.kill(os.getppid(), signal.SIGHUP)
+        except Exception as e:
+            log.warning('Config not reloaded: %r' % e)
+            raise aiohttp.web.HTTPBadRequest(body=str(e))
+        return aiohttp.web.Response(
+            body=json.dumps({'changed': changed}),
+            content_type=self.RETURN_CONTENT_TYPE,
+        )
+
+    async def profile_handler(self, request):
+        '''Profile this process, mounted on /admin/profile (see
+        ADMIN_PROFILE_ENDPOINT); admin token needed as for reload_handler.
+
+        The event loop is sampled for `seconds` (query, default 5, at most
+        profile_max_sec) and the answer is JSON with the samples as
+        collapsed stacks and the `top` (default profile_memory_top) source
+        lines that allocated the most memory meanwhile (see
+        profiling.profile). With `format=collapsed`, only the stacks are
+        sent, as text for flamegraph.pl or speedscope. One profile at a time.
+        '''
+
+        self.check_admin(request)
+        try:
+            seconds = float(request.query.get('seconds', 5))
+            top = int(request.query.get('top', self.config.profile_memory_top))
+        except ValueError:
+            raise aiohttp.web.HTTPBadRequest(reason='Invalid seconds or top')
+        seconds = max(0.0, min(seconds, float(self.config.profile_max_sec)))
+        if self._profiling:
+            raise aiohttp.web.HTTPConflict(reason='Already profiling')
+        self._profiling = True
+        try:
+            result = await profiling.profile(seconds,
+                float(self.config.profile_interval_sec), top)
+        finally:
+            self._profiling = False
+        if request.query.get('format') == 'collapsed':
+            return aiohttp.web.Response(text=result['collapsed'])
+        return aiohttp.web.Response(
+            body=json.dumps(result),
+            content_type=self.RETURN_CONTENT_TYPE,
+        )
+
+    def check_admin(self, request):
+        '''Raise HTTPNotFound unless admin endpoints are enabled, and
+        HTTPForbidden unless the request carries the admin token.
+        '''
+
+        token = self.config.admin_token
+        if not token:
+            raise aiohttp.web.HTTPNotFound()
+        if not hmac.compare_digest(request.headers.get(self.ADMIN_TOKEN_HEADER, ''), token):
+            raise aiohttp.web.HTTPForbidden()
+
+    def tenant_of(self, req_dict):
+        '''Return the tenant validate_request set for a request (see
+        TENANT_KEY), or None.
+        '''
+
+        tenant = req_dict.get(self.TENANT_KEY)
+        return None if tenant is None else str(tenant)
+
+    def make_deadline(self, headers=None):
+        '''Return the deadline.Deadline of a request starting now: in
+        request_deadline_sec seconds, or sooner if `headers` hold an earlier
+        one (see deadline_header). Return None if there is none.
+        '''
+
+        budget_sec = float(self.config.request_deadline_sec)
+        header = self.config.deadline_header
+        value = headers.get(header) if headers is not None and header else None
+        if value is not None:
+            try:
+                client_sec = int(value) / 1000
+                if client_sec <= 0:
+                    raise ValueError(value)
+            except ValueError:
+                raise aiohttp.web.HTTPBadRequest(
+                    reason='Invalid %s' % header,
+                )
+            budget_sec = client_sec if budget_sec <= 0 else min(budget_sec, client_sec)
+        if budget_sec <= 0:
+            return None
+        return deadline.Deadline(budget_sec)
+
+    def is_cache_bypassed(self, request, req_dict):
+        '''Tell whether a request asks for fresh scoring, with `noCache: true`
+        in its body or `Cache-Control: no-cache` in its headers.
+        '''
+
+        if req_dict.get('noCache'):
+            return True
+        return 'no-cache' in request.headers.get('Cache-Control', '')
+
+    async def get_result(self, req_dict, media_id, meta_obj, bypass_cache=False, trace=None):
+        '''Return the scorer response for a request, preferably from the
+        result cache or from an identical request already being scored.
+
+        Requests are identical when mediaId and meta (without the salt and
+        hash) match. With bypass_cache, the request is always scored on its own
+        and its result replaces the cached one. Stage timings go to `trace`
+        (a metrics.RequestTrace), if given, whose deadline bounds the wait.
+        '''
+
+        key = result_cache.request_key(media_id, meta_obj)
+        if not bypass_cache and self._result_cache is not None:
+            rsp = self._result_cache.get(key)
+            if rsp is not None:
+                return rsp
+        score = lambda: self.score(req_dict, media_id, meta_obj, trace)
+        if bypass_cache or self._inflight is None:
+            rsp = await score()
+        else:
+            # A shared scoring runs to the deadline of the caller that started
+            # it, so only callers with no later deadline join it; each waits
+            # for it until its own.
+            req_deadline = trace and trace.deadline
+            rsp = await _within(req_deadline, self._inflight.run(key, score,
+                req_deadline and req_deadline.expires_at), deadline.STAGE_SCORING)
+        if self._result_cache is not None and result_cache.is_success(rsp):
+            self._result_cache.put(key, rsp)
+        return rsp
+
+    async def score(self, req_dict, media_id, meta_obj, trace=None):
+        '''Sign meta and stream the audio to the scoring service, from the local
+        audio cache if it is there, otherwise from WeChat (getting the access
+        token first). Return the scorer response.
+
+        Raise admission.AdmissionRejected if the scorer is saturated (or the
+        tenant's queue is full), fair_queue.RateLimited if the tenant is over
+        its rate limit, token_cache.AccessTokenError if no token can be had,
+        or wx_http_client.WeixinResponseError if WeChat refuses the download.
+        Raise deadline.DeadlineExceeded if a stage cannot be done before the
+        deadline of `trace`.
+        '''
+
+        scheduler = self._scheduler
+        if scheduler is None:
+            return await self._sign_and_score(req_dict, media_id, meta_obj, trace)
+        tenant = self.tenant_of(req_dict) or fair_queue.DEFAULT_TENANT
+        await _within(trace and trace.deadline, scheduler.acquire(tenant),
+            deadline.STAGE_QUEUE, need_sec=_scoring_need(self.config, None))
+        try:
+            return await self._sign_and_score(req_dict, media_id, meta_obj, trace)
+        finally:
+            scheduler.release(tenant)
+
+    async def _sign_and_score(self, req_dict, media_id, meta_obj, trace=None):
+        compiled = self._compiled
+        # Sign request if credentials are set in config.
+        meta = meta_obj.encoded
+        if compiled.credentials is not None:
+            meta_signed = auth_util.sign_meta_dict(
+                compiled.credentials[0], compiled.credentials[1], meta_obj.dict)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(meta_signed)
+            meta = base64.b64encode(meta_signed.encode()).decode()
+        question_type = meta_obj.question_type
+        lease = self._balancer.pick(compiled.routes.endpoints_for(question_type))
+        try:
+            return await self._score(req_dict, media_id, meta, lease, trace, question_type,
+                compiled)
+        finally:
+            # No-op unless the scorer was never reached (or WeChat failed)
+            lease.finish()
+
+    async def _score(self, req_dict, media_id, meta, lease, trace=None, question_type='',
+            compiled=None):
+        compiled = compiled or self._compiled
+        config = compiled.config
+        # The scorer admits requests shortest audio first (see _admit); no
+        # request waits holding a WeChat response.
+        limiter = None
+        if self._admission is not None:
+            limiter = self._admission.limiter(lease.url)
+        # Every stage before scoring keeps the least time scoring needs
+        req_deadline = trace and trace.deadline
+        need_sec = _scoring_need(config, None)
+        admitted = None
+        ws_fut = None
+        stream, prefetcher = None, None
+        try:
+            # Audio already in the local cache needs no access token.
+            if self._audio_cache is not None:
+                audio = await self._audio_cache.open(media_id)
+                if audio is not None:
+                    duration = wx_http_client.estimate_duration(
+                        self._audio_cache.size(media_id), framed=True)
+                    if trace is not None:
+                        trace.audio_sec = duration
+                    if limiter is not None:
+                        admitted = await _within(req_deadline, limiter.acquire(duration),
+                            deadline.STAGE_QUEUE, need_sec=_scoring_need(config, duration))
+                    return await self._get_score(lease, meta, audio, trace, question_type,
+                        compiled=compiled)
+
+            # In pipelined mode the scorer handshake runs while the token is
+            # got and WeChat answers; the socket is only used once WeChat's
+            # response turned out fine. It is admitted before the handshake,
+            # not knowing the audio's length yet.
+            if config.pipelined:
+                if limiter is not None:
+                    admitted = await _within(req_deadline, limiter.acquire(),
+                        deadline.STAGE_QUEUE, need_sec=need_sec)
+                ws_fut = asyncio.ensure_future(_cut(req_deadline, lls_ws_client.open_socket(
+                    self._sessions[transport.UPSTREAM_SCORER], lease.url, self._ws_pool, trace,
+                    _stage_timeout(req_deadline, metrics.STAGE_WS_CONNECT,
+                        config.ws_connect_timeout_sec, need_sec)),
+                    metrics.STAGE_WS_CONNECT, need_sec))
+
+            access_token = ''
+            try:
+                # If accessToken is specified, use it
+                access_token = req_dict['accessToken']
+            except KeyError:
+                pass
+            token_key = None
+            fetched = len(access_token) == 0
+            if fetched:
+                token_key = self.get_access_token_key(req_dict)
+                access_token = await self._fetch_access_token(req_dict, token_key, trace)
+            if limiter is not None and admitted is None:
+                admitted = await self._admit(limiter,
+                    self.calculateURL(media_id, access_token, compiled.audio_url),
+                    compiled, req_deadline)
+
+            retried = False
+            while True:
+                audio_link = self.calculateURL(media_id, access_token, compiled.audio_url)
+                try:
+                    # Receive from WeChat, convert to LLS format, and send to
+                    # scoring service - all done in parallel.
+                    stream = await self._call_upstream(transport.UPSTREAM_WECHAT,
+                        wx_http_client.open_audio(self._session, audio_link,
+                            trace=trace, timeout=_stage_timeout(req_deadline,
+                                metrics.STAGE_WX_DOWNLOAD, config.wechat_timeout_sec, need_sec)),
+                        _is_weixin_failure, req_deadline, metrics.STAGE_WX_DOWNLOAD, need_sec)
+                    break
+                except breaker.CircuitOpen as co:
+                    # Answered the way WeChat answers when it is busy
+                    raise wx_http_client.WeixinResponseError(
+                        json.dumps({'errcode': WX_BUSY_ERRCODE, 'errmsg': str(co)}),
+                        503, 'application/json') from co
+                except wx_http_client.WeixinResponseError as wre:
+                    if (not fetched or retried or
+                        wre.errcode not in token_cache.WX_INVALID_TOKEN_ERRCODES):
+                        raise
+                    # Our cached token was rejected: drop it and try once more
+                    # with a fresh one.
+                    log.info('WeChat rejected access token (errcode %d), retrying' % wre.errcode)
+                    if token_key is not None:
+                        self._token_cache.invalidate(token_key, access_token)
+                    access_token = await self._fetch_access_token(req_dict, token_key, trace)
+                    retried = True
+
+            if trace is not None:
+                trace.audio_sec = stream.duration_sec
+                trace.audio_bytes = stream.size
+            audio = stream
+            if ws_fut is not None:
+                # Frames arriving before the handshake is done wait here
+                audio = prefetcher = wx_http_client.Prefetcher(stream,
+                    config.pipeline_queue_chunks)
+            if self._audio_cache is not None:
+                audio = self._audio_cache.tee(media_id, audio)
+            ws_fut, pending_ws = None, ws_fut
+            return await self._get_score(lease, meta, audio, trace, question_type,
+                pending_ws, compiled)
+        finally:
+            if ws_fut is not None:
+                _discard_socket(ws_fut)
+            if prefetcher is not None:
+                prefetcher.close()
+            if stream is not None:
+                await stream.close()
+            if admitted is not None:
+                limiter.release(admitted, trace and trace.audio_sec)
+
+    async def _admit(self, limiter, audio_link, compiled, req_deadline=None):
+        '''Take a slot of the scorer's `limiter` for the audio at `audio_link`
+        and return the time it was granted (see admission.BackendLimiter).
+
+        A request that has to queue first asks WeChat for the size of the
+        audio (a HEAD request, no body), so that it queues by the length of
+        its audio; if WeChat does not tell, as the average length.
+        '''
+
+        config = compiled.config
+        started = limiter.try_acquire()
+        if started is not None:
+            return started
+        duration = None
+        if limiter.sjf_weight > 0 and limiter.queue_depth < limiter.max_queue:
+            try:
+                size = await wx_http_client.probe_size(self._session, audio_link,
+                    _stage_timeout(req_deadline, deadline.STAGE_QUEUE,
+                        config.wechat_timeout_sec, _scoring_need(config, None)))
+                duration = wx_http_client.estimate_duration(size)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.debug('Unable to get the audio size from WeChat: %r' % e)
+        return await _within(req_deadline, limiter.acquire(duration),
+            deadline.STAGE_QUEUE, need_sec=_scoring_need(config, duration))
+
+    async def _get_score(self, lease, meta, audio, trace=None, question_type='', ws_fut=None,
+            compiled=None):
+        compiled = compiled or self._compiled
+        hedging = self._hedging
+        if hedging is None:
+            return await self._get_score_from(lease, meta, audio, trace, ws_fut, compiled)
+        # Durations are kept per type label, like metrics
+        type_label = compiled.routes.type_label(question_type)
+        delay = hedging.delay(type_label)
+        if delay is None:
+            started = time.monotonic()
+            rsp = await self._get_score_from(lease, meta, audio, trace, ws_fut, compiled)
+            hedging.observe(type_label, time.monotonic() - started)
+            return rsp
+
+        # Keep the audio so that it can be sent again to a second scorer.
+        buffered = lls_ws_client.BufferedAudio(audio)
+        started = time.monotonic()
+        primary = asyncio.ensure_future(
+            self._get_score_from(lease, meta, buffered.reader(), trace, ws_fut, compiled))
+        hedge, hedge_lease = None, None
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if not done:
+                endpoints = compiled.routes.endpoints_for(question_type)
+                others = [url for url in endpoints if url != lease.url] or endpoints
+                hedge_lease = self._balancer.pick(others)
+                # A hedge never waits for its backend's admission (see
+                # admission.BackendLimiter): it is skipped if that is full.
+                hedge_limiter, hedge_admitted = None, None
+                if self._admission is not None:
+                    hedge_limiter = self._admission.limiter(hedge_lease.url)
+                    hedge_admitted = hedge_limiter.try_acquire()
+                if hedge_limiter is not None and hedge_admitted is None:
+                    hedging.saturated += 1
+                    hedge_lease.finish()
+                    hedge_lease = None
+                elif not hedging.try_hedge():
+                    if hedge_limiter is not None:
+                        hedge_limiter.release()
+                    hedge_lease.finish()
+                    hedge_lease = None
+                else:
+                    log.info('No answer from %s after %.3gs, hedging to %s' % (
+                        lease.url, delay, hedge_lease.url))
+                    # The hedge is not traced, but it has the same time left
+                    hedge = asyncio.ensure_future(
+                        self._get_score_from(hedge_lease, meta, buffered.reader(),
+                            compiled=compiled, req_deadline=trace and trace.deadline,
+                            audio_sec=trace and trace.audio_sec))
+                    if hedge_limiter is not None:
+                        # Released once the hedge is over, even cancelled
+                        hedge.add_done_callback(lambda fut, limiter=hedge_limiter,
+                            started=hedge_admitted: limiter.release(started))
+            pending = set(fut for fut in (primary, hedge) if fut is not None)
+            while True:
+                done, pending = await asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if fut.exception() is None:
+                        if fut is hedge:
+                            hedging.hedge_wins += 1
+                        else:
+                            hedging.observe(type_label, time.monotonic() - started)
+                        return fut.result()
+                if not pending:
+                    # Both failed; the first scorer's error is the one to report
+                    return primary.result()
+        finally:
+            # The loser (or both, if we are cancelled) is not needed anymore
+            primary.cancel()
+            if hedge is not None:
+                hedge.cancel()
+                hedge_lease.finish()
+
+    async def _get_score_from(self, lease, meta, audio, trace=None, ws_fut=None, compiled=None,
+            req_deadline=None, audio_sec=None):
+        config = (compiled or self._compiled).config
+        if trace is not None:
+            req_deadline, audio_sec = trace.deadline, trace.audio_sec
+        # Scoring gets time in proportion to the audio, and is not started
+        # at all when it cannot be done in time.
+        # Nor when the circuit of this scorer endpoint is open.
+        scorer_breaker = self._breakers.endpoint(transport.UPSTREAM_SCORER, lease.url)
+        try:
+            if req_deadline is not None:
+                req_deadline.require(deadline.STAGE_SCORING, _scoring_need(config, audio_sec))
+            scorer_breaker.allow()
+        except (deadline.DeadlineExceeded, breaker.CircuitOpen) as e:
+            if ws_fut is not None:
+                _discard_socket(ws_fut)
+            if isinstance(e, breaker.CircuitOpen):
+                raise lls_ws_client.LiulishuoResponseError(str(e)) from e
+            raise
+        # Failures of the audio source are WeChat's (or the cache's), not the
+        # scorer's, and must not count against the backend.
+        source = _AudioSource(audio)
+        started = time.monotonic()
+        async def exchange():
+            ws = None
+            if ws_fut is not None:
+                ws = await ws_fut
+            return await lls_ws_client.get_score(
+                self._sessions[transport.UPSTREAM_SCORER],
+                lease.url,
+                meta,
+                source,
+                config.ws_coalesce_bytes,
+                config.ws_coalesce_window_sec,
+                self._ws_pool,
+                trace,
+                ws,
+                _stage_timeout(req_deadline, metrics.STAGE_WS_CONNECT,
+                    config.ws_connect_timeout_sec),
             )
+        try:
+            rsp = await _within(req_deadline, exchange(), deadline.STAGE_SCORING,
+                _scoring_timeout(config, audio_sec))
+        except deadline.DeadlineExceeded:
+            # Cut short by the request's deadline, not the scorer's fault
+            scorer_breaker.skip()
+            if ws_fut is not None:
+                _discard_socket(ws_fut)
+            raise
+        except (lls_ws_client.LiulishuoResponseError, aiohttp.ClientError,
+                asyncio.TimeoutError) as e:
+            if source.failed:
+                scorer_breaker.skip()
+            else:
+                scorer_breaker.failure(isinstance(e, asyncio.TimeoutError))
+                lease.finish(failed=True)
+            raise
+        except BaseException:
+            scorer_breaker.skip()
+            raise
+        scorer_breaker.success()
+        lease.finish(time.monotonic() - started)
+        return rsp
 
-    def calculateURL(self, media_id, access_token):
+    async def _call_upstream(self, upstream, aw, is_failure=None, req_deadline=None,
+            stage=None, need_sec=0):
+        '''Await `aw`, a call to `upstream`, through its circuit breaker.
+        Raise breaker.CircuitOpen if the circuit is open. An error of the call
+        counts against the upstream if is_failure(error) is true (always if
+        is_failure is None); timeouts always do, unless the request's own
+        deadline cut the call short. If the timeout of `aw` is the one of
+        `stage` (see _stage_timeout), pass `req_deadline` to tell the two
+        apart.
+        '''
+
+        upstream_breaker = self._breakers[upstream]
+        try:
+            upstream_breaker.allow()
+        except breaker.CircuitOpen:
+            aw.close()
+            raise
+        try:
+            result = await _cut(req_deadline, aw, stage, need_sec)
+        except deadline.DeadlineExceeded:
+            upstream_breaker.skip()
+            raise
+        except asyncio.TimeoutError:
+            upstream_breaker.failure(timeout=True)
+            raise
+        except asyncio.CancelledError:
+            upstream_breaker.skip()
+            raise
+        except Exception as e:
+            if is_failure is None or is_failure(e):
+                upstream_breaker.failure()
+            else:
+                upstream_breaker.success()
+            raise
+        upstream_breaker.success()
+        return result
+
+    async def _fetch_access_token(self, req_dict, token_key, trace=None):
+        started = time.monotonic()
+        try:
+            fetch = lambda: self._call_upstream(transport.UPSTREAM_TOKEN,
+                self.get_access_token(req_dict))
+            return await _within(trace and trace.deadline,
+                fetch() if token_key is None else self._token_cache.get(fetch, token_key),
+                metrics.STAGE_TOKEN, need_sec=_scoring_need(self.config, None))
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception as e:
+            # The traceback is formatted by the logging thread, if queued
+            log.warning('Unable to get access token: %r' % e, exc_info=e)
+            raise token_cache.AccessTokenError(repr(e)) from e
+        finally:
+            if trace is not None:
+                trace.mark(metrics.STAGE_TOKEN, time.monotonic() - started)
+
+    def calculateURL(self, media_id, access_token, audio_url=None):
         '''Return link to the wanted audio from the above arguments.
 
-        The domain & path part of URL is declared in `self.config`.
+        The domain & path part of URL is declared in `self.config` (or given
+        as the URLTemplate `audio_url`).
         '''
 
         query = {'access_token': access_token, 'media_id': media_id}
-        return url_util.add_url_params(self.config.audio_download_url, query)
+        return (audio_url or self._audio_url).build(query)
+
+def _batch_line(index, media_id, result):
+    '''Return the NDJSON line of a batch item. The result is re-serialized,
+    so that the line is always one line of valid JSON; a result that is not
+    JSON is replaced by an error.
+    '''
+
+    try:
+        result = json.loads(result)
+    except ValueError:
+        log.warning('Malformed scorer response for batch item %d: %r' % (index, result[:100]))
+        result = json.loads(error_result(BATCH_ITEM_ERROR_STATUS, 'Malformed scorer response'))
+    line = json.dumps({'index': index, 'mediaId': media_id, 'result': result},
+        ensure_ascii=False, separators=(',', ':'))
+    return (line + '\n').encode()
+
+def _is_weixin_failure(error):
+    '''Tell whether an error of a WeChat download is WeChat's failure, not
+    an answer (such as an invalid media_id).
+    '''
+
+    if isinstance(error, wx_http_client.WeixinResponseError):
+        return error.status >= 500 or error.errcode == WX_BUSY_ERRCODE
+    return isinstance(error, aiohttp.ClientError)
+
+def _scoring_need(config, audio_sec):
+    '''Return the least seconds scoring `audio_sec` seconds of audio (None if
+    unknown) takes.
+    '''
+
+    return config.scoring_min_sec + config.scoring_min_per_audio_sec * (audio_sec or 0)
+
+def _scoring_timeout(config, audio_sec):
+    '''Return the most seconds scoring `audio_sec` seconds of audio (None if
+    unknown) may take.
+    '''
+
+    if audio_sec is None:
+        return lls_ws_client.SCORING_TIMEOUT_SEC
+    return config.scoring_timeout_sec + config.scoring_timeout_per_audio_sec * audio_sec
+
+def _stage_timeout(req_deadline, stage, cap_sec, need_sec=0):
+    '''Return the timeout of `stage`: `cap_sec`, or less if `req_deadline`
+    (a deadline.Deadline, or None) is sooner (see Deadline.budget).
+    '''
+
+    if req_deadline is None:
+        return cap_sec
+    return req_deadline.budget(stage, cap_sec, need_sec)
+
+async def _cut(req_deadline, aw, stage, need_sec=0):
+    '''Await `aw`, whose timeout is the one of `stage` (see Deadline.cut).
+    '''
+
+    if req_deadline is None:
+        return await aw
+    return await req_deadline.cut(aw, stage, need_sec)
+
+async def _within(req_deadline, aw, stage, cap_sec=None, need_sec=0):
+    '''Await `aw` within the timeout of `stage` (see _stage_timeout).
+    '''
+
+    if req_deadline is not None:
+        return await req_deadline.run(aw, stage, cap_sec, need_sec)
+    if cap_sec:
+        return await asyncio.wait_for(aw, cap_sec)
+    return await aw
+
+def _discard_socket(ws_fut):
+    '''Cancel a pending scorer handshake, or close the socket it opened.
+    '''
+
+    if not ws_fut.done():
+        ws_fut.cancel()
+    elif not ws_fut.cancelled() and ws_fut.exception() is None:
+        asyncio.ensure_future(ws_fut.result().close())
+
+class _AudioSource(object):
+    '''Async iterator over `audio` that remembers whether it failed.
+    '''
+
+    def __init__(self, audio):
+        self._audio = audio.__aiter__()
+        self.failed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._audio.__anext__()
+        except StopAsyncIteration:
+            raise
+        except BaseException:
+            self.failed = True
+            raise
@@ -0,0 +1,269 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+log = logging.getLogger()
+
+SPOOL_FILE_SUFFIX = '.json'
+# Marks a job still running, for the workers that share the spool directory
+PENDING_FILE_SUFFIX = '.pending'
+TEMP_FILE_SUFFIX = '.tmp'
+# Job ids are uuid4 hex strings; anything else is never looked up on disk
+JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+class JobStoreFull(Exception):
+    '''This exception is thrown when a job is submitted while the store holds
+    max_jobs jobs that are all still running.
+    '''
+
+    pass
+
+def default_error_result(exc):
+    '''Return the result of a job that raised `exc`.
+    '''
+
+    return json.dumps({'status': -1, 'msg': 'Internal Error'}).encode()
+
+class Job(object):
+    '''Job is one rating request run in the background.
+
+    `result` (bytes) is None until the job is done. A job read from another
+    worker's spool has no future.
+    '''
+
+    def __init__(self, job_id, expires_at, result=None):
+        self.id = job_id
+        self.expires_at = expires_at
+        self.result = result
+        self.future = None
+
+    @property
+    def done(self):
+        return self.result is not None
+
+class JobStore(object):
+    '''JobStore runs jobs and keeps them, oldest first out, for `ttl_sec`
+    seconds after they were submitted.
+
+    At most `max_jobs` jobs are kept; when full, the oldest completed job is
+    dropped, and if every job is still running a new one is refused with
+    JobStoreFull. A job whose coroutine raises is done with the result
+    `error_result(exception)`. With `spool_dir`, running jobs are marked and
+    completed results are written there, so they can still be fetched after
+    a worker restart, or from another worker sharing the directory. The
+    spool is only used by executor threads, never on the event loop.
+    '''
+
+    def __init__(self, max_jobs=10000, ttl_sec=600, spool_dir='',
+            error_result=default_error_result):
+        self.max_jobs = int(max_jobs)
+        self.ttl_sec = float(ttl_sec)
+        self.spool_dir = spool_dir
+        self.error_result = error_result
+        self._jobs = collections.OrderedDict() # job id -> Job, oldest first
+        self._spooling = set() # futures of spool writes and removals
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.expirations = 0
+        self.spool_hits = 0
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+            self._purge_spool()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def submit(self, coro_func):
+        '''Start `coro_func()` (which returns bytes) in the background and
+        return its Job.
+        '''
+
+        self._expire()
+        if len(self._jobs) >= self.max_jobs and not self._drop_completed():
+            self.rejected += 1
+            raise JobStoreFull('%d jobs running' % len(self._jobs))
+        job = Job(uuid.uuid4().hex, time.monotonic() + self.ttl_sec)
+        job.future = asyncio.ensure_future(coro_func())
+        job.future.add_done_callback(lambda fut: self._complete(job, fut))
+        self._jobs[job.id] = job
+        self.submitted += 1
+        if self.spool_dir:
+            self._spool(self._mark_pending, job.id)
+        return job
+
+    async def get(self, job_id):
+        '''Return the Job `job_id`, or None if it is unknown or expired. A job
+        another worker is running is returned not done.
+        '''
+
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is None and self.spool_dir and JOB_ID_PATTERN.match(job_id):
+            found = await asyncio.get_event_loop().run_in_executor(None,
+                self._read_spool, job_id)
+            if found is not None:
+                self.spool_hits += 1
+                age, result = found
+                job = Job(job_id, time.monotonic() + self.ttl_sec - age, result)
+        return job
+
+    async def wait(self, job, timeout):
+        '''Wait up to `timeout` seconds for `job` to be done.
+        '''
+
+        if job.done or job.future is None or timeout <= 0:
+            return
+        try:
+            # shield() keeps a poller that gives up from cancelling the job
+            await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Timed out, or the job failed and has its error result by now
+            pass
+
+    async def close(self):
+        '''Cancel the jobs still running and wait for the spool writes.
+        '''
+
+        for job in self._jobs.values():
+            if job.future is not None and not job.future.done():
+                job.future.cancel()
+        await self.flush()
+
+    async def flush(self):
+        '''Wait for the spool writes and removals started so far.
+        '''
+
+        if self._spooling:
+            await asyncio.gather(*self._spooling)
+
+    def stats(self):
+        running = sum(1 for job in self._jobs.values() if not job.done)
+        return {
+            'jobs':        len(self._jobs),
+            'running':     running,
+            'submitted':   self.submitted,
+            'completed':   self.completed,
+            'failed':      self.failed,
+            'rejected':    self.rejected,
+            'expirations': self.expirations,
+            'spool_hits':  self.spool_hits,
+        }
+
+    def _complete(self, job, fut):
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        if exc is not None:
+            # The traceback is formatted by the logging thread, if queued
+            log.warning('Job %s failed: %r' % (job.id, exc), exc_info=exc)
+            job.result = self.error_result(exc)
+            self.failed += 1
+        else:
+            job.result = fut.result()
+        job.future = None
+        self.completed += 1
+        if self.spool_dir:
+            self._spool(self._write_spool, job.id, job.result)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if now < job.expires_at:
+                break
+            self._remove(job)
+            self.expirations += 1
+
+    def _drop_completed(self):
+        for job in self._jobs.values():
+            if job.done:
+                self._remove(job)
+                return True
+        return False
+
+    def _remove(self, job):
+        del self._jobs[job.id]
+        if job.future is not None:
+            job.future.cancel()
+        if self.spool_dir:
+            self._spool(self._remove_spool, job.id)
+
+    def _spool(self, func, *args):
+        fut = asyncio.get_event_loop().run_in_executor(None, func, *args)
+        self._spooling.add(fut)
+        fut.add_done_callback(self._spooling.discard)
+
+    # The methods below run in executor threads
+
+    def _remove_spool(self, job_id):
+        for suffix in (SPOOL_FILE_SUFFIX, PENDING_FILE_SUFFIX):
+            try:
+                os.remove(self._spool_path(job_id, suffix))
+            except OSError:
+                pass
+
+    def _spool_path(self, job_id, suffix=SPOOL_FILE_SUFFIX):
+        return os.path.join(self.spool_dir, job_id + suffix)
+
+    def _mark_pending(self, job_id):
+        try:
+            open(self._spool_path(job_id, PENDING_FILE_SUFFIX), 'wb').close()
+        except OSError as e:
+            log.warning('Unable to spool job %s: %r' % (job_id, e))
+
+    def _write_spool(self, job_id, result):
+        path = self._spool_path(job_id)
+        tmp_path = '%s.%d%s' % (path, os.getpid(), TEMP_FILE_SUFFIX)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(result)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warning('Unable to spool job %s: %r' % (job_id, e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        try:
+            os.remove(self._spool_path(job_id, PENDING_FILE_SUFFIX))
+        except OSError:
+            pass
+
+    def _read_spool(self, job_id):
+        # Return the age and result (None if running) of a spooled job, or None
+        path = self._spool_path(job_id)
+        try:
+            with open(path, 'rb') as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                result = f.read()
+        except OSError:
+            # Maybe still running in another worker
+            try:
+                age = time.time() - os.stat(self._spool_path(job_id, PENDING_FILE_SUFFIX)).st_mtime
+            except OSError:
+                return None
+            result = None
+        if age >= self.ttl_sec:
+            return None
+        return age, result
+
+    def _purge_spool(self):
+        now = time.time()
+        for entry in os.scandir(self.spool_dir):
+            if not entry.name.endswith((SPOOL_FILE_SUFFIX, PENDING_FILE_SUFFIX,
+                    TEMP_FILE_SUFFIX)):
+                continue
+            try:
+                if now - entry.stat().st_mtime >= self.ttl_sec:
+                    os.remove(entry.path)
+            except OSError:
+                pass
@@ -1,59 +1,284 @@
 import asyncio
-import base64
-import binascii
-import json
 import logging
-import sys
+import time
 
 import aiohttp
-from . import auth_util
+from . import meta_util, metrics, routing
 
 # The maximum duration of one WeChat voice message is 60 seconds. Under
 # moderate load, Liulishuo needs ~30s to finish marking a 60s audio.
 SCORING_TIMEOUT_SEC = 30
 # Size of the length field in streaming reqs/rsps
 INTEGER_SIZE = 4
+# Responses announcing more bytes than this are rejected instead of allocated
+MAX_RESPONSE_SIZE = 16 * 1024 * 1024
 # Add this HTTP header to get the server informed of the requestor being WeChat.
 # This has effect on certain behaviors, such as disabling queuing (HTTP requests
 # will inevitably time out after queued for ~10 seconds).
 HEADER_FOR_STATS = 'X-from-WeChat'
+# Audio chunks are merged into WS messages of at least COALESCE_BYTES bytes,
+# unless the data waiting in the buffer is older than COALESCE_WINDOW_SEC
+# seconds. Set COALESCE_BYTES to 0 to send every chunk as it comes.
+COALESCE_BYTES = 32768
+COALESCE_WINDOW_SEC = 0.05
 
 log = logging.getLogger()
 
 class LiulishuoResponseError(Exception):
     pass
 
-async def get_score(session, endpoint, meta, audio_iter):
-    async with session.ws_connect(
+class ResponseAssembler(object):
+    '''ResponseAssembler puts a scorer response back together from the WS
+    messages it was split into.
+
+    The response starts with a 4-byte big-endian length. Once that is known, a
+    buffer of exactly that size is allocated and every fragment is copied into
+    it once; the buffer itself is the result.
+    '''
+
+    def __init__(self, max_size=MAX_RESPONSE_SIZE):
+        self.max_size = max_size
+        self.size = None
+        self.received = 0
+        self._header = b''
+        self._body = None
+        self._view = None
+
+    def feed(self, data):
+        '''Add a fragment. Return True once the whole response has arrived;
+        bytes beyond the announced length are ignored.
+        '''
+
+        if self.size is None:
+            need = INTEGER_SIZE - len(self._header)
+            self._header += data[:need]
+            if len(self._header) < INTEGER_SIZE:
+                return False
+            self.size = int.from_bytes(self._header, byteorder='big', signed=False)
+            if self.size > self.max_size:
+                raise LiulishuoResponseError('Response too large: %d bytes' % self.size)
+            self._body = bytearray(self.size)
+            self._view = memoryview(self._body)
+            data = memoryview(data)[need:]
+        n = min(len(data), self.size - self.received)
+        self._view[self.received:self.received+n] = data[:n]
+        self.received += n
+        return self.received >= self.size
+
+    @property
+    def started(self):
+        '''True once any byte of the response has arrived.
+        '''
+
+        return len(self._header) > 0
+
+    def result(self):
+        '''Return the response body (a bytearray) or raise
+        LiulishuoResponseError if it is empty or incomplete.
+        '''
+
+        if not self.size:
+            raise LiulishuoResponseError('Response too short: '+repr(self._header))
+        if self.received < self.size:
+            raise LiulishuoResponseError('Response truncated: got %d of %d bytes' % (
+                self.received, self.size))
+        self._view.release()
+        return self._body
+
+async def coalesce_chunks(chunks, max_bytes=COALESCE_BYTES, window_sec=COALESCE_WINDOW_SEC):
+    '''Merge the byte chunks of async iterator `chunks` into larger ones.
+
+    A merged chunk is yielded once it reaches `max_bytes`, once a chunk arrives
+    more than `window_sec` after the first buffered one, and when `chunks` is
+    exhausted. The scorer only answers after EOS, which always follows the
+    final flush, so holding data during a stalled download costs nothing.
+    '''
+
+    if max_bytes <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+    loop = asyncio.get_event_loop()
+    buf = bytearray()
+    deadline = None
+    async for chunk in chunks:
+        if not buf:
+            if len(chunk) >= max_bytes:
+                yield chunk
+                continue
+            deadline = loop.time() + window_sec
+        buf += chunk
+        if len(buf) >= max_bytes or loop.time() >= deadline:
+            yield buf
+            buf = bytearray()
+    if buf:
+        yield buf
+
+class BufferedAudio(object):
+    '''BufferedAudio lets several readers stream the same audio, e.g. to a
+    second scorer when a request is hedged.
+
+    Chunks are kept as they are pulled from `source`; each reader() first
+    replays what has been kept, then pulls more itself, so a reader does not
+    depend on another one going on. An error of `source` is raised to every
+    reader that gets to it.
+    '''
+
+    def __init__(self, source):
+        self._source = source.__aiter__()
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def failed(self):
+        return self._error is not None
+
+    async def reader(self):
+        i = 0
+        while True:
+            if i < len(self._chunks):
+                yield self._chunks[i]
+                i += 1
+            elif self._error is not None:
+                raise self._error
+            elif self._done:
+                return
+            else:
+                await self._pull(i)
+
+    async def _pull(self, index):
+        async with self._lock:
+            if index < len(self._chunks) or self._done or self._error is not None:
+                return
+            try:
+                chunk = await self._source.__anext__()
+            except StopAsyncIteration:
+                self._done = True
+                return
+            except Exception as e:
+                self._error = e
+                raise
+            except BaseException:
+                # The source cannot be resumed after a cancellation; other
+                # readers must not take what was read so far for all of it.
+                self._error = LiulishuoResponseError('Audio source was interrupted')
+                raise
+            self._chunks.append(chunk)
+
+async def connect(session, endpoint):
+    '''Open a WebSocket connection to the scoring service on `endpoint`.
+    '''
+
+    return await session.ws_connect(
         endpoint,
         timeout=SCORING_TIMEOUT_SEC,
         receive_timeout=SCORING_TIMEOUT_SEC,
         headers={HEADER_FOR_STATS: '1'},
-    ) as ws:
-        meta_bin = meta.encode()
-        meta_len = len(meta_bin).to_bytes(INTEGER_SIZE, 'big')
-        await ws.send_bytes(meta_len+meta_bin)
-        async for chunk in audio_iter:
-            await ws.send_bytes(chunk)
-        await ws.send_bytes(b'EOS') # End-of-Stream marker
-        ret = b''
-        ret_size = None
-        async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.BINARY:
-                ret += msg.data
-            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-                break
-            # Get response size from the 4-byte header
-            if ret_size == None and len(ret) >= INTEGER_SIZE:
-                ret_size = int.from_bytes(ret[0:INTEGER_SIZE], byteorder='big', signed=False)
-            # If the 'first' response has been wholly received, stop and ignore the rest
-            if ret_size != None and len(ret) >= INTEGER_SIZE+ret_size:
+    )
+
+async def open_socket(session, endpoint, pool=None, trace=None, timeout=None):
+    '''Return a WebSocket connected to `endpoint`, from `pool` if given,
+    within `timeout` seconds if given.
+    '''
+
+    started = time.monotonic()
+    if pool is not None:
+        opening = pool.acquire(endpoint)
+    else:
+        opening = connect(session, endpoint)
+    if timeout is not None:
+        ws = await asyncio.wait_for(opening, timeout)
+    else:
+        ws = await opening
+    if trace is not None:
+        trace.mark(metrics.STAGE_WS_CONNECT, time.monotonic() - started)
+    return ws
+
+async def get_score(session, endpoint, meta, audio_iter,
+        coalesce_bytes=None, coalesce_window_sec=None, pool=None, trace=None, ws=None,
+        connect_timeout=None):
+    '''Send meta and audio to the scoring service on `endpoint` and return its
+    response (a bytearray, without the length header).
+
+    Arguments:
+    session             -- aiohttp.client.ClientSession object
+    endpoint            -- WebSocket URL of the scoring service
+    meta                -- str (Base64-encoded JSON expected)
+    audio_iter          -- async iterator of Liulishuo speex bytes
+    coalesce_bytes      -- see COALESCE_BYTES (module default if None)
+    coalesce_window_sec -- see COALESCE_WINDOW_SEC (module default if None)
+    pool                -- optional server.ws_pool.WebSocketPool to take an
+                           already-connected socket from; if that socket fails
+                           before the scorer answers, a new one is dialed and
+                           the audio sent again
+    trace               -- optional server.metrics.RequestTrace to time the
+                           connect, upload and response stages
+    ws                  -- optional socket already connected to `endpoint`
+                           (see open_socket); it is closed when done
+    connect_timeout     -- optional seconds to wait for a socket if `ws` is
+                           not given
+    '''
+
+    if coalesce_bytes is None:
+        coalesce_bytes = COALESCE_BYTES
+    if coalesce_window_sec is None:
+        coalesce_window_sec = COALESCE_WINDOW_SEC
+    if ws is None:
+        ws = await open_socket(session, endpoint, pool, trace, connect_timeout)
+    audio = None
+    if pool is not None and pool.lent(ws):
+        # The scorer may have closed the idle socket, which only shows once
+        # it is used: keep the audio to send it again on a new socket.
+        audio = BufferedAudio(audio_iter)
+        audio_iter = audio.reader()
+    assembler = ResponseAssembler()
+    try:
+        await _exchange(ws, meta, audio_iter, assembler,
+            coalesce_bytes, coalesce_window_sec, trace)
+        return assembler.result()
+    except (ConnectionError, aiohttp.ClientError, LiulishuoResponseError) as e:
+        if audio is None or audio.failed or assembler.started:
+            raise
+        log.info('Pooled socket to %s failed before a response (%r), retrying' % (
+            endpoint, e))
+    finally:
+        await ws.close()
+    ws = await open_socket(session, endpoint, None, trace, connect_timeout)
+    assembler = ResponseAssembler()
+    try:
+        await _exchange(ws, meta, audio.reader(), assembler,
+            coalesce_bytes, coalesce_window_sec, trace)
+        return assembler.result()
+    finally:
+        await ws.close()
+
+async def _exchange(ws, meta, audio_iter, assembler, coalesce_bytes, coalesce_window_sec, trace):
+    '''Send meta and audio on `ws` and feed the response to `assembler`.
+    '''
+
+    connected = time.monotonic()
+    meta_bin = meta.encode()
+    meta_len = len(meta_bin).to_bytes(INTEGER_SIZE, 'big')
+    await ws.send_bytes(meta_len+meta_bin)
+    async for chunk in coalesce_chunks(audio_iter, coalesce_bytes, coalesce_window_sec):
+        await ws.send_bytes(chunk)
+    await ws.send_bytes(b'EOS') # End-of-Stream marker
+    eos_sent = time.monotonic()
+    if trace is not None:
+        trace.mark(metrics.STAGE_UPLOAD, eos_sent - connected)
+    async for msg in ws:
+        if trace is not None and eos_sent is not None:
+            trace.mark(metrics.STAGE_SCORER_RESPONSE, time.monotonic() - eos_sent)
+            eos_sent = None
+        if msg.type == aiohttp.WSMsgType.BINARY:
+            # If the 'first' response has been wholly received, stop and
+            # ignore the rest
+            if assembler.feed(msg.data):
                 break
-        if ret_size != None and ret_size > 0:
-            # NOTE: this does not handle the case where ret_size is greater than
-            # the bytes actually received
-            return ret[INTEGER_SIZE:INTEGER_SIZE+ret_size]
-        raise LiulishuoResponseError('Response too short: '+repr(ret))
+        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+            break
 
 def get_type_from_meta(meta):
     '''
@@ -63,23 +288,10 @@ def get_type_from_meta(meta):
     meta -- a str (JSON expected)
     '''
 
-    meta_json = auth_util.remove_trail_from_meta(meta)
-    try:
-        meta_dict = json.loads(meta_json)
-    except json.decoder.JSONDecodeError as jde:
-        log.warning(jde)
+    meta_dict = meta_util.parse_json(meta)
+    if meta_dict is None:
         return ''
-    try:
-        question_type = meta_dict['type']
-        return question_type
-    except KeyError as ke:
-        log.warning(repr(ke))
-    try:
-        question_type = meta_dict['item']['type']
-        return question_type
-    except KeyError as ke:
-        log.warning(repr(ke))
-    return ''
+    return meta_util.get_question_type(meta_dict)
 
 def provide_scorer_url(config, meta):
     '''
@@ -88,20 +300,17 @@ def provide_scorer_url(config, meta):
     It fallbacks to default if there's no `type` in meta or no `type_specific_
     scorer_urls` in config.
 
+    OpenWeixinScorer does not call this per request; it parses meta once and
+    looks the type up in a precompiled server.routing.ScorerRoutes.
+
     Arguments:
     config -- server.cfg.ScorerConfig object
     meta   -- a str (Base64-encoded JSON expected)
     '''
 
-    ret = config.scorer_url
-    try:
-        meta = base64.b64decode(meta).decode()
-    except (binascii.Error, ValueError) as e:
-        log.warning(e)
-        return ret
-    type_str = get_type_from_meta(meta)
     try:
-        return config.type_specific_scorer_urls[type_str]
-    except (AttributeError, KeyError) as e:
-        log.warning(e)
-    return ret
+        meta_obj = meta_util.Meta.from_base64(meta)
+    except meta_util.MetaError as me:
+        log.warning(me)
+        return config.scorer_url
+    return routing.ScorerRoutes(config).url_for(meta_obj.question_type)
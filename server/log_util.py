@@ -0,0 +1,155 @@
+import logging
+import logging.handlers
+import queue
+import time
+
+import aiohttp.web
+
+from . import metrics
+
+# Logger of the one-line-per-request access log
+access_log = logging.getLogger('scorer.access')
+# Set on a request that log_access has handled
+ACCESS_LOGGED = 'access_logged'
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler that never blocks: when its bounded queue is full, the
+    record is dropped and counted.
+
+    Records are queued as they are; the messages of this code base are
+    %-formatted by the caller already, and any exception is formatted by the
+    listener thread.
+    '''
+
+    def __init__(self, max_size):
+        super().__init__(queue.Queue(max(1, int(max_size))))
+        self.queued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+class RateLimitFilter(logging.Filter):
+    '''RateLimitFilter lets each call site (file and line) log at most
+    `burst` warnings (or errors) per `period_sec` seconds. The rest are
+    suppressed and counted, and the next record let through says how many
+    were. Records below WARNING, such as access logs, are not limited.
+    '''
+
+    def __init__(self, burst=10, period_sec=10):
+        super().__init__()
+        self.burst = int(burst)
+        self.period_sec = float(period_sec)
+        self.suppressed = 0
+        # (pathname, lineno) -> [window start, records in window, suppressed]
+        self._sites = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.burst <= 0 or self.period_sec <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        site = self._sites.get(key)
+        if site is None:
+            site = self._sites[key] = [now, 0, 0]
+        elif now - site[0] >= self.period_sec:
+            site[0], site[1] = now, 0
+        if site[1] >= self.burst:
+            site[2] += 1
+            self.suppressed += 1
+            return False
+        site[1] += 1
+        if site[2]:
+            record.msg = '%s (%d similar messages suppressed)' % (record.getMessage(), site[2])
+            record.args = None
+            site[2] = 0
+        return True
+
+class QueueLogging(object):
+    '''QueueLogging moves the root logger's handlers to a background thread.
+
+    The root logger gets a DroppingQueueHandler (filtered by a
+    RateLimitFilter) instead, so that logging on the event loop thread costs
+    a filter check and a queue put; formatting and writing happen on the
+    listener thread. Threads do not survive fork(), so every worker process
+    starts its own (see OpenWeixinScorer.run_worker).
+    '''
+
+    def __init__(self, max_size=10000, burst=10, period_sec=10):
+        self.handler = DroppingQueueHandler(max_size)
+        self.rate_limit = RateLimitFilter(burst, period_sec)
+        self.handler.addFilter(self.rate_limit)
+        self._handlers = []
+        self._listener = None
+
+    def start(self):
+        root = logging.getLogger()
+        self._handlers = list(root.handlers)
+        for handler in self._handlers:
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        self._listener = logging.handlers.QueueListener(self.handler.queue,
+            *self._handlers, respect_handler_level=True)
+        self._listener.start()
+
+    def stop(self):
+        '''Write what is queued and give the root logger its handlers back.
+        '''
+
+        root = logging.getLogger()
+        root.removeHandler(self.handler)
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        for handler in self._handlers:
+            root.addHandler(handler)
+        self._handlers = []
+
+    def stats(self):
+        return {
+            'queued':     self.handler.queued,
+            'dropped':    self.handler.dropped,
+            'suppressed': self.rate_limit.suppressed,
+            'pending':    self.handler.queue.qsize(),
+        }
+
+def log_access(request, media_id, trace, outcome):
+    '''Log a finished rating request in one line of key=value pairs, with
+    the duration of each stage in milliseconds (see metrics.RequestTrace).
+    media_id is None if the request was rejected before it was known.
+    '''
+
+    request[ACCESS_LOGGED] = True
+    if not access_log.isEnabledFor(logging.INFO):
+        return
+    fields = [
+        'method=%s' % request.method,
+        'path=%s' % request.path,
+        'remote=%s' % request.remote,
+        'media_id=%s' % ('-' if media_id is None else media_id),
+        'type=%s' % (trace.question_type or '-'),
+        'tenant=%s' % ('-' if trace.tenant is None else trace.tenant or 'default'),
+        'audio_sec=%s' % ('-' if trace.audio_sec is None else '%.1f' % trace.audio_sec),
+        'outcome=%s' % outcome,
+        'ms=%.1f' % (trace.elapsed() * 1000),
+    ]
+    for stage in metrics.STAGES:
+        if stage in trace.stages:
+            fields.append('%s_ms=%.1f' % (stage, trace.stages[stage] * 1000))
+    access_log.info(' '.join(fields))
+
+class AccessLogger(aiohttp.web.AccessLogger):
+    '''aiohttp's access logger, for the requests that log_access did not log
+    (other endpoints, and anything that failed before reaching a handler).
+    '''
+
+    def log(self, request, response, time):
+        if not request.get(ACCESS_LOGGED):
+            super().log(request, response, time)
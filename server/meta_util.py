@@ -0,0 +1,98 @@
+import base64
+import binascii
+import json
+
+# Use a faster JSON codec when one is installed. Any of them produces valid
+# JSON for signing, since the hash is computed over the serialized string.
+try:
+    import orjson
+
+    def json_loads(s):
+        return orjson.loads(s)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    JSON_CODEC = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        def json_loads(s):
+            return ujson.loads(s)
+
+        def json_dumps(obj):
+            return ujson.dumps(obj)
+
+        JSON_CODEC = 'ujson'
+    except ImportError:
+        json_loads = json.loads
+        json_dumps = json.dumps
+        JSON_CODEC = 'json'
+
+class MetaError(Exception):
+    '''This exception is thrown when meta is not valid Base64-encoded text.
+    '''
+
+    pass
+
+def remove_trail_from_meta(meta):
+    return meta[:meta.rfind('}')+1]
+
+def get_question_type(meta_dict):
+    '''Return `type` or `item.type` of a parsed meta, or '' if neither exists
+    or it is not a string (such types go to the default scorer_url).
+    '''
+
+    try:
+        question_type = meta_dict['type']
+    except (KeyError, TypeError):
+        try:
+            question_type = meta_dict['item']['type']
+        except (KeyError, TypeError):
+            return ''
+    if not isinstance(question_type, str):
+        return ''
+    return question_type
+
+class Meta(object):
+    '''Meta is the `meta` field of a rating request, decoded and parsed once.
+
+    Attributes:
+    encoded       -- the Base64 str as received
+    text          -- the decoded str (JSON, possibly followed by ';hash=...')
+    dict          -- the parsed JSON object, or None if text is not valid JSON
+    question_type -- see get_question_type ('' if dict is None)
+    '''
+
+    def __init__(self, encoded, text, meta_dict):
+        self.encoded = encoded
+        self.text = text
+        self.dict = meta_dict
+        self.question_type = ''
+        if meta_dict is not None:
+            self.question_type = get_question_type(meta_dict)
+
+    @classmethod
+    def from_base64(cls, encoded):
+        '''Decode and parse `encoded`. Raise MetaError if it is not Base64 of
+        UTF-8 text; text that is not JSON gives a Meta whose dict is None.
+        '''
+
+        try:
+            text = base64.b64decode(encoded).decode()
+        except (binascii.Error, ValueError, TypeError) as e:
+            raise MetaError('Meta is not Base64-encoded text: %s' % e)
+        return cls(encoded, text, parse_json(text))
+
+def parse_json(text):
+    '''Parse the JSON part of a (maybe signed) meta text; None if invalid.
+    '''
+
+    try:
+        meta_dict = json_loads(remove_trail_from_meta(text))
+    except ValueError:
+        return None
+    if not isinstance(meta_dict, dict):
+        return None
+    return meta_dict
@@ -0,0 +1,294 @@
+import bisect
+import time
+
+# Upper bounds (seconds) of latency histogram buckets. Scoring takes up to
+# SCORING_TIMEOUT_SEC (30 s); token and WS connects are expected in ms.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+# Upper bounds (seconds) of the event loop lag histogram buckets
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Stages timed by RequestTrace, in pipeline order
+STAGE_TOKEN = 'token'                     # getting the access token
+STAGE_WX_FIRST_BYTE = 'wechat_first_byte' # WeChat GET until response headers
+STAGE_WX_DOWNLOAD = 'wechat_download'     # WeChat GET until the last byte
+STAGE_WS_CONNECT = 'ws_connect'           # WS handshake (or pool checkout)
+STAGE_UPLOAD = 'audio_upload'             # WS connected until EOS sent
+STAGE_SCORER_RESPONSE = 'scorer_response' # EOS sent until the first reply
+STAGES = (STAGE_TOKEN, STAGE_WX_FIRST_BYTE, STAGE_WX_DOWNLOAD, STAGE_WS_CONNECT,
+    STAGE_UPLOAD, STAGE_SCORER_RESPONSE)
+
+# Upper bounds (seconds) of the audio length classes requests are labelled
+# with, e.g. "le5s"; longer audio is "gt60s" and unknown "unknown".
+AUDIO_CLASS_BOUNDS = (5, 15, 30, 60)
+
+def audio_class(seconds):
+    '''Return the audio length class label of `seconds` (or None, unknown).
+    '''
+
+    if seconds is None:
+        return 'unknown'
+    for bound in AUDIO_CLASS_BOUNDS:
+        if seconds <= bound:
+            return 'le%ds' % bound
+    return 'gt%ds' % AUDIO_CLASS_BOUNDS[-1]
+
+# Request outcomes
+OUTCOME_OK = 'ok'
+OUTCOME_WEIXIN_ERROR = 'weixin_error' # the status -100 response
+OUTCOME_SCORER_ERROR = 'scorer_error' # LiulishuoResponseError
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_REJECTED = 'rejected'         # admission control
+OUTCOME_TOKEN_ERROR = 'token_error'
+OUTCOME_BAD_REQUEST = 'bad_request'   # unusable request (400)
+OUTCOME_ERROR = 'error'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+class Counter(object):
+    '''Counter of events, by label values.
+
+    Metrics are only touched from the event loop thread, so no locking is
+    done; an observation is a dict lookup and an addition.
+    '''
+
+    TYPE = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def inc(self, label_values=(), amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, label_values=()):
+        return self._values.get(label_values, 0)
+
+    def render(self, lines):
+        for label_values, value in sorted(self._values.items()):
+            lines.append('%s%s %s' % (self.name,
+                _format_labels(self.label_names, label_values), _format_value(value)))
+
+class Histogram(object):
+    '''Histogram of observed values, by label values.
+
+    Each series is a list of per-bucket counts (made cumulative only when
+    rendered) followed by the sum, so observe() allocates nothing once the
+    series exists.
+    '''
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, label_values=()):
+        series = self._series.get(label_values)
+        if series is None:
+            # One count per bucket, one for +Inf, then the sum
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            self._series[label_values] = series
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, label_values=()):
+        series = self._series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q, label_values=()):
+        '''Estimate the q-quantile (0 < q < 1) of a series by linear
+        interpolation within its bucket; None if nothing was observed.
+        '''
+
+        series = self._series.get(label_values)
+        if not series:
+            return None
+        total = sum(series[:-1])
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for i, upper in enumerate(self.buckets):
+            if seen + series[i] >= rank:
+                if series[i] == 0:
+                    return upper
+                return lower + (upper - lower) * (rank - seen) / series[i]
+            seen += series[i]
+            lower = upper
+        return self.buckets[-1]
+
+    def render(self, lines):
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for upper, n in zip(self.buckets + (float('inf'),), series):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (self.name,
+                    _format_labels(self.label_names, label_values,
+                        'le="%s"' % _format_value(float(upper))),
+                    cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(series[-1])))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+
+class StatsGauges(object):
+    '''Renders the stats() dict of a component as gauges.
+
+    `stats` is called at scrape time and returns either {key: number}, or,
+    with `label_name`, {label_value: {key: number}} (e.g. per scorer URL).
+    Every key becomes a gauge named `prefix_key`.
+    '''
+
+    TYPE = 'gauge'
+
+    def __init__(self, prefix, help_text, stats, label_name=None):
+        self.name = prefix
+        self.help_text = help_text
+        self.stats = stats
+        self.label_name = label_name
+
+    def render(self, lines):
+        stats = self.stats()
+        if self.label_name is None:
+            stats = {None: stats}
+        by_key = {}
+        for label_value, values in sorted(stats.items(), key=lambda kv: str(kv[0])):
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    by_key.setdefault(key, []).append((label_value, value))
+        for key, samples in sorted(by_key.items()):
+            name = '%s_%s' % (self.name, key)
+            lines.append('# HELP %s %s: %s' % (name, self.help_text, key))
+            lines.append('# TYPE %s gauge' % name)
+            for label_value, value in samples:
+                labels = ''
+                if self.label_name is not None:
+                    labels = _format_labels((self.label_name,), (label_value,))
+                lines.append('%s%s %s' % (name, labels, _format_value(value)))
+
+class Registry(object):
+    '''Registry renders its metrics in the Prometheus text format.
+    '''
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            if not isinstance(metric, StatsGauges):
+                lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+                lines.append('# TYPE %s %s' % (metric.name, metric.TYPE))
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+class RequestTrace(object):
+    '''RequestTrace collects the stage timings of one rating request.
+
+    It is passed down the pipeline; code that owns a stage calls mark() with
+    its duration. The timings are turned into metrics when the request ends,
+    once its outcome is known.
+    '''
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.question_type = '' # see routing.ScorerRoutes.type_label
+        self.tenant = None # set for requests of a tenant (see server.fair_queue)
+        self.audio_sec = None # estimated from the audio size, once known
+        self.audio_bytes = None # of the WeChat download, if its size is known
+        self.deadline = None # a server.deadline.Deadline, if the request has one
+        self.stages = {}
+
+    def mark(self, stage, seconds):
+        # A retried stage (e.g. after a rejected token) adds up
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+class ScorerMetrics(object):
+    '''The metrics of an OpenWeixinScorer.
+    '''
+
+    def __init__(self):
+        self.registry = Registry()
+        self.stage_seconds = self.registry.register(Histogram(
+            'scorer_stage_seconds',
+            'Duration of each stage of the rating pipeline',
+            ('stage', 'type', 'outcome'),
+        ))
+        self.request_seconds = self.registry.register(Histogram(
+            'scorer_request_seconds',
+            'End-to-end duration of rating requests',
+            ('type', 'outcome'),
+        ))
+        self.audio_request_seconds = self.registry.register(Histogram(
+            'scorer_audio_request_seconds',
+            'End-to-end duration of rating requests, by audio length class',
+            ('audio', 'outcome'),
+        ))
+        self.tenant_request_seconds = self.registry.register(Histogram(
+            'scorer_tenant_request_seconds',
+            'End-to-end duration of rating requests, by tenant',
+            ('tenant', 'outcome'),
+        ))
+        self.tenant_wait_seconds = self.registry.register(Histogram(
+            'scorer_tenant_wait_seconds',
+            'Time rating requests waited for their turn, by tenant',
+            ('tenant',),
+        ))
+        self.loop_lag_seconds = self.registry.register(Histogram(
+            'scorer_loop_lag_seconds',
+            'Delay of the event loop in running a timer',
+            (),
+            LOOP_LAG_BUCKETS,
+        ))
+
+    def observe_request(self, trace, outcome):
+        '''Record the timings of a finished request.
+        '''
+
+        question_type = str(trace.question_type)
+        for stage, seconds in trace.stages.items():
+            self.stage_seconds.observe(seconds, (stage, question_type, outcome))
+        self.request_seconds.observe(trace.elapsed(), (question_type, outcome))
+        self.audio_request_seconds.observe(trace.elapsed(),
+            (audio_class(trace.audio_sec), outcome))
+        if trace.tenant is not None:
+            self.tenant_request_seconds.observe(trace.elapsed(),
+                (trace.tenant or 'default', outcome))
+
+    def add_stats(self, prefix, help_text, stats, label_name=None):
+        '''Export a component's stats() (see StatsGauges).
+        '''
+
+        self.registry.register(StatsGauges(prefix, help_text, stats, label_name))
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from . import metrics
+
+log = logging.getLogger()
+
+# Frames of a stack that tracemalloc keeps per allocation
+MEMORY_TRACE_FRAMES = 1
+
+class LoopLagMonitor(object):
+    '''LoopLagMonitor measures how responsive the event loop is.
+
+    Every `interval_sec` a task sleeps and records how much later than asked
+    it woke up: the lag every other callback saw at that time. With
+    `slow_callback_sec` > 0, a watchdog thread also logs the stack of the
+    event loop thread when the loop has not come back for that long, i.e.
+    the code blocking it (CPU work, or a blocking call).
+
+    Unlike asyncio's debug mode, nothing is added to each callback. Lags are
+    observed into the histogram `lag` (a new one if None).
+    '''
+
+    def __init__(self, interval_sec=0.5, slow_callback_sec=0.1, lag=None):
+        self.interval_sec = float(interval_sec)
+        self.slow_callback_sec = float(slow_callback_sec)
+        if lag is None:
+            lag = metrics.Histogram('loop_lag_seconds',
+                'Delay of the event loop in running a timer', (), metrics.LOOP_LAG_BUCKETS)
+        self.lag = lag
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._loop_thread_id = None
+        self._heartbeat = time.monotonic()
+
+    def start(self):
+        '''Start monitoring the running event loop.
+        '''
+
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.ensure_future(self._run())
+        if self.slow_callback_sec > 0:
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._watch, args=(self._stopped,),
+                name='loop-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # The watchdog notices within slow_callback_sec / 2; not waited for.
+        self._stopped.set()
+        self._thread = None
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval_sec
+            await asyncio.sleep(self.interval_sec)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(0.0, now - expected)
+            self.lag.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def _watch(self, stopped):
+        reported = None
+        while not stopped.wait(self.slow_callback_sec / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval_sec
+            if blocked < self.slow_callback_sec or heartbeat == reported:
+                continue
+            # Once per stall
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            log.warning('Event loop blocked for over %.3gs, in:\n%s' % (blocked, stack))
+
+    def stats(self):
+        return {
+            'max_lag_seconds': self.max_lag,
+            'stalls':          self.stalls,
+        }
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+def sample_stacks(thread_id, seconds, interval_sec):
+    '''Sample the stack of thread `thread_id` every `interval_sec` for
+    `seconds`, from the calling thread. Return a Counter of stacks, each a
+    tuple of frame names from the outermost in.
+    '''
+
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        stacks[tuple(reversed(stack))] += 1
+        del frame
+        time.sleep(interval_sec)
+    return stacks
+
+def collapse(stacks):
+    '''Return `stacks` (see sample_stacks) in the collapsed format of
+    flamegraph.pl and speedscope: one "outer;...;inner count" line each.
+    '''
+
+    return ''.join('%s %d\n' % (';'.join(stack), count)
+        for stack, count in stacks.most_common())
+
+def memory_top(snapshot, limit):
+    '''Return the `limit` source lines holding the most memory in a
+    tracemalloc snapshot, biggest first.
+    '''
+
+    return [{
+        'file':  stat.traceback[0].filename,
+        'line':  stat.traceback[0].lineno,
+        'bytes': stat.size,
+        'count': stat.count,
+    } for stat in snapshot.statistics('lineno')[:limit]]
+
+async def profile(seconds, interval_sec=0.005, memory_limit=20):
+    '''Profile the running event loop for `seconds`.
+
+    Its stack is sampled every `interval_sec` from an executor thread, and
+    memory allocations are traced with tracemalloc meanwhile (unless it was
+    already tracing, only those made while profiling are seen). Samples
+    that end in the selector show the loop waiting for I/O; anything else
+    is CPU spent on the loop. Nothing runs when no profile is being taken.
+
+    Return {"seconds", "samples", "collapsed", "memory"} (see collapse and
+    memory_top).
+    '''
+
+    loop = asyncio.get_event_loop()
+    thread_id = threading.get_ident()
+    tracing = tracemalloc.is_tracing()
+    if not tracing and memory_limit > 0:
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+    try:
+        stacks = await loop.run_in_executor(None, sample_stacks, thread_id, seconds,
+            interval_sec)
+        memory = []
+        if tracemalloc.is_tracing() and memory_limit > 0:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ])
+            memory = memory_top(snapshot, memory_limit)
+    finally:
+        if not tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+    return {
+        'seconds':   seconds,
+        'samples':   sum(stacks.values()),
+        'collapsed': collapse(stacks),
+        'memory':    memory,
+    }
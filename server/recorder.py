@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+from . import metrics
+
+log = logging.getLogger()
+
+# Records kept in memory between writes; more are dropped and counted
+MAX_PENDING_RECORDS = 10000
+# Most bytes of whole lines appended in one write() call
+WRITE_CHUNK_BYTES = 65536
+
+class TrafficRecorder(object):
+    '''TrafficRecorder writes the shape of a sample of rating requests to the
+    file `path`, for test/replay.py to play back against mocks.
+
+    `sample_percent` percent of requests are recorded, one JSON object per
+    line:
+
+        {"t": 1700000000.123, "type": "readaloud", "meta": 312,
+         "audio": 4200, "audio_sec": 1.4, "outcome": "ok", "ms": 523.1,
+         "stages": {"token": 0.4, "wechat_first_byte": 80.2, ...}}
+
+    that is, the arrival time (seconds since the epoch), question type (as
+    labelled in metrics, see routing.ScorerRoutes.type_label), size of the
+    Base64 meta, bytes of WeChat audio (null if they came from the
+    audio cache), estimated seconds of audio, outcome, duration and stage
+    timings in milliseconds (see metrics.RequestTrace). Nothing a request
+    carries is written: no mediaId, token, meta or audio.
+
+    Records are buffered and appended every `flush_interval_sec` seconds
+    by an executor thread. Every write() call on the O_APPEND file appends
+    whole lines, so worker processes can share the file.
+    '''
+
+    def __init__(self, path, sample_percent=1, flush_interval_sec=1):
+        self.path = path
+        self.sample_percent = float(sample_percent)
+        self.flush_interval_sec = float(flush_interval_sec)
+        self._pending = []
+        self._flush_handle = None
+        self._writes = set() # futures of appends in progress
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.write_errors = 0
+
+    def sample(self):
+        '''Tell whether to record the next request.
+        '''
+
+        return random.random() * 100 < self.sample_percent
+
+    def record(self, trace, meta_size, outcome):
+        '''Record a finished request with its metrics.RequestTrace.
+        '''
+
+        if len(self._pending) >= MAX_PENDING_RECORDS:
+            self.dropped += 1
+            return
+        stages = {stage: round(trace.stages[stage] * 1000, 1)
+            for stage in metrics.STAGES if stage in trace.stages}
+        elapsed = trace.elapsed()
+        self._pending.append(json.dumps({
+            't':         round(time.time() - elapsed, 3),
+            'type':      trace.question_type,
+            'meta':      meta_size,
+            'audio':     trace.audio_bytes,
+            'audio_sec': None if trace.audio_sec is None else round(trace.audio_sec, 2),
+            'outcome':   outcome,
+            'ms':        round(elapsed * 1000, 1),
+            'stages':    stages,
+        }, separators=(',', ':')))
+        self.recorded += 1
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.flush_interval_sec, self.flush)
+
+    def flush(self):
+        '''Start appending the pending records to the file.
+        '''
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        fut = asyncio.get_event_loop().run_in_executor(None, _append, self.path, lines)
+        self._writes.add(fut)
+        fut.add_done_callback(lambda fut: self._written(fut, len(lines)))
+
+    async def close(self):
+        '''Append the pending records and wait for the appends to be done.
+        '''
+
+        self.flush()
+        if self._writes:
+            await asyncio.gather(*self._writes)
+
+    def _written(self, fut, count):
+        self._writes.discard(fut)
+        e = fut.exception()
+        if e is not None:
+            self.write_errors += 1
+            log.warning('Unable to write traffic records to %s: %r' % (self.path, e))
+            return
+        self.written += count
+
+    def stats(self):
+        return {
+            'recorded':     self.recorded,
+            'written':      self.written,
+            'dropped':      self.dropped,
+            'write_errors': self.write_errors,
+            'pending':      len(self._pending),
+        }
+
+def _append(path, lines):
+    data = [(line + '\n').encode() for line in lines]
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        start = 0
+        while start < len(data):
+            end, size = start, 0
+            while end < len(data) and (end == start or size + len(data[end]) <= WRITE_CHUNK_BYTES):
+                size += len(data[end])
+                end += 1
+            chunk = b''.join(data[start:end])
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+            start = end
+    finally:
+        os.close(fd)
+
+def read_records(path):
+    '''Return the records of a file written by TrafficRecorder, sorted by
+    arrival time. Lines that are not records (e.g. cut short by a crash) are
+    skipped.
+    '''
+
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                float(record['t'])
+            except (ValueError, TypeError, KeyError):
+                continue
+            records.append(record)
+    records.sort(key=lambda record: record['t'])
+    return records
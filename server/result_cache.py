@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import json
+import time
+
+def request_key(media_id, meta_obj):
+    '''Return the key identifying a rating request: mediaId plus the meta with
+    its volatile signing fields (salt, hash) removed, in canonical form.
+
+    Arguments:
+    media_id -- str
+    meta_obj -- server.meta_util.Meta object
+    '''
+
+    if meta_obj.dict is None:
+        return (media_id, meta_obj.text)
+    meta_dict = dict(meta_obj.dict)
+    meta_dict.pop('salt', None)
+    return (media_id, json.dumps(meta_dict, sort_keys=True, separators=(',', ':')))
+
+# `status` of a successful scorer response
+SUCCESS_STATUS = 0
+
+def is_success(rsp):
+    '''Tell whether the scorer response `rsp` (JSON bytes) is a successful
+    result; an error is not worth keeping, as a retry may well succeed.
+    '''
+
+    try:
+        return json.loads(rsp)['status'] == SUCCESS_STATUS
+    except (ValueError, TypeError, KeyError):
+        return False
+
+class ResultCache(object):
+    '''ResultCache keeps completed scorer responses, least recently used first
+    out, each for at most `ttl_sec` seconds.
+
+    It is bounded both by entry count and by the total size of the responses.
+    Counters: hits, misses, evictions (for size) and expirations (for age).
+    '''
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl_sec=300):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl_sec = float(ttl_sec)
+        self._entries = collections.OrderedDict() # key -> (value, expires_at)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''Return the cached response for `key`, or None.
+        '''
+
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes or self.max_entries <= 0:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl_sec)
+        self.bytes += len(value)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries':     len(self._entries),
+            'bytes':       self.bytes,
+            'hits':        self.hits,
+            'misses':      self.misses,
+            'hit_rate':    self.hits / lookups if lookups else 0.0,
+            'evictions':   self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.bytes -= len(value)
+
+class InFlightRequests(object):
+    '''InFlightRequests runs one coroutine per key at a time; callers asking
+    for a key that is already running wait for the same result.
+
+    The coroutine runs in its own task, so it goes on (and later callers can
+    still attach to it) even if the caller that started it is cancelled.
+
+    A run may have to end by a time (`expires_at`, time.monotonic(), None
+    for never). A caller that can wait longer does not join it, but starts
+    a run of its own, which later callers then join.
+    '''
+
+    def __init__(self):
+        self._futures = {} # key -> (future, expires_at)
+        self.started = 0
+        self.joined = 0
+
+    def __len__(self):
+        return len(self._futures)
+
+    async def run(self, key, coro_func, expires_at=None):
+        '''Return the result of `coro_func()` for `key`, which must be done by
+        `expires_at`, sharing a run that is already in flight and lasts as
+        long.
+        '''
+
+        if expires_at is None:
+            expires_at = float('inf')
+        fut, run_expires_at = self._futures.get(key, (None, None))
+        if fut is None or run_expires_at < expires_at:
+            self.started += 1
+            fut = asyncio.ensure_future(coro_func())
+            self._futures[key] = (fut, expires_at)
+            fut.add_done_callback(lambda _: self._forget(key, fut))
+        else:
+            self.joined += 1
+        return await asyncio.shield(fut)
+
+    def _forget(self, key, fut):
+        if self._futures.get(key, (None,))[0] is fut:
+            del self._futures[key]
+        # Its callers may all have given up (e.g. at their deadline); their
+        # error is theirs to report, not the task's
+        if not fut.cancelled():
+            fut.exception()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._futures),
+            'started':   self.started,
+            'joined':    self.joined,
+        }
@@ -0,0 +1,58 @@
+# Label of the question types that have no route of their own (see
+# ScorerRoutes.type_label)
+OTHER_TYPE = 'other'
+
+def _as_list(urls):
+    if isinstance(urls, (list, tuple)):
+        return list(urls)
+    return [urls]
+
+class ScorerRoutes(object):
+    '''ScorerRoutes maps question types to scorer URLs.
+
+    It is compiled once from config (scorer_url and the optional
+    type_specific_scorer_urls) so that routing a request is one dict lookup.
+    Every entry may be one URL or a list of them, to be balanced over (see
+    server.balancer).
+    '''
+
+    def __init__(self, config):
+        self.default = _as_list(config.scorer_url)
+        by_type = getattr(config, 'type_specific_scorer_urls', None) or {}
+        self.by_type = {t: _as_list(urls) for t, urls in by_type.items()}
+        for endpoints in [self.default] + list(self.by_type.values()):
+            if not endpoints or not all(endpoints):
+                raise ValueError('Empty scorer URL in config')
+
+    def endpoints_for(self, question_type):
+        '''Return the list of URLs that may score `question_type`.
+        '''
+
+        return self.by_type.get(question_type, self.default)
+
+    def type_label(self, question_type):
+        '''Return the label `question_type` is counted under in metrics: the
+        type itself if it has its own route or is '', else OTHER_TYPE, so
+        that clients cannot add series at will.
+        '''
+
+        if not question_type or question_type in self.by_type:
+            return question_type
+        return OTHER_TYPE
+
+    def url_for(self, question_type):
+        '''Return the first URL for `question_type`.
+        '''
+
+        return self.endpoints_for(question_type)[0]
+
+    def urls(self):
+        '''Return every URL in the table, without duplicates.
+        '''
+
+        urls = []
+        for endpoints in [self.default] + list(self.by_type.values()):
+            for url in endpoints:
+                if url not in urls:
+                    urls.append(url)
+        return urls
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger()
+
+# WeChat error codes meaning "the access_token you used is no good":
+# 40001 - invalid credential / access_token is invalid or not latest
+# 40014 - invalid access_token
+# 42001 - access_token expired
+WX_INVALID_TOKEN_ERRCODES = (40001, 40014, 42001)
+
+class AccessTokenError(Exception):
+    '''This exception is thrown when no access token could be got; the
+    original exception is its __cause__.
+    '''
+
+    pass
+
+class AccessTokenCache(object):
+    '''AccessTokenCache keeps access tokens in process memory.
+
+    Tokens are fetched with a caller-provided coroutine function. Only one
+    fetch per key runs at a time (concurrent callers await the same future),
+    and a token that is about to expire is refreshed in the background while
+    the old one is still being served.
+
+    Counters `hits`, `misses`, `refreshes`, `errors` and `invalidations` are
+    plain integers; read them (or call stats()) to see whether the token
+    service is still on the hot path.
+    '''
+
+    def __init__(self, ttl_sec=600, refresh_ahead_sec=60):
+        '''
+        Arguments:
+        ttl_sec           -- how long a fetched token is considered valid; a
+                             value <= 0 disables caching (every get() fetches)
+        refresh_ahead_sec -- start a background refresh when the cached token
+                             has less than this many seconds left
+        '''
+
+        self.ttl_sec = float(ttl_sec)
+        self.refresh_ahead_sec = float(refresh_ahead_sec)
+        self._tokens = {}   # key -> (token, expires_at)
+        self._inflight = {} # key -> asyncio.Future
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.invalidations = 0
+
+    async def get(self, fetch, key=''):
+        '''Return a token for `key`, calling `fetch()` only when needed.
+
+        Arguments:
+        fetch -- coroutine function without arguments that returns a token
+        key   -- cache key (use it if tokens differ between requests)
+        '''
+
+        if self.ttl_sec <= 0:
+            self.misses += 1
+            return await fetch()
+        now = time.monotonic()
+        try:
+            token, expires_at = self._tokens[key]
+        except KeyError:
+            token, expires_at = None, 0
+        if token is not None and now < expires_at:
+            self.hits += 1
+            if expires_at - now < self.refresh_ahead_sec and key not in self._inflight:
+                self.refreshes += 1
+                fut = self._start_fetch(fetch, key)
+                # Nobody awaits a background refresh; keep its failure quiet
+                # here (it is counted and logged in _fetch) and let the next
+                # caller retry.
+                fut.add_done_callback(_ignore_result)
+            return token
+        self.misses += 1
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = self._start_fetch(fetch, key)
+        # shield() keeps a cancelled caller from cancelling the fetch that
+        # other callers share.
+        return await asyncio.shield(fut)
+
+    def invalidate(self, key='', token=None):
+        '''Drop the cached token for `key`.
+
+        If `token` is given, the entry is only dropped when it still holds that
+        token, so a token rejected by WeChat does not evict a newer one.
+        '''
+
+        try:
+            cached, _ = self._tokens[key]
+        except KeyError:
+            return
+        if token is not None and cached != token:
+            return
+        del self._tokens[key]
+        self.invalidations += 1
+
+    def stats(self):
+        return {
+            'hits':          self.hits,
+            'misses':        self.misses,
+            'refreshes':     self.refreshes,
+            'errors':        self.errors,
+            'invalidations': self.invalidations,
+            'size':          len(self._tokens),
+        }
+
+    def _start_fetch(self, fetch, key):
+        fut = asyncio.ensure_future(self._fetch(fetch, key))
+        self._inflight[key] = fut
+        return fut
+
+    async def _fetch(self, fetch, key):
+        try:
+            token = await fetch()
+        except Exception as e:
+            self.errors += 1
+            log.warning('Unable to fetch access token: %r' % e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        if token:
+            self._tokens[key] = (token, time.monotonic() + self.ttl_sec)
+        return token
+
+def _ignore_result(fut):
+    if not fut.cancelled():
+        fut.exception()
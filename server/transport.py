@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+import aiohttp
+
+log = logging.getLogger()
+
+UPSTREAM_WECHAT = 'wechat'
+UPSTREAM_TOKEN = 'token'
+UPSTREAM_SCORER = 'scorer'
+UPSTREAMS = (UPSTREAM_WECHAT, UPSTREAM_TOKEN, UPSTREAM_SCORER)
+
+# Options of aiohttp.TCPConnector that may be set in config
+CONNECTOR_OPTIONS = ('limit', 'limit_per_host', 'keepalive_timeout', 'ttl_dns_cache')
+
+EVENT_LOOP_ASYNCIO = 'asyncio'
+EVENT_LOOP_UVLOOP = 'uvloop'
+
+def connector_options(config, upstream):
+    '''Return the TCPConnector options for `upstream`: connector_defaults
+    updated with connectors[upstream], if any.
+    '''
+
+    options = dict(config.connector_defaults)
+    options.update((config.connectors or {}).get(upstream) or {})
+    unknown = set(options) - set(CONNECTOR_OPTIONS)
+    if unknown:
+        raise ValueError('Unknown connector option(s) for %s: %s' % (
+            upstream, ', '.join(sorted(unknown))))
+    return options
+
+def make_session(options):
+    '''Create a ClientSession with its own connection pool.
+
+    Must be called with an event loop running (e.g. in on_startup).
+    '''
+
+    connector = aiohttp.TCPConnector(use_dns_cache=True, **options)
+    return aiohttp.ClientSession(connector=connector)
+
+def make_sessions(config):
+    '''Return a dict of one ClientSession per upstream.
+    '''
+
+    return {upstream: make_session(connector_options(config, upstream))
+        for upstream in UPSTREAMS}
+
+def install_event_loop(name):
+    '''Make new event loops of the kind `name` ('asyncio' or 'uvloop').
+
+    Call it before any loop is created. If uvloop is asked for but not
+    installed, the default loop is kept and a warning logged.
+    '''
+
+    if not name or name == EVENT_LOOP_ASYNCIO:
+        return
+    if name != EVENT_LOOP_UVLOOP:
+        raise ValueError('Unknown event loop %r (expected %s or %s)' % (
+            name, EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP))
+    try:
+        import uvloop
+    except ImportError:
+        log.warning('uvloop is not installed, using the asyncio event loop')
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    log.info('Using the uvloop event loop')
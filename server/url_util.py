@@ -50,3 +50,27 @@ def add_url_params(url, params):
     ).geturl()
 
     return new_url
+
+class URLTemplate(object):
+    """ A URL whose query gets extra params, parsed once.
+
+    URLTemplate(url).build(params) returns the same URL as
+    add_url_params(url, params) without re-parsing `url` every time.
+    """
+
+    def __init__(self, url):
+        parsed_url = urlparse(unquote(url))
+        self._base_args = dict(parse_qsl(parsed_url.query))
+        self._prefix = ParseResult(
+            parsed_url.scheme, parsed_url.netloc, parsed_url.path,
+            parsed_url.params, '', ''
+        ).geturl() + '?'
+        self._suffix = '#' + parsed_url.fragment if parsed_url.fragment else ''
+
+    def build(self, params):
+        args = dict(self._base_args)
+        args.update(params)
+        args.update(
+            {k: dumps(v) for k, v in args.items() if isinstance(v, (bool, dict))}
+        )
+        return self._prefix + urlencode(args, doseq=True) + self._suffix
@@ -0,0 +1,142 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+log = logging.getLogger()
+
+# A worker that exits within this many seconds of being started counts as
+# crashing on startup; such workers are restarted with exponential backoff.
+MIN_WORKER_LIFETIME_SEC = 5
+MAX_RESTART_DELAY_SEC = 30
+LISTEN_BACKLOG = 1024
+
+def resolve_worker_count(value):
+    '''Turn the `workers` config value into a process count.
+
+    Arguments:
+    value -- a positive int, or 'auto' for one worker per CPU
+    '''
+
+    if value == 'auto':
+        return os.cpu_count() or 1
+    count = int(value)
+    if count < 1:
+        raise ValueError('workers must be positive or "auto", got %r' % value)
+    return count
+
+def describe_status(status):
+    '''Tell how a child ended, from its os.wait() status.
+    '''
+
+    if os.WIFSIGNALED(status):
+        return 'was killed by signal %d' % os.WTERMSIG(status)
+    if os.WIFEXITED(status):
+        return 'exited with code %d' % os.WEXITSTATUS(status)
+    return 'ended with wait status %d' % status
+
+def bind_socket(host, port, reuse_port=False):
+    '''Create a listening TCP socket that can be inherited by child processes.
+
+    With reuse_port, SO_REUSEPORT is set so that several processes can bind
+    the same address and the kernel spreads connections among them.
+    '''
+
+    family = socket.AF_INET6 if ':' in str(host) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, int(port)))
+    sock.listen(LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+class Supervisor(object):
+    '''Supervisor forks worker processes and keeps them running.
+
+    Each worker calls `target(index)` and should serve until told to stop.
+    Crashed workers are restarted, SIGTERM/SIGINT stop all of them and SIGHUP
+    is forwarded to every worker.
+
+    The parent process never runs an event loop, so every worker builds its
+    own loop, client sessions and caches after the fork.
+    '''
+
+    def __init__(self, target, count):
+        self.target = target
+        self.count = count
+        self._workers = {}   # pid -> (index, start time)
+        self._failures = {}  # index -> consecutive quick exits
+        self._stopping = False
+
+    def run(self):
+        '''Start the workers and block until all of them are stopped.
+        '''
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_hup)
+        for index in range(self.count):
+            self._spawn(index)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            try:
+                index, started = self._workers.pop(pid)
+            except KeyError:
+                continue
+            if self._stopping:
+                continue
+            log.warning('Worker %d (pid %d) %s' % (index, pid, describe_status(status)))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME_SEC:
+                self._failures[index] = self._failures.get(index, 0) + 1
+                delay = min(2 ** self._failures[index], MAX_RESTART_DELAY_SEC)
+                log.warning('Worker %d is crashing on startup, restarting in %ds' % (index, delay))
+                time.sleep(delay)
+                if self._stopping:
+                    continue
+            else:
+                self._failures[index] = 0
+            self._spawn(index)
+        log.info('All workers stopped')
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for signum in (signal.SIGTERM, signal.SIGINT):
+                    signal.signal(signum, signal.SIG_DFL)
+                # A SIGHUP forwarded before the worker's loop handles it
+                # (see OpenWeixinScorer.make_app) must not kill it
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                self.target(index)
+            except BaseException:
+                log.exception('Worker %d failed' % index)
+                code = 1
+            finally:
+                # Never return into the supervisor's code in the child
+                os._exit(code)
+        self._workers[pid] = (index, time.monotonic())
+        log.info('Started worker %d (pid %d)' % (index, pid))
+
+    def _signal_workers(self, signum):
+        for pid in list(self._workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _on_stop(self, signum, frame):
+        if not self._stopping:
+            log.info('Stopping %d workers' % len(self._workers))
+        self._stopping = True
+        self._signal_workers(signal.SIGTERM)
+
+    def _on_hup(self, signum, frame):
+        log.info('Forwarding SIGHUP to %d workers' % len(self._workers))
+        self._signal_workers(signal.SIGHUP)
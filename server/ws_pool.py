@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+import weakref
+
+log = logging.getLogger()
+
+def is_healthy(ws):
+    '''Tell whether an idle, already-upgraded WebSocket can still be used.
+
+    Nothing is read from the socket, so a socket the peer closed while idle
+    may look healthy until it is used; see WebSocketPool.lent.
+    '''
+
+    return not ws.closed and ws.exception() is None
+
+class PoolStats(object):
+    '''Counters of one scorer URL in WebSocketPool.
+    '''
+
+    def __init__(self):
+        self.hits = 0        # acquire() served by an idle socket
+        self.misses = 0      # acquire() had to dial
+        self.dials = 0       # background dials that succeeded
+        self.dial_errors = 0 # background dials that failed
+        self.expired = 0     # idle sockets closed for age
+        self.discarded = 0   # idle sockets closed for failing the health check
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class WebSocketPool(object):
+    '''WebSocketPool keeps idle WebSocket connections to scorer URLs.
+
+    Every scoring request uses its own connection, so sockets are never given
+    back; instead the pool dials new ones in the background to keep `size`
+    idle sockets per URL. Idle sockets are health-checked every
+    `check_interval_sec` and closed once older than `max_idle_sec`.
+    '''
+
+    def __init__(self, connect, urls, size=2, max_idle_sec=20, check_interval_sec=5):
+        '''
+        Arguments:
+        connect            -- coroutine function taking a URL and returning a
+                              connected aiohttp ClientWebSocketResponse
+        urls               -- the URLs to keep sockets for
+        size               -- idle sockets to keep per URL
+        max_idle_sec       -- close idle sockets older than this
+        check_interval_sec -- how often idle sockets are checked
+        '''
+
+        self._connect = connect
+        self.size = int(size)
+        self.max_idle_sec = float(max_idle_sec)
+        self.check_interval_sec = float(check_interval_sec)
+        self._idle = {}  # url -> list of (ws, connected_at), oldest first
+        self._stats = {}
+        self._refilling = set()
+        self._failed_at = {} # url -> time of the last failed dial
+        self._lent = weakref.WeakSet() # idle sockets handed out by acquire()
+        self._task = None
+        for url in urls:
+            self._idle.setdefault(url, [])
+            self._stats.setdefault(url, PoolStats())
+
+    def start(self):
+        '''Fill the pool and start the maintenance task.
+        '''
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._maintain())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for url, idle in self._idle.items():
+            for ws, _ in idle:
+                await ws.close()
+            idle.clear()
+
+    def update(self, urls, size, max_idle_sec, check_interval_sec):
+        '''Apply new settings. Idle sockets of URLs still in `urls` are kept;
+        those of the other URLs are closed.
+        '''
+
+        self.size = int(size)
+        self.max_idle_sec = float(max_idle_sec)
+        self.check_interval_sec = float(check_interval_sec)
+        for url in list(self._idle):
+            if url not in urls:
+                for ws, _ in self._idle.pop(url):
+                    asyncio.ensure_future(ws.close())
+                self._stats.pop(url, None)
+                self._failed_at.pop(url, None)
+        for url in urls:
+            if url not in self._idle:
+                self._idle[url] = []
+                self._stats[url] = PoolStats()
+                self._schedule_refill(url, force=True)
+
+    async def acquire(self, url):
+        '''Return a connected WebSocket for `url`, dialing if no idle one is
+        available. The caller owns (and must close) the returned socket.
+        '''
+
+        stats = self._stats.setdefault(url, PoolStats())
+        idle = self._idle.get(url)
+        now = time.monotonic()
+        while idle:
+            # Newest first: it is the least likely to be timed out by the peer
+            ws, connected_at = idle.pop()
+            if now - connected_at < self.max_idle_sec and is_healthy(ws):
+                stats.hits += 1
+                self._schedule_refill(url)
+                self._lent.add(ws)
+                return ws
+            stats.discarded += 1
+            asyncio.ensure_future(ws.close())
+        stats.misses += 1
+        if idle is not None:
+            self._schedule_refill(url)
+        return await self._connect(url)
+
+    def lent(self, ws):
+        '''Tell whether `ws` was an idle socket handed out by acquire(), as
+        opposed to one dialed for the caller. Such a socket may turn out to be
+        closed by the peer on its first send or receive.
+        '''
+
+        return ws in self._lent
+
+    def stats(self):
+        '''Return {url: {counter: value, 'idle': n}}.
+        '''
+
+        ret = {}
+        for url, stats in self._stats.items():
+            ret[url] = stats.as_dict()
+            ret[url]['idle'] = len(self._idle.get(url, ()))
+        return ret
+
+    def _schedule_refill(self, url, force=False):
+        if self._task is None or url in self._refilling:
+            return
+        # After a failed dial, leave retrying to the maintenance task
+        if not force and time.monotonic() - self._failed_at.get(url, 0) < self.check_interval_sec:
+            return
+        self._refilling.add(url)
+        asyncio.ensure_future(self._refill(url))
+
+    async def _refill(self, url):
+        try:
+            idle = self._idle.get(url)
+            if idle is None:
+                return
+            stats = self._stats[url]
+            missing = self.size - len(idle)
+            if missing <= 0:
+                return
+            results = await asyncio.gather(
+                *[self._connect(url) for _ in range(missing)],
+                return_exceptions=True,
+            )
+            now = time.monotonic()
+            for ws in results:
+                if isinstance(ws, BaseException):
+                    stats.dial_errors += 1
+                    self._failed_at[url] = now
+                    log.warning('Unable to pre-connect to %s: %r' % (url, ws))
+                    continue
+                if self._task is None or self._idle.get(url) is not idle:
+                    # The pool was closed (or the URL dropped) meanwhile
+                    await ws.close()
+                    continue
+                stats.dials += 1
+                idle.append((ws, now))
+        finally:
+            self._refilling.discard(url)
+
+    async def _maintain(self):
+        while True:
+            now = time.monotonic()
+            dead = []
+            for url, idle in self._idle.items():
+                keep = []
+                for ws, connected_at in idle:
+                    if now - connected_at >= self.max_idle_sec:
+                        self._stats[url].expired += 1
+                        dead.append(ws)
+                    elif not is_healthy(ws):
+                        self._stats[url].discarded += 1
+                        dead.append(ws)
+                    else:
+                        keep.append((ws, connected_at))
+                idle[:] = keep
+                self._schedule_refill(url, force=True)
+            for ws in dead:
+                await ws.close()
+            await asyncio.sleep(self.check_interval_sec)
@@ -1,10 +1,30 @@
 import asyncio
+import json
+import time
 
 import aiohttp
 
+from . import metrics
+
 READ_TIMEOUT = 10
 WX_SPEEX_FRAME_SIZE = 60
 WX_SPEEX_CONTENT_TYPE = 'voice/speex'
+# Bytes asked from the response stream per read (about 5 seconds of audio)
+READ_BLOCK_SIZE = 16384
+# Size of the frame length field in the Liulishuo speex variant
+FRAME_LENGTH_SIZE = 4
+# Audio in each speex frame
+FRAME_DURATION_SEC = 0.02
+
+def estimate_duration(size, framed=False):
+    '''Return the seconds of audio in `size` bytes of WeChat speex (or, with
+    framed, of the Liulishuo variant), or None if size is unknown.
+    '''
+
+    if size is None:
+        return None
+    frame_size = WX_SPEEX_FRAME_SIZE + (FRAME_LENGTH_SIZE if framed else 0)
+    return size / frame_size * FRAME_DURATION_SEC
 
 class WeixinResponseError(Exception):
     '''This exception is thrown when WeChat did not respond with 200 and
@@ -21,7 +41,55 @@ class WeixinResponseError(Exception):
         self.status = status
         self.content_type = content_type
 
-async def download_audio(session, url):
+    @property
+    def errcode(self):
+        '''The `errcode` field of WeChat's JSON error body, or None.
+        '''
+
+        try:
+            return int(json.loads(str(self))['errcode'])
+        except (ValueError, TypeError, KeyError):
+            return None
+
+class SpeexFramer(object):
+    '''SpeexFramer cuts a raw WeChat speex stream into fixed-size frames and
+    puts a length field (Liulishuo convention) before each of them.
+
+    Data may be fed in blocks of any size; a frame spanning two blocks is kept
+    until it is complete.
+    '''
+
+    def __init__(self, frame_size=WX_SPEEX_FRAME_SIZE):
+        self.frame_size = frame_size
+        self._header = frame_size.to_bytes(FRAME_LENGTH_SIZE, 'little')
+        self._pending = b''
+
+    def feed(self, block):
+        '''Return the framed bytes of every frame completed by `block`.
+        '''
+
+        if self._pending:
+            block = self._pending + block
+        size = len(block) - len(block) % self.frame_size
+        self._pending = bytes(block[size:])
+        if size == 0:
+            return b''
+        view = memoryview(block)
+        # join() puts the length field before every frame (the leading empty
+        # item makes it appear before the first one too).
+        frames = [view[i:i+self.frame_size] for i in range(0, size, self.frame_size)]
+        return self._header.join([b''] + frames)
+
+    def flush(self):
+        '''Return the trailing partial frame (with its own length), if any.
+        '''
+
+        tail, self._pending = self._pending, b''
+        if not tail:
+            return b''
+        return len(tail).to_bytes(FRAME_LENGTH_SIZE, 'little') + tail
+
+async def download_audio(session, url, block_size=READ_BLOCK_SIZE, trace=None):
     '''Download audio from WeChat media server `url` and convert it to Liulishuo
     variant of speex format.
     At the time of writing, the "Fetching 'High-Definition' Voice Assets" API is
@@ -32,20 +100,142 @@ async def download_audio(session, url):
     OpenAPI does not support AMR format and only speex will be recognized.
     During my tests, the so-called "High-Definition' assets are encoded by speex
     VBR Quality 7 (60 bytes per 20ms frame). Liulishuo accepts any Quality from
-    0 to 10, but requires a Length-Value encoding for each frame, so insertion
-    of frame length field is done at the end of loop body.
+    0 to 10, but requires a Length-Value encoding for each frame, which is what
+    SpeexFramer does. Every chunk yielded holds all frames completed by one
+    read, so a fast download produces few, large chunks.
 
     Arguments:
-    session -- aiohttp.client.ClientSession object
-    url     -- anything that session.get() accepts
+    session    -- aiohttp.client.ClientSession object
+    url        -- anything that session.get() accepts
+    block_size -- maximum bytes to read from the response at a time
+    trace      -- optional server.metrics.RequestTrace to time the download
     '''
-    async with session.get(url, timeout=READ_TIMEOUT) as rsp:
+
+    stream = await open_audio(session, url, block_size, trace)
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.close()
+
+async def open_audio(session, url, block_size=READ_BLOCK_SIZE, trace=None, timeout=READ_TIMEOUT):
+    '''Start downloading audio (see download_audio) and return an AudioStream
+    once WeChat's response headers are checked. Raise WeixinResponseError if
+    WeChat did not send voice/speex contents. The whole download, body
+    included, must be done within `timeout` seconds.
+    '''
+
+    started = time.monotonic()
+    context = session.get(url, timeout=aiohttp.ClientTimeout(total=timeout))
+    rsp = await context.__aenter__()
+    if trace is not None:
+        trace.mark(metrics.STAGE_WX_FIRST_BYTE, time.monotonic() - started)
+    try:
         if rsp.status != 200 or rsp.content_type != WX_SPEEX_CONTENT_TYPE:
             body = await rsp.text()
             raise WeixinResponseError(body, rsp.status, rsp.content_type)
-        while True:
-            chunk = await rsp.content.read(WX_SPEEX_FRAME_SIZE)
-            if not chunk:
+    except BaseException:
+        await context.__aexit__(None, None, None)
+        raise
+    return AudioStream(context, rsp, block_size, trace, started)
+
+async def probe_size(session, url, timeout=READ_TIMEOUT):
+    '''Ask WeChat for the size of the audio at `url` with a HEAD request, and
+    return its Content-Length, or None if WeChat did not tell it (an error,
+    or no voice/speex contents). No body is read.
+    '''
+
+    async with session.head(url, timeout=aiohttp.ClientTimeout(total=timeout)) as rsp:
+        if rsp.status != 200 or rsp.content_type != WX_SPEEX_CONTENT_TYPE:
+            return None
+        return rsp.content_length
+
+class AudioStream(object):
+    '''AudioStream iterates over the framed audio of a checked WeChat
+    response. Its owner must close() it, iterated to the end or not.
+
+    `size` is the response's Content-Length, and `duration_sec` the length
+    of the audio estimated from it; both are None if WeChat sent none.
+    '''
+
+    def __init__(self, context, rsp, block_size, trace, started):
+        self._context = context
+        self._rsp = rsp
+        self.size = rsp.content_length
+        self.duration_sec = estimate_duration(self.size)
+        self._block_size = block_size
+        self._trace = trace
+        self._started = started
+        self._framer = SpeexFramer()
+        self._eof = False
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._eof:
+            block = await self._rsp.content.read(self._block_size)
+            if not block:
+                self._eof = True
+                if self._trace is not None:
+                    self._trace.mark(metrics.STAGE_WX_DOWNLOAD,
+                        time.monotonic() - self._started)
+                chunk = self._framer.flush()
+                if chunk:
+                    return chunk
                 break
-            # Add length field before the chunk (Liulishuo convention)
-            yield len(chunk).to_bytes(4, 'little') + chunk
+            chunk = self._framer.feed(block)
+            if chunk:
+                return chunk
+        raise StopAsyncIteration
+
+    async def close(self):
+        if not self._closed:
+            self._closed = True
+            await self._context.__aexit__(None, None, None)
+
+# Marks the end of the audio in a Prefetcher queue
+_END_OF_AUDIO = object()
+
+class Prefetcher(object):
+    '''Prefetcher reads an async iterator of chunks in a background task,
+    from the moment it is created, into a queue of at most `max_chunks`
+    chunks. Reading stops while the queue is full, so a slow consumer slows
+    the download down instead of growing the buffer.
+
+    Iterate over it to get the chunks (an error of the source is raised
+    there) and close() it when done.
+    '''
+
+    def __init__(self, chunks, max_chunks):
+        self._queue = asyncio.Queue(max(1, int(max_chunks)))
+        self._finished = False
+        self._task = asyncio.ensure_future(self._produce(chunks))
+
+    async def _produce(self, chunks):
+        try:
+            async for chunk in chunks:
+                await self._queue.put(chunk)
+        except Exception as e:
+            await self._queue.put(e)
+            return
+        await self._queue.put(_END_OF_AUDIO)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished:
+            raise StopAsyncIteration
+        item = await self._queue.get()
+        if item is _END_OF_AUDIO:
+            self._finished = True
+            raise StopAsyncIteration
+        if isinstance(item, Exception):
+            self._finished = True
+            raise item
+        return item
+
+    def close(self):
+        self._task.cancel()
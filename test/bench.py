@@ -0,0 +1,325 @@
+'''End-to-end benchmark of OpenWeixinScorer against local mocks.
+
+A mock WeChat media server (serving voice/speex clips of a given length at a
+given bandwidth) and a mock WebSocket scorer (answering after a given think
+time) run in a child process. The scorer runs either in this process or as
+a supervisor with worker processes, and is loaded with every concurrency
+level of the sweep in turn. Results are printed (or written) as JSON:
+
+    {"settings": {...}, "results": [{"concurrency": 16, "qps": ...,
+     "latency_ms": {"p50": ..., "p95": ..., "p99": ..., "max": ...},
+     "cpu_ms_per_request": ..., "peak_rss_mb": ..., ...}, ...]}
+
+In-process, CPU and RSS are those of this process, so they include the load
+generator; with --workers they are summed over the worker processes (read
+from /proc, so Linux only). Every request uses its own mediaId, so the
+result cache and request coalescing never kick in.
+
+Usage: ``` bash
+python test/bench.py [--concurrency 1,8,32,128] [--duration 10] [--workers 0]
+    [--clip-sec 7] [--bandwidth 0] [--think-ms 200] [--set pipelined=true]
+    [--output report.json]
+```
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import sys
+import time
+
+import aiohttp
+import yaml
+from aiohttp import web
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from server import cfg, http_handler, workers, wx_http_client
+
+HOST = '127.0.0.1'
+META = 'eyJpdGVtIjp7InR5cGUiOiJyZWFkYWxvdWQiLCJxdWFsaXR5Ijo3LCJyZWZ0ZXh0IjoiaGVsbG8ifX0K'
+RESULT = b'{"status":0,"result":{"overall":80}}'
+# Bytes written by the mock WeChat server at a time when throttled
+MOCK_WRITE_SIZE = 4096
+STARTUP_TIMEOUT_SEC = 10
+
+def make_mock_app(clip, bandwidth, think_sec):
+    '''Create the mock WeChat (GET /media) and scorer (WS /scorer) app.
+    '''
+
+    async def media(request):
+        if bandwidth <= 0:
+            return web.Response(body=clip, content_type=wx_http_client.WX_SPEEX_CONTENT_TYPE)
+        rsp = web.StreamResponse(headers={'Content-Type': wx_http_client.WX_SPEEX_CONTENT_TYPE})
+        rsp.content_length = len(clip)
+        await rsp.prepare(request)
+        for i in range(0, len(clip), MOCK_WRITE_SIZE):
+            chunk = clip[i:i+MOCK_WRITE_SIZE]
+            await rsp.write(chunk)
+            await asyncio.sleep(len(chunk) / bandwidth)
+        await rsp.write_eof()
+        return rsp
+
+    async def scorer(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.BINARY or msg.data == b'EOS':
+                break
+        if think_sec > 0:
+            await asyncio.sleep(think_sec)
+        try:
+            await ws.send_bytes(len(RESULT).to_bytes(4, 'big') + RESULT)
+            await ws.close()
+        except (ConnectionError, RuntimeError):
+            pass
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/media', media)
+    app.router.add_get('/scorer', scorer)
+    return app
+
+def free_port():
+    sock = workers.bind_socket(HOST, 0)
+    try:
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+def wait_for_port(port):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SEC
+    while True:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class ProcessStats(object):
+    '''CPU seconds and peak RSS of this process or of a process's children.
+    '''
+
+    def __init__(self, parent_pid=None):
+        self.parent_pid = parent_pid
+
+    def _children(self):
+        pids = []
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == self.parent_pid:
+                pids.append(int(name))
+        return pids
+
+    def cpu_sec(self):
+        if self.parent_pid is None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            return usage.ru_utime + usage.ru_stime
+        ticks = 0
+        for pid in self._children():
+            try:
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            ticks += int(fields[11]) + int(fields[12]) # utime, stime
+        return ticks / os.sysconf('SC_CLK_TCK')
+
+    def peak_rss_mb(self):
+        if self.parent_pid is None:
+            # ru_maxrss is in KiB on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        total_kb = 0
+        for pid in self._children():
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            total_kb += int(line.split()[1])
+            except OSError:
+                continue
+        return total_kb / 1024
+
+async def run_level(url, concurrency, duration, counter):
+    '''Keep `concurrency` requests in flight for `duration` seconds and
+    return (latencies in seconds, error count).
+    '''
+
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def client():
+            while time.monotonic() < deadline:
+                counter[0] += 1
+                body = json.dumps({'mediaId': 'M%d' % counter[0], 'meta': META,
+                    'accessToken': 'TOKEN'})
+                started = time.monotonic()
+                try:
+                    async with session.post(url, data=body) as rsp:
+                        await rsp.read()
+                        ok = rsp.status == 200
+                except aiohttp.ClientError:
+                    ok = False
+                if ok:
+                    latencies.append(time.monotonic() - started)
+                else:
+                    errors.append(1)
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+    return sorted(latencies), len(errors)
+
+async def sweep(url, levels, duration, stats):
+    results = []
+    counter = [0]
+    # Warm-up: connections, pools and code paths
+    await run_level(url, min(levels), 1, counter)
+    for concurrency in levels:
+        cpu_before = stats.cpu_sec()
+        started = time.monotonic()
+        latencies, errors = await run_level(url, concurrency, duration, counter)
+        elapsed = time.monotonic() - started
+        cpu = stats.cpu_sec() - cpu_before
+        done = len(latencies)
+        results.append({
+            'concurrency':        concurrency,
+            'requests':           done,
+            'errors':             errors,
+            'qps':                done / elapsed,
+            'latency_ms':         {
+                'p50': percentile(latencies, 0.50) * 1000 if done else None,
+                'p95': percentile(latencies, 0.95) * 1000 if done else None,
+                'p99': percentile(latencies, 0.99) * 1000 if done else None,
+                'max': latencies[-1] * 1000 if done else None,
+            },
+            'cpu_ms_per_request': cpu * 1000 / done if done else None,
+            'peak_rss_mb':        stats.peak_rss_mb(),
+        })
+    return results
+
+def make_config(mock_port, port, worker_count, entries):
+    config = dict(
+        listen_addr=HOST,
+        listen_port=port,
+        workers=max(1, worker_count),
+        audio_download_url='http://%s:%d/media' % (HOST, mock_port),
+        scorer_url='ws://%s:%d/scorer' % (HOST, mock_port),
+        result_cache_size=0,
+        dedup_inflight_requests=False,
+    )
+    config.update(entries)
+    return cfg.ScorerConfig(**config)
+
+async def bench_in_process(config, levels, duration):
+    scorer = http_handler.OpenWeixinScorer(config)
+    runner = web.AppRunner(scorer.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, HOST, int(config.listen_port))
+    await site.start()
+    try:
+        url = 'http://%s:%s%s' % (HOST, config.listen_port, scorer.REQUEST_ENDPOINT)
+        return await sweep(url, levels, duration, ProcessStats())
+    finally:
+        await runner.cleanup()
+
+def bench_workers(config, levels, duration):
+    scorer = http_handler.OpenWeixinScorer(config)
+    process = multiprocessing.Process(target=scorer.run)
+    process.start()
+    try:
+        wait_for_port(int(config.listen_port))
+        url = 'http://%s:%s%s' % (HOST, config.listen_port, scorer.REQUEST_ENDPOINT)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                sweep(url, levels, duration, ProcessStats(process.pid)))
+        finally:
+            loop.close()
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(STARTUP_TIMEOUT_SEC)
+
+def serve_mocks(sock, clip, bandwidth, think_sec):
+    web.run_app(make_mock_app(clip, bandwidth, think_sec), sock=sock, print=None,
+        handle_signals=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', default='1,8,32,128',
+        help='comma-separated concurrency levels to sweep')
+    parser.add_argument('--duration', type=float, default=10,
+        help='seconds per concurrency level')
+    parser.add_argument('--workers', type=int, default=0,
+        help='worker processes (0 runs the scorer in this process)')
+    parser.add_argument('--clip-sec', type=float, default=7, help='audio length')
+    parser.add_argument('--bandwidth', type=float, default=0,
+        help='bytes per second of each WeChat download (0 for unlimited)')
+    parser.add_argument('--think-ms', type=float, default=200,
+        help='scorer time between EOS and its answer')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+        help='scorer config entry (value in YAML), e.g. --set pipelined=true')
+    parser.add_argument('--output', help='write the report here instead of stdout')
+    args = parser.parse_args()
+    levels = [int(c) for c in args.concurrency.split(',')]
+    entries = {}
+    for entry in args.set:
+        key, _, value = entry.partition('=')
+        entries[key] = yaml.safe_load(value)
+
+    clip = os.urandom(int(args.clip_sec * 50) * wx_http_client.WX_SPEEX_FRAME_SIZE)
+    mock_sock = workers.bind_socket(HOST, 0)
+    mock_port = mock_sock.getsockname()[1]
+    mocks = multiprocessing.Process(target=serve_mocks,
+        args=(mock_sock, clip, args.bandwidth, args.think_ms / 1000))
+    mocks.start()
+    mock_sock.close()
+    try:
+        wait_for_port(mock_port)
+        config = make_config(mock_port, free_port(), args.workers, entries)
+        if args.workers > 0:
+            results = bench_workers(config, levels, args.duration)
+        else:
+            loop = asyncio.get_event_loop()
+            results = loop.run_until_complete(bench_in_process(config, levels, args.duration))
+    finally:
+        mocks.terminate()
+        mocks.join()
+
+    report = json.dumps({
+        'settings': {
+            'workers':     args.workers,
+            'clip_sec':    args.clip_sec,
+            'bandwidth':   args.bandwidth,
+            'think_ms':    args.think_ms,
+            'duration':    args.duration,
+            'config':      entries,
+            'python':      sys.version.split()[0],
+            'aiohttp':     aiohttp.__version__,
+        },
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''CPU cost of relaying one WeChat voice message to the scorer.
+
+Compares the original relay (one 60-byte read and one WS message per frame)
+with the current one (block reads, SpeexFramer and coalesced WS messages). No
+network is involved: WeChat's response body and the scorer's socket are
+in-memory fakes, so the numbers are pure relay CPU.
+
+Usage: ``` bash
+python test/bench_relay.py [--seconds 60] [--requests 200] [--segment 1460]
+```
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from server import lls_ws_client, wx_http_client
+
+class FakeContent(object):
+    '''Response body that arrives in `segment`-byte network segments.
+    '''
+
+    def __init__(self, data, segment):
+        self._data = data
+        self._segment = segment
+        self._pos = 0
+        self._avail = 0
+
+    async def read(self, n):
+        if self._pos >= len(self._data):
+            return b''
+        if self._avail == 0:
+            await asyncio.sleep(0) # Wait for the next segment
+            self._avail = min(self._segment, len(self._data) - self._pos)
+        n = min(n, self._avail)
+        ret = self._data[self._pos:self._pos+n]
+        self._pos += n
+        self._avail -= n
+        return ret
+
+class FakeResponse(object):
+    status = 200
+    content_type = wx_http_client.WX_SPEEX_CONTENT_TYPE
+
+    def __init__(self, data, segment):
+        self.content = FakeContent(data, segment)
+        self.content_length = len(data)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+class FakeWebSocket(object):
+    RESULT = b'{"status":0}'
+
+    def __init__(self):
+        self.messages = 0
+
+    async def send_bytes(self, data):
+        self.messages += 1
+        await asyncio.sleep(0) # Writing to the transport may yield
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __await__(self):
+        # get_score awaits ws_connect() rather than using it as a context
+        return self.__aenter__().__await__()
+
+    async def close(self):
+        pass
+
+    def __aiter__(self):
+        return self._receive()
+
+    async def _receive(self):
+        class Msg(object):
+            type = lls_ws_client.aiohttp.WSMsgType.BINARY
+            data = len(self.RESULT).to_bytes(4, 'big') + self.RESULT
+        yield Msg()
+
+class FakeSession(object):
+    def __init__(self, data, segment):
+        self._data = data
+        self._segment = segment
+        self.last_ws = None
+
+    def get(self, url, **kwargs):
+        return FakeResponse(self._data, self._segment)
+
+    def ws_connect(self, url, **kwargs):
+        self.last_ws = FakeWebSocket()
+        return self.last_ws
+
+async def legacy_download_audio(session, url):
+    '''download_audio as it was before block reads.
+    '''
+
+    async with session.get(url, timeout=wx_http_client.READ_TIMEOUT) as rsp:
+        while True:
+            chunk = await rsp.content.read(wx_http_client.WX_SPEEX_FRAME_SIZE)
+            if not chunk:
+                break
+            yield len(chunk).to_bytes(4, 'little') + chunk
+
+async def legacy_get_score(session, endpoint, meta, audio_iter):
+    '''get_score as it was before coalescing (one WS message per frame).
+    '''
+
+    async with session.ws_connect(endpoint) as ws:
+        meta_bin = meta.encode()
+        await ws.send_bytes(len(meta_bin).to_bytes(4, 'big') + meta_bin)
+        async for chunk in audio_iter:
+            await ws.send_bytes(chunk)
+        await ws.send_bytes(b'EOS')
+        ret = b''
+        async for msg in ws:
+            ret += msg.data
+        return ret[4:]
+
+async def relay_legacy(session):
+    return await legacy_get_score(session, 'ws://scorer', '{}',
+        legacy_download_audio(session, 'http://wechat'))
+
+async def relay_current(session):
+    return await lls_ws_client.get_score(session, 'ws://scorer', '{}',
+        wx_http_client.download_audio(session, 'http://wechat'))
+
+def measure(relay, data, segment, requests):
+    loop = asyncio.new_event_loop()
+    try:
+        session = FakeSession(data, segment)
+        loop.run_until_complete(relay(session)) # Warm-up
+        start = time.process_time()
+        for _ in range(requests):
+            loop.run_until_complete(relay(session))
+        cpu = time.process_time() - start
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+    return {
+        'cpu_ms_per_request': cpu * 1000 / requests,
+        'ws_messages':        session.last_ws.messages,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=int, default=60, help='audio length')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--segment', type=int, default=1460,
+        help='bytes that arrive from WeChat at a time')
+    args = parser.parse_args()
+
+    data = os.urandom(args.seconds * 50 * wx_http_client.WX_SPEEX_FRAME_SIZE)
+    before = measure(relay_legacy, data, args.segment, args.requests)
+    after = measure(relay_current, data, args.segment, args.requests)
+    print(json.dumps({
+        'audio_seconds': args.seconds,
+        'before':        before,
+        'after':         after,
+        'speedup':       before['cpu_ms_per_request'] / after['cpu_ms_per_request'],
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+'''Replay traffic recorded by the scorer against local mocks.
+
+Records come from a file written with traffic_record_path (see
+server.recorder.TrafficRecorder). Each record becomes a request sent at its
+recorded arrival time, divided by --speed, whatever the answers to earlier
+ones. A mock WeChat media server and a mock WebSocket scorer run in a child
+process and answer each request the way its upstreams did when it was
+recorded:
+- the download has the recorded audio size, first byte delay and
+  download time;
+- the scorer thinks for the recorded scorer_response time;
+- a request that got a WeChat error gets one again.
+Meta has the recorded question type and size. The results are printed (or
+written) as JSON, next to the recorded latencies:
+
+    {"settings": {...}, "recorded": {"requests": ..., "latency_ms": {...}},
+     "replayed": {"requests": ..., "errors": ..., "qps": ...,
+     "latency_ms": {"p50": ..., ...}, "by_type": {...}}}
+
+Requests carry an accessToken, so no token service is needed. Every
+request uses its own mediaId, and the result cache and request coalescing
+are off (see bench.py).
+
+Usage: ``` bash
+python test/replay.py traffic.jsonl [--speed 1] [--limit 0] [--workers 0]
+    [--set scorer_max_concurrency=50] [--output report.json]
+```
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import aiohttp
+import yaml
+from aiohttp import web
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from server import http_handler, metrics, recorder, workers, wx_http_client
+from bench import HOST, MOCK_WRITE_SIZE, RESULT, STARTUP_TIMEOUT_SEC, ProcessStats, free_port, make_config, percentile, wait_for_port
+
+# Audio of records that have neither size nor length (seconds)
+DEFAULT_AUDIO_SEC = 7
+# Error WeChat answers for records that got one
+WX_ERROR_BODY = '{"errcode":40007,"errmsg":"invalid media_id"}'
+
+def audio_size(record):
+    if record.get('audio') is not None:
+        return int(record['audio'])
+    audio_sec = record.get('audio_sec')
+    if audio_sec is None:
+        audio_sec = DEFAULT_AUDIO_SEC
+    frames = int(audio_sec / wx_http_client.FRAME_DURATION_SEC)
+    return frames * wx_http_client.WX_SPEEX_FRAME_SIZE
+
+def stage_sec(record, stage):
+    return (record.get('stages') or {}).get(stage, 0) / 1000
+
+def make_meta(record, index):
+    '''Return Base64 meta of the record's question type and about its size,
+    telling the mock scorer which record it belongs to.
+    '''
+
+    meta = {'item': {'type': record.get('type') or 'readaloud', 'reftext': ''}, 'replay': index}
+    size = len(json.dumps(meta))
+    # Base64 makes 4 bytes of every 3
+    padding = int(record.get('meta') or 0) * 3 // 4 - size
+    meta['item']['reftext'] = 'x' * max(0, padding)
+    return base64.b64encode(json.dumps(meta).encode()).decode()
+
+def make_mock_app(records):
+    '''Create the mock WeChat (GET /media?media_id=R<index>) and scorer
+    (WS /scorer) app, answering as recorded.
+    '''
+
+    async def media(request):
+        record = records[int(request.query['media_id'][1:])]
+        await asyncio.sleep(stage_sec(record, metrics.STAGE_WX_FIRST_BYTE))
+        if record.get('outcome') == metrics.OUTCOME_WEIXIN_ERROR:
+            return web.Response(text=WX_ERROR_BODY, content_type='application/json')
+        size = audio_size(record)
+        rsp = web.StreamResponse(headers={'Content-Type': wx_http_client.WX_SPEEX_CONTENT_TYPE})
+        rsp.content_length = size
+        await rsp.prepare(request)
+        # The download stage includes the first byte
+        download_sec = max(0.0, stage_sec(record, metrics.STAGE_WX_DOWNLOAD) -
+            stage_sec(record, metrics.STAGE_WX_FIRST_BYTE))
+        writes = max(1, -(-size // MOCK_WRITE_SIZE))
+        for i in range(0, size, MOCK_WRITE_SIZE):
+            await rsp.write(os.urandom(min(MOCK_WRITE_SIZE, size - i)))
+            if download_sec > 0:
+                await asyncio.sleep(download_sec / writes)
+        await rsp.write_eof()
+        return rsp
+
+    async def scorer(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        record = None
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.BINARY or msg.data == b'EOS':
+                break
+            if record is None:
+                # The first message is the meta, after its length
+                meta = json.loads(base64.b64decode(msg.data[4:]))
+                record = records[meta['replay']]
+        if record is not None:
+            await asyncio.sleep(stage_sec(record, metrics.STAGE_SCORER_RESPONSE))
+        try:
+            await ws.send_bytes(len(RESULT).to_bytes(4, 'big') + RESULT)
+            await ws.close()
+        except (ConnectionError, RuntimeError):
+            pass
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/media', media)
+    app.router.add_get('/scorer', scorer)
+    return app
+
+def serve_mocks(sock, records):
+    web.run_app(make_mock_app(records), sock=sock, print=None, handle_signals=True)
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return None
+    return {
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': latencies[-1] * 1000,
+    }
+
+async def replay(url, records, speed, stats):
+    '''Send every record at its (sped up) time and return the report of the
+    replay.
+    '''
+
+    by_type = {}
+    errors = []
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def send(index, record):
+            body = json.dumps({'mediaId': 'R%d' % index, 'meta': make_meta(record, index),
+                'accessToken': 'TOKEN'})
+            started = time.monotonic()
+            try:
+                async with session.post(url, data=body) as rsp:
+                    await rsp.read()
+                    ok = rsp.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            elapsed = time.monotonic() - started
+            if not ok:
+                errors.append(1)
+                return
+            latencies.append(elapsed)
+            by_type.setdefault(record.get('type') or '', []).append(elapsed)
+
+        first = records[0]['t']
+        cpu_before = stats.cpu_sec()
+        started = time.monotonic()
+        futs = []
+        for index, record in enumerate(records):
+            delay = started + (record['t'] - first) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            futs.append(asyncio.ensure_future(send(index, record)))
+        await asyncio.gather(*futs)
+        elapsed = time.monotonic() - started
+        cpu = stats.cpu_sec() - cpu_before
+    return {
+        'requests':           len(records),
+        'errors':             len(errors),
+        'qps':                len(latencies) / elapsed,
+        'latency_ms':         summarize(latencies),
+        'by_type':            {qtype: {'requests': len(values), 'latency_ms': summarize(values)}
+            for qtype, values in sorted(by_type.items())},
+        'cpu_ms_per_request': cpu * 1000 / len(latencies) if latencies else None,
+        'peak_rss_mb':        stats.peak_rss_mb(),
+    }
+
+async def replay_in_process(config, records, speed):
+    scorer = http_handler.OpenWeixinScorer(config)
+    runner = web.AppRunner(scorer.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, HOST, int(config.listen_port))
+    await site.start()
+    try:
+        url = 'http://%s:%s%s' % (HOST, config.listen_port, scorer.REQUEST_ENDPOINT)
+        return await replay(url, records, speed, ProcessStats())
+    finally:
+        await runner.cleanup()
+
+def replay_workers(config, records, speed):
+    scorer = http_handler.OpenWeixinScorer(config)
+    process = multiprocessing.Process(target=scorer.run)
+    process.start()
+    try:
+        wait_for_port(int(config.listen_port))
+        url = 'http://%s:%s%s' % (HOST, config.listen_port, scorer.REQUEST_ENDPOINT)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                replay(url, records, speed, ProcessStats(process.pid)))
+        finally:
+            loop.close()
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(STARTUP_TIMEOUT_SEC)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('records', help='file written with traffic_record_path')
+    parser.add_argument('--speed', type=float, default=1,
+        help='speed-up factor of arrivals (2 sends twice as fast)')
+    parser.add_argument('--limit', type=int, default=0,
+        help='replay only the first N records (0 for all)')
+    parser.add_argument('--workers', type=int, default=0,
+        help='worker processes (0 runs the scorer in this process)')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+        help='scorer config entry (value in YAML), e.g. --set pipelined=true')
+    parser.add_argument('--output', help='write the report here instead of stdout')
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    records = recorder.read_records(args.records)
+    if args.limit > 0:
+        records = records[:args.limit]
+    if not records:
+        parser.error('no records in %s' % args.records)
+    entries = {}
+    for entry in args.set:
+        key, _, value = entry.partition('=')
+        entries[key] = yaml.safe_load(value)
+
+    mock_sock = workers.bind_socket(HOST, 0)
+    mock_port = mock_sock.getsockname()[1]
+    mocks = multiprocessing.Process(target=serve_mocks, args=(mock_sock, records))
+    mocks.start()
+    mock_sock.close()
+    try:
+        wait_for_port(mock_port)
+        config = make_config(mock_port, free_port(), args.workers, entries)
+        if args.workers > 0:
+            replayed = replay_workers(config, records, args.speed)
+        else:
+            loop = asyncio.get_event_loop()
+            replayed = loop.run_until_complete(replay_in_process(config, records, args.speed))
+    finally:
+        mocks.terminate()
+        mocks.join()
+
+    recorded = [record['ms'] / 1000 for record in records
+        if record.get('outcome') == metrics.OUTCOME_OK and 'ms' in record]
+    report = json.dumps({
+        'settings': {
+            'records':     args.records,
+            'speed':       args.speed,
+            'workers':     args.workers,
+            'span_sec':    records[-1]['t'] - records[0]['t'],
+            'config':      entries,
+            'python':      sys.version.split()[0],
+            'aiohttp':     aiohttp.__version__,
+        },
+        'recorded': {
+            'requests':   len(records),
+            'latency_ms': summarize(recorded),
+        },
+        'replayed': replayed,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
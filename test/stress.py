@@ -36,6 +36,10 @@ async def _test(session):
     service.
 
     Logging levels don't seem to have an impact on performance.
+
+    For repeatable numbers without hand-made mocks, use bench.py instead; to
+    load the server the way production does, record traffic with
+    traffic_record_path and play it back with replay.py.
     '''
 
     LOCAL_SERVER_INSTANCE = 'http://localhost:55555/api/ratings'
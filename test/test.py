@@ -1,17 +1,22 @@
 import asyncio
+import base64
 import concurrent.futures
+import json
 import logging
 import os
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 import yaml
 
 from aiohttp import web
-from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
+from aiohttp.test_utils import AioHTTPTestCase, make_mocked_request, unittest_run_loop
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from server import auth_util, cfg, http_handler, lls_ws_client
+from server import admission, audio_cache, auth_util, balancer, breaker, cfg, deadline, fair_queue, hedging, http_handler, jobs, lls_ws_client, log_util, meta_util, metrics, profiling, recorder, result_cache, routing, token_cache, transport, url_util, workers, ws_pool, wx_http_client
 from server.user import lls
 
 import log_opts
@@ -41,9 +46,9 @@ async def mock_ws_handler_normal(request):
             break # Read one message only
         if meta == b'\x00\x00\x00\x02{}':
             await asyncio.sleep(0.2)
-            await ws.send_bytes(len(RSP_BYTES).to_bytes(4, sys.byteorder) + RSP_BYTES)
+            await ws.send_bytes(len(RSP_BYTES).to_bytes(4, 'big') + RSP_BYTES)
         else:
-            await ws.send_bytes(len(WRONG_BYTES).to_bytes(4, sys.byteorder) + WRONG_BYTES)
+            await ws.send_bytes(len(WRONG_BYTES).to_bytes(4, 'big') + WRONG_BYTES)
     finally:
         await ws.close()
     return ws
@@ -52,7 +57,20 @@ async def mock_ws_handler_empty_rsp(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     try:
-        await ws.send_bytes((0).to_bytes(4, sys.byteorder))
+        await ws.send_bytes((0).to_bytes(4, 'big'))
+    finally:
+        await ws.close()
+    return ws
+
+async def mock_ws_handler_truncated_rsp(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    try:
+        async for msg in ws:
+            break
+        # Announce 100 bytes but send 5 in two fragments
+        await ws.send_bytes((100).to_bytes(4, 'big')[:3])
+        await ws.send_bytes((100).to_bytes(4, 'big')[3:] + b'short')
     finally:
         await ws.close()
     return ws
@@ -110,6 +128,597 @@ class TestLLSClientUtils(unittest.TestCase):
         res2 = lls_ws_client.provide_scorer_url(cfg1, self.TEST_META_ACCEPTABLE)
         self.assertEqual(res2, 'test double')
 
+class TestMetaPipeline(unittest.TestCase):
+    '''Test for parsing meta once and the precompiled routes/URL template.
+    '''
+
+    def test_meta_from_base64(self):
+        meta = meta_util.Meta.from_base64(TestLLSClientUtils.TEST_META_WELL_FORMED)
+        self.assertEqual(meta.question_type, 'abc')
+        meta = meta_util.Meta.from_base64(TestLLSClientUtils.TEST_META_MALFORMED)
+        self.assertIsNone(meta.dict)
+        self.assertEqual(meta.question_type, '')
+        with self.assertRaises(meta_util.MetaError):
+            meta_util.Meta.from_base64('not base64!')
+        # A type that is not a string goes to the default route
+        routes = routing.ScorerRoutes(cfg.ScorerConfig(type_specific_scorer_urls={'abc': 'x'}))
+        for qtype in ({'a': 1}, ['abc'], 5):
+            meta = meta_util.Meta('', '', {'item': {'type': qtype}})
+            self.assertEqual(meta.question_type, '')
+            self.assertEqual(routes.url_for(meta.question_type), cfg.ScorerConfig.scorer_url)
+
+    def test_routes(self):
+        cfg1 = cfg.ScorerConfig(type_specific_scorer_urls={'abc': 'test double'})
+        routes = routing.ScorerRoutes(cfg1)
+        self.assertEqual(routes.url_for('abc'), 'test double')
+        self.assertEqual(routes.url_for(''), cfg1.scorer_url)
+        self.assertEqual(routes.urls(), [cfg1.scorer_url, 'test double'])
+        routes = routing.ScorerRoutes(cfg.ScorerConfig(scorer_url=['a', 'b'],
+            type_specific_scorer_urls={'abc': ['b', 'c']}))
+        self.assertEqual(routes.endpoints_for('abc'), ['b', 'c'])
+        self.assertEqual(routes.url_for(''), 'a')
+        self.assertEqual(routes.urls(), ['a', 'b', 'c'])
+
+    def test_url_template(self):
+        for url in ('https://example.com/get', 'https://example.com/get?x=1&media_id=old#frag'):
+            params = {'access_token': 'T K', 'media_id': 'DDD'}
+            self.assertEqual(url_util.URLTemplate(url).build(params),
+                url_util.add_url_params(url, params))
+
+class TestResultCache(unittest.TestCase):
+    '''Test for the server.result_cache module.
+    '''
+
+    def test_request_key(self):
+        meta1 = meta_util.Meta('', '{"a":1,"salt":"x"};hash=1', {'a': 1, 'salt': 'x'})
+        meta2 = meta_util.Meta('', '{"salt":"y","a":1}', {'salt': 'y', 'a': 1})
+        self.assertEqual(result_cache.request_key('m', meta1), result_cache.request_key('m', meta2))
+        self.assertNotEqual(result_cache.request_key('m', meta1), result_cache.request_key('n', meta1))
+
+    def test_is_success(self):
+        self.assertTrue(result_cache.is_success(bytearray(b'{"status":0,"result":{}}')))
+        for rsp in (b'{"status":-1,"msg":"bad audio"}', b'{"msg":""}', b'[]', b'{'):
+            self.assertFalse(result_cache.is_success(rsp))
+
+    def test_lru_bounds(self):
+        cache = result_cache.ResultCache(max_entries=2, max_bytes=10, ttl_sec=60)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        self.assertEqual(cache.get('a'), b'1234') # 'b' is now the oldest
+        cache.put('c', b'1234')                   # Over 10 bytes: evict 'b'
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.bytes, 8)
+        cache.put('d', b'12345678901')            # Too large to cache
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.evictions, 1)
+        cache.ttl_sec = 0
+        cache.put('a', b'1')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_in_flight(self):
+        calls = []
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+        async def run():
+            inflight = result_cache.InFlightRequests()
+            rets = await asyncio.gather(*[inflight.run('k', work) for _ in range(3)])
+            return rets, inflight.stats()
+        loop = asyncio.new_event_loop()
+        try:
+            rets, stats = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual(rets, [1, 1, 1])
+        self.assertEqual((stats['started'], stats['joined'], stats['in_flight']), (1, 2, 0))
+
+    def test_in_flight_deadlines(self):
+        def work(name):
+            async def run():
+                await asyncio.sleep(0.01)
+                return name
+            return run
+        async def run():
+            inflight = result_cache.InFlightRequests()
+            # A caller that may wait longer than the run never joins it
+            return await asyncio.gather(*[inflight.run('k', work(name), expires_at)
+                for name, expires_at in (('a', 10), ('b', 5), ('c', None), ('d', 20))])
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(run()), ['a', 'a', 'c', 'c'])
+        finally:
+            loop.close()
+
+class TestAdmission(unittest.TestCase):
+    '''Test for the server.admission module.
+    '''
+
+    def test_limiter(self):
+        limiter = admission.BackendLimiter(max_concurrency=1, max_queue=1, max_queue_time_sec=0.05)
+        async def run():
+            started = await limiter.acquire()
+            waiter = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            self.assertEqual(limiter.queue_depth, 1)
+            with self.assertRaises(admission.AdmissionRejected):
+                await limiter.acquire() # Queue full
+            limiter.release(started)
+            limiter.release(await waiter)
+            started = await limiter.acquire()
+            with self.assertRaises(admission.AdmissionRejected):
+                await limiter.acquire() # Queued too long
+            limiter.release(started)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+        stats = limiter.stats()
+        self.assertEqual((stats['admitted'], stats['rejected'], stats['timed_out']), (3, 2, 1))
+        self.assertEqual((stats['in_flight'], stats['queue_depth']), (0, 0))
+
+    def test_shortest_first(self):
+        order = []
+        async def request(limiter, name, cost_sec):
+            started = await limiter.acquire(cost_sec)
+            order.append(name)
+            await asyncio.sleep(0.01)
+            limiter.release(started)
+        async def run(sjf_weight, wait_sec=0):
+            limiter = admission.BackendLimiter(1, 10, 5, sjf_weight)
+            blocker = asyncio.ensure_future(request(limiter, 'blocker', None))
+            await asyncio.sleep(0)
+            long = asyncio.ensure_future(request(limiter, 'long', 60))
+            await asyncio.sleep(wait_sec)
+            await asyncio.gather(blocker, long, request(limiter, 'short', 3))
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run(0.1))
+            self.assertEqual(order, ['blocker', 'short', 'long'])
+            order.clear()
+            loop.run_until_complete(run(0)) # FIFO
+            self.assertEqual(order, ['blocker', 'long', 'short'])
+            order.clear()
+            loop.run_until_complete(run(0.001, 0.1)) # Aged enough to go first
+            self.assertEqual(order, ['blocker', 'long', 'short'])
+            # Unknown costs count as the average released
+            limiter = admission.BackendLimiter(1, 10, 5, 0.1)
+            for cost_sec in (10, 20):
+                limiter.release(loop.run_until_complete(limiter.acquire()), cost_sec)
+            self.assertAlmostEqual(limiter.stats()['cost_sec_avg'], 2.9)
+        finally:
+            loop.close()
+        self.assertEqual(wx_http_client.estimate_duration(60 * 50), 1)
+        self.assertEqual(wx_http_client.estimate_duration(64 * 50, framed=True), 1)
+        self.assertEqual(metrics.audio_class(1), 'le5s')
+        self.assertEqual(metrics.audio_class(61), 'gt60s')
+
+class TestBreaker(unittest.TestCase):
+    '''Test for the server.breaker module.
+    '''
+
+    def test_trip_and_probe(self):
+        b = breaker.CircuitBreaker('token', {'min_requests': 4, 'error_percent': 50,
+            'timeout_percent': 0, 'open_sec': 0.05})
+        for failed in (False, True, False, False):
+            b.allow()
+            b.failure() if failed else b.success()
+        self.assertEqual(b.state, breaker.STATE_CLOSED) # 25% failed
+        b.allow()
+        b.failure(timeout=True)
+        b.allow()
+        b.failure()
+        self.assertEqual(b.state, breaker.STATE_OPEN) # 50% failed
+        with self.assertRaises(breaker.CircuitOpen):
+            b.allow()
+        time.sleep(0.05)
+        b.allow() # The probe
+        with self.assertRaises(breaker.CircuitOpen):
+            b.allow() # Only one at a time
+        b.failure()
+        self.assertEqual(b.state, breaker.STATE_OPEN)
+        time.sleep(0.05)
+        b.allow()
+        b.success()
+        self.assertEqual(b.state, breaker.STATE_CLOSED)
+        stats = b.stats()
+        self.assertEqual((stats['trips'], stats['rejected'], stats['timeouts']), (2, 2, 1))
+        with self.assertRaises(ValueError):
+            breaker.BreakerSet({'open_secs': 1})
+
+class TestDeadline(unittest.TestCase):
+    '''Test for the server.deadline module.
+    '''
+
+    def test_budget(self):
+        d = deadline.Deadline(1)
+        self.assertEqual(d.budget('token', 0.2, 0.5), 0.2)
+        self.assertLessEqual(d.budget('download', None, 0.5), 0.5)
+        with self.assertRaises(deadline.DeadlineExceeded) as cm:
+            d.budget('download', 10, 2) # Would leave too little for scoring
+        self.assertEqual(cm.exception.stage, 'download')
+        with self.assertRaises(deadline.DeadlineExceeded):
+            d.require('scoring', 2)
+        async def run():
+            self.assertEqual(await d.run(asyncio.sleep(0, 'done'), 'token'), 'done')
+            with self.assertRaises(asyncio.TimeoutError) as cm:
+                await d.run(asyncio.sleep(1), 'scoring', 0.05)
+            # The stage's cap ran out, not the deadline
+            self.assertNotIsInstance(cm.exception, deadline.DeadlineExceeded)
+            with self.assertRaises(deadline.DeadlineExceeded):
+                await deadline.Deadline(0.05).run(asyncio.sleep(1), 'scoring', 10)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+class TestFairQueue(unittest.TestCase):
+    '''Test for the server.fair_queue module.
+    '''
+
+    def test_scheduler(self):
+        order = []
+        async def request(scheduler, tenant, hold_sec=0.01):
+            await scheduler.acquire(tenant)
+            order.append(tenant)
+            await asyncio.sleep(hold_sec)
+            scheduler.release(tenant)
+        async def run():
+            scheduler = fair_queue.FairScheduler(1, tenants={'big': {'weight': 2}})
+            # A burst of the big tenant, then one request of a small one
+            burst = [asyncio.ensure_future(request(scheduler, 'big')) for _ in range(6)]
+            await asyncio.sleep(0)
+            await request(scheduler, 'small')
+            await asyncio.gather(*burst)
+            # It went in next, not after the whole burst
+            self.assertEqual(order, ['big', 'small'] + ['big'] * 5)
+
+            # Two busy tenants share by weight
+            order.clear()
+            blocker = asyncio.ensure_future(request(scheduler, 'other', 0.05))
+            await asyncio.sleep(0)
+            await asyncio.gather(blocker, *[request(scheduler, tenant)
+                for tenant in ['big'] * 6 + ['small'] * 3])
+            self.assertEqual(order[1:7].count('big'), 4)
+
+            order.clear()
+            scheduler.update(0, tenants={'capped': {'max_in_flight': 1, 'rate': 2, 'burst': 2}})
+            await asyncio.gather(*[request(scheduler, 'capped', 0.05) for _ in range(2)])
+            self.assertEqual(scheduler.stats()['capped']['queued'], 1)
+            with self.assertRaises(fair_queue.RateLimited):
+                await scheduler.acquire('capped')
+            with self.assertRaises(ValueError):
+                scheduler.update(tenants={'bad': {'weight': 0}})
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+class TestMetrics(unittest.TestCase):
+    '''Test for the server.metrics module.
+    '''
+
+    def test_histogram(self):
+        hist = metrics.Histogram('h', 'Test histogram', ('type',), buckets=(1, 2, 4))
+        for value in (0.5, 1.5, 1.5, 3):
+            hist.observe(value, ('a',))
+        self.assertEqual(hist.count(('a',)), 4)
+        self.assertIsNone(hist.quantile(0.5, ('b',)))
+        self.assertEqual(hist.quantile(0.5, ('a',)), 1.5)
+        lines = []
+        hist.render(lines)
+        self.assertIn('h_bucket{type="a",le="2"} 3', lines)
+        self.assertIn('h_bucket{type="a",le="+Inf"} 4', lines)
+        self.assertIn('h_sum{type="a"} 6.5', lines)
+
+    def test_scorer_metrics(self):
+        scorer_metrics = metrics.ScorerMetrics()
+        scorer_metrics.add_stats('pool', 'Pool', lambda: {'u1': {'hits': 2}}, 'url')
+        trace = metrics.RequestTrace()
+        trace.question_type = 'readaloud'
+        trace.mark(metrics.STAGE_TOKEN, 0.001)
+        trace.mark(metrics.STAGE_TOKEN, 0.001)
+        scorer_metrics.observe_request(trace, metrics.OUTCOME_OK)
+        text = scorer_metrics.render()
+        self.assertIn('scorer_stage_seconds_count{stage="token",type="readaloud",outcome="ok"} 1', text)
+        self.assertIn('scorer_request_seconds_count{type="readaloud",outcome="ok"} 1', text)
+        self.assertIn('pool_hits{url="u1"} 2', text)
+
+class TestBalancer(unittest.TestCase):
+    '''Test for the server.balancer module.
+    '''
+
+    def test_least_outstanding(self):
+        lb = balancer.LoadBalancer()
+        first = lb.pick(['a', 'b'])
+        second = lb.pick(['a', 'b'])
+        self.assertNotEqual(first.url, second.url)
+        first.finish(0.1)
+        first.finish(0.1) # Counted once
+        self.assertEqual(lb.pick(['a', 'b']).url, first.url)
+        self.assertEqual(lb.stats()[first.url]['outstanding'], 1)
+
+    def test_ejection_and_recovery(self):
+        lb = balancer.LoadBalancer(eject_after=2, eject_sec=60, recovery_sec=60)
+        for _ in range(2):
+            lb.backend('a').outstanding += 1
+            lb.finish(lb.backend('a'), failed=True)
+        self.assertEqual(lb.stats()['a']['ejected'], 1)
+        self.assertTrue(all(lb.pick(['a', 'b']).url == 'b' for _ in range(5)))
+        # Back, but with a small share until it recovers
+        lb.backend('a').ejected_until = time.monotonic()
+        self.assertEqual(lb.pick(['a', 'b']).url, 'b')
+        self.assertAlmostEqual(lb.stats()['a']['weight'], balancer.RECOVERY_MIN_WEIGHT)
+
+    def test_peak_ewma(self):
+        lb = balancer.LoadBalancer(balancer.POLICY_PEAK_EWMA)
+        lb.pick(['fast']).finish(0.1)
+        lb.pick(['slow']).finish(2)
+        self.assertEqual(lb.pick(['slow', 'fast']).url, 'fast')
+        with self.assertRaises(ValueError):
+            balancer.LoadBalancer('round_robin')
+
+class TestHedging(unittest.TestCase):
+    '''Test for the server.hedging module and the audio it replays.
+    '''
+
+    def test_policy(self):
+        policy = hedging.HedgePolicy(budget_percent=50, min_samples=2)
+        self.assertIsNone(policy.delay('abc')) # Not enough samples yet
+        for seconds in (0.9, 1.1):
+            policy.observe('abc', seconds)
+        self.assertTrue(1 < policy.delay('abc') <= 1.5) # p95 within the bucket
+        self.assertTrue(policy.try_hedge())
+        self.assertFalse(policy.try_hedge()) # 3 requests earned 1.5 hedges
+        self.assertEqual(hedging.HedgePolicy(delay_sec=2).delay('abc'), 2)
+
+    def test_buffered_audio(self):
+        async def source(fail):
+            for i in range(3):
+                yield bytes([i])
+            if fail:
+                raise ValueError('broken')
+        async def read(reader):
+            return b''.join([chunk async for chunk in reader])
+        async def run():
+            buffered = lls_ws_client.BufferedAudio(source(False))
+            first = await read(buffered.reader())
+            second = await read(buffered.reader())
+            self.assertEqual((first, second), (b'\x00\x01\x02',) * 2)
+            buffered = lls_ws_client.BufferedAudio(source(True))
+            for _ in range(2):
+                with self.assertRaises(ValueError):
+                    await read(buffered.reader())
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+class TestProfiling(unittest.TestCase):
+    '''Test for the server.profiling module.
+    '''
+
+    def test_loop_lag_and_profile(self):
+        def busy(seconds):
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                pass
+        async def run():
+            monitor = profiling.LoopLagMonitor(0.05, 0.1)
+            monitor.start()
+            await asyncio.sleep(0.1)
+            busy(0.3) # Blocks the loop
+            await asyncio.sleep(0.2)
+            monitor.stop()
+            self.assertEqual(monitor.stalls, 1)
+            self.assertGreater(monitor.max_lag, 0.2)
+            self.assertGreater(monitor.lag.count(), 2)
+
+            profile = asyncio.ensure_future(profiling.profile(0.3, 0.005, 5))
+            await asyncio.sleep(0.05)
+            busy(0.2)
+            return await profile
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertGreater(result['samples'], 10)
+        lines = result['collapsed'].splitlines()
+        self.assertTrue(any(';test.py:busy ' in line for line in lines))
+        self.assertLessEqual(len(result['memory']), 5)
+
+class TestLogging(unittest.TestCase):
+    '''Test for the server.log_util module.
+    '''
+
+    def test_queue_logging(self):
+        records = []
+        class Capture(logging.Handler):
+            def emit(self, record):
+                records.append((threading.get_ident(), record.getMessage()))
+        capture = Capture()
+        log.addHandler(capture)
+        queue_logging = log_util.QueueLogging(100, burst=3, period_sec=0.2)
+        queue_logging.start()
+        try:
+            for i in range(6):
+                if i == 5:
+                    time.sleep(0.2) # A new period
+                log.warning('Repeated %d' % i)
+        finally:
+            queue_logging.stop()
+            log.removeHandler(capture)
+        self.assertEqual([msg for _, msg in records], ['Repeated 0', 'Repeated 1', 'Repeated 2',
+            'Repeated 5 (2 similar messages suppressed)'])
+        # Written by the listener thread
+        self.assertNotIn(threading.get_ident(), [ident for ident, _ in records])
+        self.assertEqual(queue_logging.stats()['suppressed'], 2)
+
+        handler = log_util.DroppingQueueHandler(1)
+        for _ in range(3):
+            handler.handle(logging.makeLogRecord({'msg': 'x'}))
+        self.assertEqual((handler.queued, handler.dropped), (1, 2))
+
+    def test_access_logger(self):
+        # aiohttp's access log skips requests that log_access has logged
+        access = log_util.AccessLogger(logging.getLogger('aiohttp.access'), '%r %s')
+        request = make_mocked_request('GET', '/metrics')
+        with self.assertLogs('aiohttp.access', logging.INFO) as logs:
+            access.log(request, web.Response(), 0.1)
+            request[log_util.ACCESS_LOGGED] = True
+            access.log(request, web.Response(), 0.1)
+        self.assertEqual(logs.output, ['INFO:aiohttp.access:GET /metrics HTTP/1.1 200'])
+
+class TestJobs(unittest.TestCase):
+    '''Test for the server.jobs module.
+    '''
+
+    def test_store_and_spool(self):
+        async def result():
+            return b'{"status":0}'
+        async def complete(store):
+            job = store.submit(result)
+            self.assertFalse(job.done)
+            await store.wait(job, 1)
+            await store.flush()
+            return job
+        async def run(spool_dir):
+            store = jobs.JobStore(max_jobs=1, spool_dir=spool_dir)
+            job = await complete(store)
+            self.assertEqual((await store.get(job.id)).result, b'{"status":0}')
+            # A restarted worker finds the result in the spool
+            restarted = jobs.JobStore(spool_dir=spool_dir)
+            self.assertEqual((await restarted.get(job.id)).result, b'{"status":0}')
+            self.assertIsNone(await restarted.get('../' + job.id))
+            # A full store drops completed jobs, not running ones
+            newer = await complete(store)
+            self.assertIsNone(await store.get(job.id))
+            store.submit(lambda: asyncio.sleep(1))
+            with self.assertRaises(jobs.JobStoreFull):
+                store.submit(result)
+            await store.close()
+            self.assertIsNone(newer.future)
+            self.assertIsNone(await restarted.get(job.id))
+        loop = asyncio.new_event_loop()
+        try:
+            with tempfile.TemporaryDirectory() as spool_dir:
+                loop.run_until_complete(run(spool_dir))
+        finally:
+            loop.close()
+
+    def test_failed_job_and_other_worker(self):
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise RuntimeError('boom')
+        async def run(spool_dir):
+            store = jobs.JobStore(spool_dir=spool_dir)
+            other = jobs.JobStore(spool_dir=spool_dir)
+            with self.assertLogs(level=logging.WARNING):
+                job = store.submit(fail)
+                await store.flush()
+                # Another worker sharing the spool knows it is running
+                self.assertFalse((await other.get(job.id)).done)
+                await store.wait(job, 1)
+                await store.flush()
+            # A failed job is done, with an error result, in both workers
+            self.assertEqual(json.loads(job.result)['status'], -1)
+            self.assertEqual((await other.get(job.id)).result, job.result)
+            self.assertEqual(store.stats()['failed'], 1)
+            self.assertIsNone(await other.get(jobs.uuid.uuid4().hex))
+        loop = asyncio.new_event_loop()
+        try:
+            with tempfile.TemporaryDirectory() as spool_dir:
+                loop.run_until_complete(run(spool_dir))
+        finally:
+            loop.close()
+
+class TestAudioCache(unittest.TestCase):
+    '''Test for the server.audio_cache module.
+    '''
+
+    def test_write_serve_evict(self):
+        async def chunks(data):
+            for i in range(0, len(data), 100):
+                yield data[i:i+100]
+        async def run(cache, media_id, data):
+            async for _ in cache.tee(media_id, chunks(data)):
+                pass
+            await cache.close() # The file is written in the background
+            return b''.join([bytes(c) async for c in await cache.open(media_id, block_size=64)])
+        loop = asyncio.new_event_loop()
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                cache = audio_cache.AudioCache(cache_dir, max_bytes=1000)
+                data = os.urandom(600)
+                self.assertEqual(loop.run_until_complete(run(cache, 'a', data)), data)
+                loop.run_until_complete(run(cache, 'b', data))
+                self.assertIsNone(loop.run_until_complete(cache.open('a'))) # Evicted
+                self.assertEqual(cache.stats()['evictions'], 1)
+                # The index is rebuilt from the directory
+                self.assertEqual(audio_cache.AudioCache(cache_dir).bytes, 600)
+                loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+class TestSpeexFraming(unittest.TestCase):
+    '''Test for framing WeChat audio and coalescing it into WS messages.
+    '''
+
+    def test_framer_across_blocks(self):
+        raw = os.urandom(60 * 10 + 7)
+        framer = wx_http_client.SpeexFramer()
+        out = b''
+        for i in range(0, len(raw), 37): # Frames span block boundaries
+            out += framer.feed(raw[i:i+37])
+        out += framer.flush()
+        expected = b''
+        for i in range(0, len(raw), 60):
+            frame = raw[i:i+60]
+            expected += len(frame).to_bytes(4, 'little') + frame
+        self.assertEqual(out, expected)
+
+    def test_coalesce_chunks(self):
+        async def run(max_bytes, window_sec):
+            chunks = mock_download_audio(chunk_size=60, chunk_count=20, chunk_delay_ms=5)
+            return [bytes(c) async for c in lls_ws_client.coalesce_chunks(chunks, max_bytes, window_sec)]
+        loop = asyncio.new_event_loop()
+        try:
+            by_size = loop.run_until_complete(run(640, 10))
+            by_time = loop.run_until_complete(run(1 << 20, 0.02))
+            unmerged = loop.run_until_complete(run(0, 0))
+        finally:
+            loop.close()
+        self.assertEqual([len(c) for c in by_size], [640] * 2)
+        self.assertGreater(len(by_time), 1)
+        self.assertEqual(sum(len(c) for c in by_time), 64 * 20)
+        self.assertEqual(len(unmerged), 20)
+
+    def test_prefetcher_backpressure(self):
+        produced = []
+        async def source():
+            for i in range(10):
+                produced.append(i)
+                yield bytes([i])
+        async def run():
+            prefetcher = wx_http_client.Prefetcher(source(), max_chunks=2)
+            await asyncio.sleep(0.01)
+            # The producer waits for room in the queue
+            self.assertLessEqual(len(produced), 3)
+            chunks = [chunk async for chunk in prefetcher]
+            prefetcher.close()
+            return chunks
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(run()), [bytes([i]) for i in range(10)])
+        finally:
+            loop.close()
+
 class TestLLSClientScoring(AioHTTPTestCase):
     '''Test for getting score via WebSocket connections.
     '''
@@ -117,15 +726,29 @@ class TestLLSClientScoring(AioHTTPTestCase):
     MOCK_NORMAL    = '/ws-endpoint'
     MOCK_EMPTY_RSP = '/ws-endpoint-empty'
     MOCK_TIMEOUT   = '/ws-endpoint-hog'
+    MOCK_TRUNCATED = '/ws-endpoint-truncated'
+    MOCK_IDLE_CLOSE = '/ws-endpoint-idle-close'
 
     async def get_application(self):
-        '''Set up three mock WS servers with distinct behaviors.
+        '''Set up mock WS servers with distinct behaviors.
         '''
+        self.idle_closed = 0
+        async def close_first_socket(request):
+            # The first socket is closed while idle in the pool
+            if self.idle_closed == 0:
+                self.idle_closed += 1
+                ws = web.WebSocketResponse()
+                await ws.prepare(request)
+                await ws.close()
+                return ws
+            return await mock_ws_handler_normal(request)
         app = web.Application()
         app.add_routes([
             web.get(self.MOCK_NORMAL, mock_ws_handler_normal),
             web.get(self.MOCK_EMPTY_RSP, mock_ws_handler_empty_rsp),
             web.get(self.MOCK_TIMEOUT, mock_ws_handler_stuck_forever),
+            web.get(self.MOCK_TRUNCATED, mock_ws_handler_truncated_rsp),
+            web.get(self.MOCK_IDLE_CLOSE, close_first_socket),
         ])
         return app
 
@@ -134,11 +757,69 @@ class TestLLSClientScoring(AioHTTPTestCase):
         rsp = await lls_ws_client.get_score(self.client, self.MOCK_NORMAL, '{}', mock_download_audio())
         self.assertEqual(rsp.decode(), '{}')
     
+    @unittest_run_loop
+    async def test_get_score_pooled(self):
+        pool = ws_pool.WebSocketPool(
+            lambda url: lls_ws_client.connect(self.client, url),
+            [self.MOCK_NORMAL], size=1, check_interval_sec=0.05,
+        )
+        pool.start()
+        try:
+            await asyncio.sleep(0.2)
+            self.assertEqual(pool.stats()[self.MOCK_NORMAL]['idle'], 1)
+            for _ in range(2):
+                rsp = await lls_ws_client.get_score(self.client, self.MOCK_NORMAL, '{}',
+                    mock_download_audio(), pool=pool)
+                self.assertEqual(rsp.decode(), '{}')
+            stats = pool.stats()[self.MOCK_NORMAL]
+            self.assertEqual(stats['hits'], 2) # Refilled after the first one
+            self.assertEqual(stats['misses'], 0)
+            ws = await pool.acquire(self.MOCK_EMPTY_RSP) # Not pre-connected
+            await ws.close()
+            self.assertEqual(pool.stats()[self.MOCK_EMPTY_RSP]['misses'], 1)
+        finally:
+            await pool.close()
+
+    @unittest_run_loop
+    async def test_get_score_pooled_closed(self):
+        pool = ws_pool.WebSocketPool(
+            lambda url: lls_ws_client.connect(self.client, url),
+            [self.MOCK_IDLE_CLOSE], size=1, check_interval_sec=10,
+        )
+        pool.start()
+        try:
+            await asyncio.sleep(0.2)
+            self.assertEqual(pool.stats()[self.MOCK_IDLE_CLOSE]['idle'], 1)
+            # The closed socket is only found out when used, and the request
+            # goes on with a new one
+            rsp = await lls_ws_client.get_score(self.client, self.MOCK_IDLE_CLOSE, '{}',
+                mock_download_audio(), pool=pool)
+            self.assertEqual(rsp.decode(), '{}')
+            self.assertEqual(pool.stats()[self.MOCK_IDLE_CLOSE]['hits'], 1)
+        finally:
+            await pool.close()
+        # A dialed socket is not retried
+        with self.assertRaises(lls_ws_client.LiulishuoResponseError):
+            await lls_ws_client.get_score(self.client, self.MOCK_EMPTY_RSP, '{}',
+                mock_download_audio(), pool=pool)
+
     @unittest_run_loop
     async def test_get_score_empty(self):
         with self.assertRaises(lls_ws_client.LiulishuoResponseError):
             await lls_ws_client.get_score(self.client, self.MOCK_EMPTY_RSP, '{}', mock_download_audio())
 
+    @unittest_run_loop
+    async def test_get_score_truncated(self):
+        with self.assertRaises(lls_ws_client.LiulishuoResponseError):
+            await lls_ws_client.get_score(self.client, self.MOCK_TRUNCATED, '{}', mock_download_audio())
+
+    def test_response_assembler(self):
+        assembler = lls_ws_client.ResponseAssembler()
+        self.assertFalse(assembler.feed(b'\x00\x00'))
+        self.assertFalse(assembler.feed(b'\x00\x05he'))
+        self.assertTrue(assembler.feed(b'llo, ignored'))
+        self.assertEqual(assembler.result(), b'hello')
+
     @unittest_run_loop
     async def test_get_score_timeout(self):
         lls_ws_client.SCORING_TIMEOUT_SEC = 1
@@ -192,6 +873,55 @@ class TestLLSTokenService(AioHTTPTestCase):
                 self.client, cfg2, {},
             )
 
+class TestAccessTokenCache(unittest.TestCase):
+    '''Test for the server.token_cache module.
+    '''
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.fetch_count = 0
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def fetch(self):
+        self.fetch_count += 1
+        await asyncio.sleep(0.01)
+        return 'TOKEN%d' % self.fetch_count
+
+    def test_single_flight(self):
+        cache = token_cache.AccessTokenCache(ttl_sec=60, refresh_ahead_sec=0)
+        async def run():
+            return await asyncio.gather(*[cache.get(self.fetch) for _ in range(10)])
+        tokens = self.loop.run_until_complete(run())
+        self.assertEqual(tokens, ['TOKEN1'] * 10)
+        self.assertEqual(self.fetch_count, 1)
+        self.assertEqual(cache.misses, 10)
+        self.loop.run_until_complete(cache.get(self.fetch))
+        self.assertEqual(cache.hits, 1)
+
+    def test_refresh_ahead_and_invalidate(self):
+        cache = token_cache.AccessTokenCache(ttl_sec=60, refresh_ahead_sec=120)
+        async def run():
+            first = await cache.get(self.fetch)
+            # Within the refresh-ahead window: old token served, refresh starts
+            second = await cache.get(self.fetch)
+            await asyncio.sleep(0.05)
+            third = await cache.get(self.fetch)
+            return first, second, third
+        self.assertEqual(self.loop.run_until_complete(run()), ('TOKEN1', 'TOKEN1', 'TOKEN2'))
+        self.assertEqual(cache.refreshes, 2)
+        cache.invalidate('', 'TOKEN1') # Stale token: ignored
+        self.assertEqual(cache.invalidations, 0)
+        cache.invalidate('', 'TOKEN3')
+        cache.invalidate()
+        self.assertEqual(cache.invalidations, 1)
+
+    def test_errcode(self):
+        wre = wx_http_client.WeixinResponseError('{"errcode":40001,"errmsg":"invalid credential"}')
+        self.assertIn(wre.errcode, token_cache.WX_INVALID_TOKEN_ERRCODES)
+        self.assertIsNone(wx_http_client.WeixinResponseError('<html>').errcode)
+
 class TestHTTPHandler(unittest.TestCase):
     '''Test for the server.http_handler module.
 
@@ -208,6 +938,557 @@ class TestHTTPHandler(unittest.TestCase):
             'https://api.weixin.qq.com/cgi-bin/media/get/jssdk?access_token=TOKEN&media_id=DDD'
         )
 
+    def test_batch_line(self):
+        line = http_handler._batch_line(1, 'A', bytearray(b'{\n"status": 0,\n"msg": "\xe5\xa5\xbd"}'))
+        self.assertEqual(line, '{"index":1,"mediaId":"A","result":{"status":0,"msg":"好"}}\n'.encode())
+        for result in (b'{"status":0', b'\xff'):
+            line = http_handler._batch_line(2, None, result)
+            self.assertEqual(line.count(b'\n'), 1)
+            self.assertEqual(json.loads(line)['result']['status'], http_handler.BATCH_ITEM_ERROR_STATUS)
+
+class TestTransport(unittest.TestCase):
+    '''Test for the server.transport module.
+    '''
+
+    def test_connector_options(self):
+        config = cfg.ScorerConfig(connectors={'wechat': {'limit': 400}})
+        self.assertEqual(transport.connector_options(config, 'wechat')['limit'], 400)
+        self.assertEqual(transport.connector_options(config, 'scorer'), config.connector_defaults)
+        config = cfg.ScorerConfig(connectors={'token': {'limt': 1}})
+        with self.assertRaises(ValueError):
+            transport.connector_options(config, 'token')
+
+    def test_event_loop(self):
+        transport.install_event_loop('asyncio')
+        with self.assertRaises(ValueError):
+            transport.install_event_loop('trio')
+
+class TestWorkers(unittest.TestCase):
+    '''Test for the server.workers module.
+    '''
+
+    def test_resolve_worker_count(self):
+        self.assertEqual(workers.resolve_worker_count(3), 3)
+        self.assertEqual(workers.resolve_worker_count('2'), 2)
+        self.assertGreaterEqual(workers.resolve_worker_count('auto'), 1)
+        with self.assertRaises(ValueError):
+            workers.resolve_worker_count(0)
+
+    @unittest.skipUnless(hasattr(workers.socket, 'SO_REUSEPORT'), 'SO_REUSEPORT unavailable')
+    def test_bind_socket_reuse_port(self):
+        sock1 = workers.bind_socket('127.0.0.1', 0, reuse_port=True)
+        try:
+            port = sock1.getsockname()[1]
+            sock2 = workers.bind_socket('127.0.0.1', port, reuse_port=True)
+            sock2.close()
+        finally:
+            sock1.close()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'no fork')
+    def test_describe_status(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(3)
+        self.assertEqual(workers.describe_status(os.waitpid(pid, 0)[1]), 'exited with code 3')
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(5)
+            os._exit(0)
+        os.kill(pid, workers.signal.SIGKILL)
+        self.assertEqual(workers.describe_status(os.waitpid(pid, 0)[1]),
+            'was killed by signal %d' % workers.signal.SIGKILL)
+
+    @unittest.skipUnless(hasattr(workers.signal, 'SIGHUP'), 'no SIGHUP')
+    def test_sighup_during_startup(self):
+        supervisor = workers.Supervisor(lambda index: time.sleep(0.5), 1)
+        supervisor._spawn(0)
+        pid = next(iter(supervisor._workers))
+        time.sleep(0.2)
+        # Forwarded before the worker's loop would handle it
+        os.kill(pid, workers.signal.SIGHUP)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+class TestRatingHandler(AioHTTPTestCase):
+    '''End-to-end test for OpenWeixinScorer.rating_handler against a mock
+    WeChat media server, token service and scorer served by the same app.
+    '''
+
+    META = 'eyJpdGVtIjp7InR5cGUiOiJhYmMifX0K'
+    AUDIO = os.urandom(60 * 50 + 30)
+
+    async def get_application(self):
+        self.scorer = http_handler.OpenWeixinScorer(cfg.ScorerConfig(
+            access_token_refresh_ahead_sec=0,
+        ))
+        self.tokens_issued = 0
+        self.downloads = 0
+        self.probes = 0
+        self.scored_audio = []
+        async def token(request):
+            self.tokens_issued += 1
+            return web.json_response({'result': {'access_token': 'T%d' % self.tokens_issued}})
+        async def media(request):
+            if request.query['media_id'] == 'bad':
+                return web.json_response({'errcode': 40007, 'errmsg': 'invalid media_id'})
+            if request.query['access_token'] == 'T1':
+                return web.json_response({'errcode': 40001, 'errmsg': 'invalid credential'})
+            if request.query['media_id'] == 'slow':
+                await asyncio.sleep(5)
+            if request.method == 'HEAD':
+                self.probes += 1
+            else:
+                self.downloads += 1
+            audio = self.AUDIO[:600] if request.query['media_id'] == 'short' else self.AUDIO
+            return web.Response(body=audio, content_type='voice/speex')
+        async def scorer(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            audio = None
+            async for msg in ws:
+                if msg.data == b'EOS':
+                    self.scored_audio.append(audio)
+                    break
+                if audio is None:
+                    audio = b'' # Skip meta
+                else:
+                    audio += msg.data
+            rsp = b'{"status":0}'
+            await ws.send_bytes(len(rsp).to_bytes(4, 'big') + rsp)
+            await ws.close()
+            return ws
+        app = self.scorer.make_app()
+        app.router.add_post('/token', token)
+        app.router.add_get('/media', media)
+        async def broken_scorer(request):
+            return web.Response(status=502)
+        app.router.add_get('/scorer', scorer)
+        app.router.add_get('/scorer2', scorer)
+        async def slow_scorer(request):
+            await asyncio.sleep(5)
+            return await scorer(request)
+        app.router.add_get('/broken', broken_scorer)
+        app.router.add_get('/slow', slow_scorer)
+        return app
+
+    def setUpConfig(self, **entries):
+        config = self.scorer.config
+        config.token_service_jsonrpc_addr = str(self.server.make_url('/token'))
+        config.audio_download_url = str(self.server.make_url('/media'))
+        config.scorer_url = str(self.server.make_url('/scorer'))
+        config.__dict__.update(entries)
+        self.scorer.compile_config()
+
+    async def rate(self, media_id='DDD', **fields):
+        req = {'mediaId': media_id, 'meta': self.META}
+        req.update(fields)
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT, data=json.dumps(req))
+        return rsp.status, await rsp.text()
+
+    @unittest_run_loop
+    async def test_rating(self):
+        self.setUpConfig()
+        # The first token is rejected by WeChat, so it is dropped and refetched
+        self.assertEqual(await self.rate(), (200, '{"status":0}'))
+        self.assertEqual(await self.rate(), (200, '{"status":0}'))
+        self.assertEqual(self.tokens_issued, 2)
+        # Audio reached the scorer in Liulishuo framing
+        self.assertEqual(len(self.scored_audio[0]), 64 * 50 + 34)
+        # Every upstream has its own connection pool
+        connectors = set(id(session.connector) for session in self.scorer._sessions.values())
+        self.assertEqual(len(connectors), len(transport.UPSTREAMS))
+
+    @unittest_run_loop
+    async def test_rating_token_override(self):
+        self.setUpConfig()
+        self.assertEqual(self.scorer.get_access_token_key({}),
+            self.scorer.config.token_service_jsonrpc_addr)
+        class AccountScorer(http_handler.OpenWeixinScorer):
+            async def get_access_token(self, req_dict):
+                return req_dict['account']
+        self.scorer.__class__ = AccountScorer
+        self.assertIsNone(self.scorer.get_access_token_key({}))
+        # Every request uses its own account's token; none is cached
+        self.assertEqual(await self.rate(account='T2', noCache=True), (200, '{"status":0}'))
+        _, body = await self.rate(account='T1', noCache=True)
+        self.assertIn('40001', body) # T1 is rejected by WeChat
+        self.assertEqual(self.scorer._token_cache.stats()['size'], 0)
+        self.assertEqual(self.tokens_issued, 0)
+
+    @unittest_run_loop
+    async def test_rating_dedup_and_cache(self):
+        self.setUpConfig()
+        results = await asyncio.gather(*[self.rate(accessToken='T2') for _ in range(5)])
+        self.assertEqual(results, [(200, '{"status":0}')] * 5)
+        self.assertEqual(len(self.scored_audio), 1) # Joined in flight
+        await self.rate(accessToken='T2')
+        self.assertEqual(len(self.scored_audio), 1) # Served from cache
+        await self.rate(accessToken='T2', noCache=True)
+        self.assertEqual(len(self.scored_audio), 2)
+        self.assertEqual(self.scorer._result_cache.hits, 1)
+
+    @unittest_run_loop
+    async def test_rating_audio_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.setUpConfig()
+            self.scorer._audio_cache = audio_cache.AudioCache(cache_dir)
+            for _ in range(2):
+                self.assertEqual(await self.rate(accessToken='T2', noCache=True), (200, '{"status":0}'))
+                await self.scorer._audio_cache.close()
+            self.assertEqual(self.downloads, 1)
+            self.assertEqual(self.scored_audio[0], self.scored_audio[1])
+            self.assertEqual(self.scorer._audio_cache.stats()['hits'], 1)
+
+    @unittest_run_loop
+    async def test_rating_admission(self):
+        self.setUpConfig()
+        self.scorer._admission = admission.AdmissionController({
+            'max_concurrency': 1, 'max_queue': 0, 'max_queue_time_sec': 1})
+        rsp1, rsp2 = await asyncio.gather(
+            self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+                data=json.dumps({'mediaId': 'A', 'meta': self.META, 'accessToken': 'T2'})),
+            self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+                data=json.dumps({'mediaId': 'B', 'meta': self.META, 'accessToken': 'T2'})),
+        )
+        self.assertEqual(sorted([rsp1.status, rsp2.status]), [200, 503])
+        rejected = rsp1 if rsp1.status == 503 else rsp2
+        self.assertEqual(rejected.headers['Retry-After'], '1')
+        # The rejected request never asked WeChat for its audio
+        self.assertEqual((self.downloads, self.probes), (1, 0))
+
+    @unittest_run_loop
+    async def test_rating_shortest_first(self):
+        self.setUpConfig()
+        self.scorer._admission = admission.AdmissionController({
+            'max_concurrency': 1, 'max_queue': 10, 'max_queue_time_sec': 5, 'sjf_weight': 0.1})
+        limiter = self.scorer._admission.limiter(self.scorer.config.scorer_url)
+        held = limiter.try_acquire()
+        def post(media_id):
+            return asyncio.ensure_future(self.client.post(
+                http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+                data=json.dumps({'mediaId': media_id, 'meta': self.META, 'accessToken': 'T2'})))
+        long_rsp = post('DDD')
+        while limiter.queue_depth < 1:
+            await asyncio.sleep(0.01)
+        short_rsp = post('short')
+        while limiter.queue_depth < 2:
+            await asyncio.sleep(0.01)
+        # Both learnt the size of their audio without downloading it
+        self.assertEqual((self.probes, self.downloads), (2, 0))
+        limiter.release(held)
+        self.assertEqual([(await rsp).status for rsp in (long_rsp, short_rsp)], [200, 200])
+        self.assertEqual([len(audio) for audio in self.scored_audio], [640, 3234])
+
+    @unittest_run_loop
+    async def test_traffic_recorder(self):
+        with tempfile.TemporaryDirectory() as record_dir:
+            path = os.path.join(record_dir, 'traffic.jsonl')
+            self.setUpConfig(type_specific_scorer_urls={'abc': str(self.server.make_url('/scorer'))})
+            self.scorer._recorder = recorder.TrafficRecorder(path, 100)
+            await self.rate(accessToken='T2')
+            await self.rate('bad', accessToken='T2')
+            await self.scorer._recorder.close()
+            with open(path) as f:
+                text = f.read()
+            for secret in ('DDD', 'T2', self.META):
+                self.assertNotIn(secret, text)
+            ok, refused = recorder.read_records(path)
+            self.assertEqual((ok['type'], ok['meta'], ok['audio']), ('abc', len(self.META), len(self.AUDIO)))
+            self.assertEqual((ok['outcome'], refused['outcome']), ('ok', 'weixin_error'))
+            self.assertIn('scorer_response', ok['stages'])
+            self.scorer._recorder.sample_percent = 0
+            await self.rate(accessToken='T2', noCache=True)
+            self.assertEqual(self.scorer._recorder.stats()['recorded'], 2)
+            # Appended in whole lines, however many
+            lines = ['{"t":%d,"pad":"%s"}' % (i, 'x' * 30000) for i in range(5)]
+            recorder._append(path, lines)
+            self.assertEqual([r['t'] for r in recorder.read_records(path)][:5], list(range(5)))
+
+    @unittest_run_loop
+    async def test_circuit_breaker(self):
+        broken, good = [str(self.server.make_url(path)) for path in ('/broken', '/scorer')]
+        self.setUpConfig(scorer_url=broken)
+        self.scorer._breakers = breaker.BreakerSet(None, {'scorer': {'min_requests': 2}})
+        for _ in range(3):
+            status, _ = await self.rate(accessToken='T2', noCache=True)
+            self.assertEqual(status, 500)
+        scorer_breaker = self.scorer._breakers.endpoint(transport.UPSTREAM_SCORER, broken)
+        self.assertEqual((scorer_breaker.failures, scorer_breaker.rejected), (2, 1))
+        # The other scorer's circuit is not the broken one's
+        self.setUpConfig(scorer_url=[broken, good])
+        self.scorer._balancer.backend(broken).outstanding += 1 # Make the good one first
+        self.assertEqual(await self.rate(accessToken='T2', noCache=True), (200, '{"status":0}'))
+        # WeChat answered every download, even refusing one
+        await self.rate('bad', accessToken='T2')
+        self.assertEqual(self.scorer._breakers[transport.UPSTREAM_WECHAT].failures, 0)
+        rsp = await self.client.get(http_handler.OpenWeixinScorer.METRICS_ENDPOINT)
+        text = await rsp.text()
+        self.assertIn('scorer_backend_circuit_state{url="%s"} 1' % broken, text)
+        self.assertIn('scorer_backend_circuit_state{url="%s"} 0' % good, text)
+        self.assertIn('scorer_circuit_state{upstream="wechat"} 0', text)
+
+    @unittest_run_loop
+    async def test_deadline(self):
+        self.setUpConfig(scorer_url=str(self.server.make_url('/slow')))
+        def post(timeout_ms, media_id='DDD'):
+            return self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+                data=json.dumps({'mediaId': media_id, 'meta': self.META}),
+                headers={'X-Request-Timeout-Ms': timeout_ms})
+        started = time.monotonic()
+        rsp = await post('1000')
+        self.assertEqual(rsp.status, 504)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(self.downloads, 1)
+        # Too little time to score at all: fails before any upstream is used
+        rsp = await post('100')
+        self.assertEqual(rsp.status, 504)
+        self.assertEqual((self.tokens_issued, self.downloads), (2, 1))
+        self.assertEqual((await post('soon')).status, 400)
+        # WeChat is not blamed for the client's short deadline
+        self.assertEqual((await post('1000', 'slow')).status, 504)
+        wx_breaker = self.scorer._breakers[transport.UPSTREAM_WECHAT]
+        self.assertEqual((wx_breaker.calls, wx_breaker.failures), (3, 0))
+
+    @unittest_run_loop
+    async def test_hung_scorer(self):
+        slow = str(self.server.make_url('/slow'))
+        self.setUpConfig(scorer_url=slow, scoring_timeout_sec=0.2,
+            scoring_timeout_per_audio_sec=0)
+        # The scoring cap, not the client's deadline, cuts the request short
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+            data=json.dumps({'mediaId': 'DDD', 'meta': self.META, 'accessToken': 'T2'}),
+            headers={'X-Request-Timeout-Ms': '10000'})
+        self.assertEqual(rsp.status, 504)
+        scorer_breaker = self.scorer._breakers.endpoint(transport.UPSTREAM_SCORER, slow)
+        self.assertEqual((scorer_breaker.failures, scorer_breaker.timeouts), (1, 1))
+        self.assertEqual(self.scorer._balancer.stats()[slow]['failures'], 1)
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        self.setUpConfig(type_specific_scorer_urls={'abc': str(self.server.make_url('/scorer'))})
+        with self.assertLogs('scorer.access', logging.INFO) as logs:
+            await self.rate()
+        self.assertRegex(logs.output[0], r'media_id=DDD type=abc tenant=- audio_sec=1.0 outcome=ok ms=\S+ token_ms=')
+        with self.assertLogs('scorer.access', logging.INFO) as logs:
+            rsp = await self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT, data='{')
+        self.assertEqual(rsp.status, 400)
+        self.assertRegex(logs.output[0], r'media_id=- type=- tenant=- audio_sec=- outcome=bad_request')
+        await self.rate('bad', accessToken='T2')
+        rsp = await self.client.get(http_handler.OpenWeixinScorer.METRICS_ENDPOINT)
+        self.assertEqual(rsp.status, 200)
+        text = await rsp.text()
+        for stage in metrics.STAGES:
+            self.assertIn('scorer_stage_seconds_count{stage="%s",type="abc",outcome="ok"} 1' % stage, text)
+        self.assertIn('scorer_request_seconds_count{type="abc",outcome="weixin_error"} 1', text)
+        self.assertIn('scorer_audio_request_seconds_count{audio="le5s",outcome="ok"} 1', text)
+        self.assertIn('scorer_token_cache_invalidations 1', text)
+        # Types without a route of their own, or not strings, are "other"
+        for qtype in (5, 'xyz'):
+            meta = base64.b64encode(json.dumps({'item': {'type': qtype}}).encode()).decode()
+            self.assertEqual((await self.rate(meta=meta, accessToken='T2'))[0], 200)
+        rsp = await self.client.get(http_handler.OpenWeixinScorer.METRICS_ENDPOINT)
+        self.assertEqual(rsp.status, 200)
+        text = await rsp.text()
+        self.assertIn('scorer_request_seconds_count{type="",outcome="ok"} 1', text)
+        self.assertIn('scorer_request_seconds_count{type="other",outcome="ok"} 1', text)
+        self.assertNotIn('xyz', text)
+
+    @unittest_run_loop
+    async def test_profile(self):
+        self.setUpConfig()
+        endpoint = http_handler.OpenWeixinScorer.ADMIN_PROFILE_ENDPOINT
+        rsp = await self.client.get(endpoint)
+        self.assertEqual(rsp.status, 404)
+        self.scorer.config.admin_token = 'secret'
+        rsp = await self.client.get(endpoint, params={'seconds': '0.1', 'top': '3'},
+            headers={'X-Admin-Token': 'secret'})
+        self.assertEqual(rsp.status, 200)
+        result = await rsp.json()
+        self.assertGreater(result['samples'], 0)
+        self.assertLessEqual(len(result['memory']), 3)
+        rsp = await self.client.get(endpoint, params={'seconds': '0.05', 'format': 'collapsed'},
+            headers={'X-Admin-Token': 'secret'})
+        self.assertRegex(await rsp.text(), r'^\S.* \d+\n')
+        rsp = await self.client.get(self.scorer.METRICS_ENDPOINT)
+        self.assertIn('# TYPE scorer_loop_lag_seconds histogram', await rsp.text())
+
+    @unittest_run_loop
+    async def test_tenants(self):
+        self.setUpConfig()
+        async def validate_request(req_dict, header_dict, query_dict):
+            self.assertNotIn('_tenant', req_dict) # Clients can't choose
+            req_dict['_tenant'] = header_dict.get('X-School')
+            return req_dict
+        self.scorer.validate_request = validate_request
+        self.scorer._scheduler = fair_queue.FairScheduler(
+            tenants={'school': {'rate': 1, 'burst': 1}},
+            wait_seconds=self.scorer._metrics.tenant_wait_seconds,
+        )
+        body = json.dumps({'mediaId': 'DDD', 'meta': self.META, 'accessToken': 'T2',
+            'noCache': True, '_tenant': 'other'})
+        statuses = []
+        for _ in range(2):
+            rsp = await self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+                data=body, headers={'X-School': 'school'})
+            statuses.append(rsp.status)
+        self.assertEqual(statuses, [200, 429])
+        self.assertEqual(rsp.headers['Retry-After'], '1')
+        rsp = await self.client.get(http_handler.OpenWeixinScorer.METRICS_ENDPOINT)
+        text = await rsp.text()
+        self.assertIn('scorer_tenant_rate_limited{tenant="school"} 1', text)
+        self.assertIn('scorer_tenant_request_seconds_count{tenant="school",outcome="ok"} 1', text)
+        self.assertIn('scorer_tenant_wait_seconds_count{tenant="school"} 1', text)
+
+    @unittest_run_loop
+    async def test_batch(self):
+        self.setUpConfig(batch_concurrency=2)
+        await self.rate() # Caches a valid token
+        items = [{'mediaId': 'A', 'meta': self.META}, {'mediaId': 'bad', 'meta': self.META},
+            {'mediaId': 'C'}, {'mediaId': 'D', 'meta': self.META}]
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.BATCH_ENDPOINT,
+            data=json.dumps({'items': items}))
+        self.assertEqual(rsp.status, 200)
+        self.assertEqual(rsp.content_type, 'application/x-ndjson')
+        lines = [json.loads(line) for line in (await rsp.text()).splitlines()]
+        results = {line['index']: line['result'] for line in lines}
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(results[0], {'status': 0})
+        self.assertEqual(results[1]['status'], http_handler.WEIXIN_ERROR_STATUS)
+        self.assertEqual(results[2]['status'], http_handler.BATCH_ITEM_ERROR_STATUS)
+        self.assertEqual(results[3], {'status': 0})
+        self.assertEqual(self.tokens_issued, 2)
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.BATCH_ENDPOINT,
+            data=json.dumps({'items': items * 100}))
+        self.assertEqual(rsp.status, 413)
+
+    @unittest_run_loop
+    async def test_jobs(self):
+        self.setUpConfig()
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.JOBS_ENDPOINT,
+            data=json.dumps({'mediaId': 'DDD', 'meta': self.META, 'accessToken': 'T2'}))
+        self.assertEqual(rsp.status, 202)
+        job_url = '%s/%s' % (http_handler.OpenWeixinScorer.JOBS_ENDPOINT, (await rsp.json())['jobId'])
+        rsp = await self.client.get(job_url, params={'wait': '5'})
+        self.assertEqual((rsp.status, await rsp.text()), (200, '{"status":0}'))
+        rsp = await self.client.get(http_handler.OpenWeixinScorer.JOBS_ENDPOINT + '/unknown')
+        self.assertEqual(rsp.status, 404)
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.JOBS_ENDPOINT,
+            data=json.dumps({'mediaId': 'DDD'}))
+        self.assertEqual(rsp.status, 400)
+
+    @unittest_run_loop
+    async def test_balancing(self):
+        self.setUpConfig()
+        urls = [str(self.server.make_url(path)) for path in ('/scorer', '/scorer2', '/broken')]
+        self.scorer.config.scorer_url = urls
+        self.scorer.compile_config()
+        self.scorer._balancer = balancer.LoadBalancer(eject_after=1, eject_sec=60)
+        statuses = [(await self.rate(accessToken='T2', noCache=True))[0] for _ in range(12)]
+        stats = self.scorer._balancer.stats()
+        # The broken scorer fails at most once, then is ejected
+        self.assertLessEqual(statuses.count(500), 1)
+        self.assertEqual(stats[urls[2]]['requests'], stats[urls[2]]['ejections'])
+        self.assertEqual(stats[urls[0]]['requests'] + stats[urls[1]]['requests'], statuses.count(200))
+        self.assertEqual(len(self.scored_audio), statuses.count(200))
+
+    @unittest_run_loop
+    async def test_hedging(self):
+        self.setUpConfig()
+        slow, fast = [str(self.server.make_url(path)) for path in ('/slow', '/scorer')]
+        self.scorer.config.scorer_url = [slow, fast]
+        self.scorer.compile_config()
+        self.scorer._hedging = hedging.HedgePolicy(delay_sec=0.2, budget_percent=100)
+        self.scorer._balancer.backend(fast).outstanding += 1 # Make the slow one first
+        started = time.monotonic()
+        self.assertEqual(await self.rate(accessToken='T2'), (200, '{"status":0}'))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(self.scorer._hedging.stats()['hedge_wins'], 1)
+        self.assertEqual(self.scorer._balancer.stats()[slow]['outstanding'], 0)
+        self.assertEqual(len(self.scored_audio[0]), 64 * 50 + 34)
+        # No hedge goes to a backend whose admission is full
+        self.scorer._admission = admission.AdmissionController({
+            'max_concurrency': 1, 'max_queue': 10, 'max_queue_time_sec': 5})
+        fast_limiter = self.scorer._admission.limiter(fast)
+        held = fast_limiter.try_acquire()
+        rsp = await self.client.post(http_handler.OpenWeixinScorer.REQUEST_ENDPOINT,
+            data=json.dumps({'mediaId': 'DDD', 'meta': self.META, 'accessToken': 'T2',
+                'noCache': True}),
+            headers={'X-Request-Timeout-Ms': '1000'})
+        self.assertEqual(rsp.status, 504)
+        self.assertEqual(self.scorer._hedging.stats()['saturated'], 1)
+        fast_limiter.release(held)
+        self.assertEqual(fast_limiter.stats()['in_flight'], 0)
+
+    @unittest_run_loop
+    async def test_reload(self):
+        self.setUpConfig()
+        entries = {
+            'token_service_jsonrpc_addr': self.scorer.config.token_service_jsonrpc_addr,
+            'audio_download_url':         self.scorer.config.audio_download_url,
+            'scorer_url':                 str(self.server.make_url('/scorer2')),
+            'connectors':                 {'scorer': {'limit': 10}},
+            'admin_token':                'secret',
+        }
+        sessions = dict(self.scorer._sessions)
+        tokens = self.scorer._token_cache
+        with tempfile.NamedTemporaryFile('w', suffix='.yml') as f:
+            self.scorer.config_file = f.name
+            yaml.safe_dump(entries, f)
+            f.flush()
+            endpoint = http_handler.OpenWeixinScorer.ADMIN_RELOAD_ENDPOINT
+            rsp = await self.client.post(endpoint)
+            self.assertEqual(rsp.status, 404) # No admin token in config yet
+            self.scorer.on_sighup()
+            self.assertEqual(self.scorer.config.scorer_url, entries['scorer_url'])
+            # Only the scorer's connection pool changed
+            self.assertIs(self.scorer._sessions['wechat'], sessions['wechat'])
+            self.assertIs(self.scorer._sessions['token'], sessions['token'])
+            self.assertIsNot(self.scorer._sessions['scorer'], sessions['scorer'])
+            self.assertIs(self.scorer._token_cache, tokens)
+            self.assertEqual(await self.rate(), (200, '{"status":0}'))
+
+            rsp = await self.client.post(endpoint)
+            self.assertEqual(rsp.status, 403)
+            # An unusable config is refused as a whole
+            entries['scorer_balancer'] = 'random'
+            entries['scorer_url'] = str(self.server.make_url('/scorer'))
+            f.seek(0)
+            f.truncate()
+            yaml.safe_dump(entries, f)
+            f.flush()
+            rsp = await self.client.post(endpoint, headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(rsp.status, 400)
+            self.assertEqual(self.scorer.config.scorer_url, str(self.server.make_url('/scorer2')))
+            del entries['scorer_balancer']
+            f.seek(0)
+            f.truncate()
+            yaml.safe_dump(entries, f)
+            f.flush()
+            rsp = await self.client.post(endpoint, headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(rsp.status, 200)
+            self.assertEqual(await rsp.json(), {'changed': ['scorer_url']})
+        self.assertEqual(self.scorer._routes.url_for('abc'), entries['scorer_url'])
+
+    @unittest_run_loop
+    async def test_pipelined(self):
+        self.setUpConfig(pipelined=True, pipeline_queue_chunks=1)
+        self.assertEqual(await self.rate(), (200, '{"status":0}'))
+        self.assertEqual(self.tokens_issued, 2) # T1 rejected while the socket waited
+        status, body = await self.rate('bad', accessToken='T2')
+        self.assertEqual(json.loads(body)['status'], -100)
+        self.assertEqual(len(self.scored_audio), 1)
+        self.assertEqual(len(self.scored_audio[0]), 64 * 50 + 34)
+
+    @unittest_run_loop
+    async def test_rating_errors(self):
+        self.setUpConfig()
+        status, body = await self.rate('bad', accessToken='T2')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['status'], -100)
+        status, _ = await self.rate(meta='not base64!')
+        self.assertEqual(status, 400)
+
 class TestAuthUtil(unittest.TestCase):
     '''Test for the server.auth_util module.
     '''